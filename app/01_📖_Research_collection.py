@@ -2,17 +2,22 @@
 import random
 
 import streamlit as st
-from app.utils.utils import download_abstracts
+from app.utils.quantization import QUANTIZATION_MODES
+from app.utils.utils import download_abstracts, refresh_collection
 from app.utils.vector_database import disconnect_from_vector_db
 from pymilvus import utility
 from streamlit_tags import st_tags
 from utils.llm import KeywordsAgent
 from utils.ui import (
     choose_collection,
+    display_jobs,
+    display_quantization_report,
     display_vector_db_info,
     init_session_states,
+    poll_jobs,
     sidebar_collection_info,
     start_app,
+    watch_job,
 )
 
 init_session_states()
@@ -30,6 +35,12 @@ if len(collections) > 0 and st.checkbox(
 ):
     choose_collection(collections=collections)
     display_vector_db_info()
+    display_quantization_report()
+    if st.button(
+        "Refresh collection",
+        help="Download only the papers published since the last download.",
+    ):
+        watch_job(refresh_collection())
 
 
 st.divider()
@@ -70,12 +81,7 @@ if "refined_keywords" in state:
         st.experimental_rerun()
 
     if cols[0].button("Search abstracts in Arxiv with these keywords"):
-        download_abstracts()
-        st.info(
-            f"{state['total_new_documents']} abstracts were downloaded. \n\n"
-            "Total abstracts in the collection: "
-            f"{state['vector_db'].col.num_entities}"
-        )
+        watch_job(download_abstracts())
 
     state["max_papers"] = cols[1].number_input(
         "Max number of papers to download",
@@ -86,14 +92,20 @@ if "refined_keywords" in state:
     )
 
     state["sort_by"] = cols[1].selectbox("Sort by", ["Relevance", "Submitted date"])
-    state["placeholder"] = st.empty()
+    state["embedding_dtype"] = cols[1].selectbox(
+        "Embedding storage",
+        QUANTIZATION_MODES,
+        help="float16 and int8 use less memory and disk, with a small loss of "
+        "accuracy. Only applies to new collections.",
+    )
 
+active_jobs = display_jobs()
 sidebar_collection_info()
 
 
 st.divider()
 
-if "vector_db" in state:
+if "vector_db" in state and state["vector_db"].col is not None:
     st.write("## Example abstract in the collection:")
     with st.expander("Show example abstract"):
         query = random.choice(
@@ -136,3 +148,5 @@ if "vector_db" in state:
         "Explore collections", url="http://localhost:8501/Explore_collections"
     )
     st.divider()
+
+poll_jobs(active_jobs)
@@ -0,0 +1,259 @@
+"""Command line entry point to build and refresh collections without the app."""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from typing import Iterator
+
+import langchain
+import yaml
+from app.utils.arxiv_harvester import HarvestWatermarks
+from app.utils.embeddings import get_embedding_service
+from app.utils.jobs import get_job_queue
+from app.utils.llm_cache import get_llm_cache
+from app.utils.reranker import recommend_papers
+from app.utils.scoring import score_papers
+from app.utils.topic_model import (
+    TOPIC_FIT_SAMPLE_SIZE,
+    TOPIC_REFIT_NEW_SHARE,
+    TOPIC_REFIT_OUTLIER_INCREASE,
+    TopicModel,
+)
+from app.utils.utils import clean_string
+from app.utils.vector_database import open_collection
+from dotenv import find_dotenv, load_dotenv
+from pymilvus import connections
+
+
+class StageTimings:
+    """Seconds spent in each stage of the run of a collection."""
+
+    def __init__(self, collection_name: str):
+        """Initialize the timings."""
+        self.collection_name = collection_name
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[dict]:
+        """Time a stage, which can add details to the yielded dict."""
+        details = {}
+        start = time.perf_counter()
+        try:
+            yield details
+        finally:
+            seconds = time.perf_counter() - start
+            self.stages.append((name, seconds, details))
+            info = ", ".join(f"{key}: {value}" for key, value in details.items())
+            print(f"[{self.collection_name}] {name} {seconds:.1f} s {info}", flush=True)
+
+
+def load_config(path: str) -> list[dict]:
+    """Load the collections of a YAML config file.
+
+    The file has a list of collections, each with a name and its keywords::
+
+        collections:
+          - name: JWST discoveries
+            keywords: [James Webb Space Telescope, high redshift galaxies]
+            max_papers: 1000
+            sort_by: Relevance
+            embedding_dtype: float32
+            topic_model: true
+            questions:
+              - Which galaxies did JWST find at the highest redshifts?
+    """
+    with open(path, "r") as f:
+        config = yaml.safe_load(f) or {}
+    collections = config.get("collections", [])
+    for collection in collections:
+        if "name" not in collection:
+            raise ValueError(f"A collection in {path} has no name.")
+        collection["collection_name"] = clean_string(collection["name"])
+    return collections
+
+
+def wait_for_job(job_id: int, poll_interval: float = 1.0) -> dict:
+    """Wait for an ingestion job to finish, and return it."""
+    job_queue = get_job_queue()
+    while True:
+        job = job_queue.get(job_id)
+        if job["status"] == "failed":
+            raise RuntimeError(f"Ingestion job {job_id} failed: {job['error']}")
+        if job["status"] == "cancelled":
+            raise RuntimeError(f"Ingestion job {job_id} was cancelled.")
+        if job["status"] == "done":
+            return job
+        time.sleep(poll_interval)
+
+
+def run_collection(config: dict, args: argparse.Namespace) -> StageTimings:
+    """Ingest the papers of a collection, fit its topic model and score papers."""
+    name = config["collection_name"]
+    timings = StageTimings(name)
+    if not args.skip_ingestion:
+        watermarks = HarvestWatermarks(f"./cache/{name}/watermarks.json")
+        refresh = args.refresh and len(watermarks.keywords) > 0
+        with timings.stage("refresh" if refresh else "download") as details:
+            # the job queue runs a single writer per collection, also across the
+            # processes that share its database, like the app
+            job = wait_for_job(
+                get_job_queue().submit(
+                    name,
+                    "refresh" if refresh else "download",
+                    keywords=watermarks.keywords if refresh else config["keywords"],
+                    max_papers=config.get("max_papers", 1000),
+                    sort_by="Submitted date"
+                    if refresh
+                    else config.get("sort_by", "Relevance"),
+                    embedding_dtype=config.get("embedding_dtype", "float32"),
+                )
+            )
+            details["new"] = job["result"]["new_documents"]
+            details["duplicates"] = job["result"]["duplicates"]
+        for stage_name, stage in job["result"]["stages"].items():
+            throughput = stage["items"] / stage["seconds"] if stage["seconds"] else 0
+            timings.stages.append(
+                (
+                    f"  {stage_name}",
+                    stage["seconds"],
+                    {"items": stage["items"], "items/s": f"{throughput:.1f}"},
+                )
+            )
+
+    # opened after the ingestion job, so it sees the papers the job inserted
+    with timings.stage("open"):
+        collection = open_collection(
+            name, get_embedding_service(), config.get("embedding_dtype", "float32")
+        )
+
+    if config.get("topic_model", True) and not args.skip_topics:
+        with timings.stage("topic model") as details:
+            topic_model = TopicModel(collection=collection)
+            if args.update_topics:
+                update = topic_model.update_model(
+                    max_new_share=args.max_new_share,
+                    max_outlier_increase=args.max_outlier_increase,
+                    sample_size=args.topic_sample_size,
+                )
+                details.update(update)
+            else:
+                topic_model.fit_model(sample_size=args.topic_sample_size)
+            details["documents"] = len(topic_model.documents)
+            details["topics"] = len(topic_model.topic_model.get_topics())
+
+    questions = config.get("questions", [])
+    if questions and not args.skip_recommendations:
+        with timings.stage("recommendations") as details:
+            for question in questions:
+                recommendations = recommend_papers(
+                    collection["vector_db"],
+                    question,
+                    k=args.k,
+                    rerank=not args.no_rerank,
+                )
+                score_papers(question, [paper for paper, _ in recommendations])
+            details["questions"] = len(questions)
+    return timings
+
+
+def print_timings(all_timings: list[StageTimings]):
+    """Print a table with the seconds of each stage of each collection."""
+    print(f"\n{'collection':<30} {'stage':<20} {'seconds':>10}  details")
+    for timings in all_timings:
+        for stage, seconds, details in timings.stages:
+            info = ", ".join(f"{key}: {value}" for key, value in details.items())
+            print(f"{timings.collection_name:<30} {stage:<20} {seconds:>10.1f}  {info}")
+
+
+def main(argv: list[str] = None) -> int:
+    """Build or refresh the collections of a config file."""
+    parser = argparse.ArgumentParser(
+        prog="research-assistant",
+        description="Build and refresh research collections and their topic models.",
+    )
+    parser.add_argument("config", help="YAML file with the collections to build.")
+    parser.add_argument(
+        "--parallel",
+        type=int,
+        default=int(os.environ.get("INGESTION_WORKERS", 2)),
+        help="Number of collections processed at the same time.",
+    )
+    parser.add_argument(
+        "--refresh",
+        action="store_true",
+        help="Download only the papers published since the last download.",
+    )
+    parser.add_argument("--skip-ingestion", action="store_true")
+    parser.add_argument("--skip-topics", action="store_true")
+    parser.add_argument("--skip-recommendations", action="store_true")
+    parser.add_argument(
+        "--update-topics",
+        action="store_true",
+        help="Add the new papers to the cached topic model instead of refitting it.",
+    )
+    parser.add_argument(
+        "--topic-sample-size",
+        type=int,
+        default=TOPIC_FIT_SAMPLE_SIZE,
+        help="Bigger collections fit their topic model on a sample of this size.",
+    )
+    parser.add_argument(
+        "--max-new-share",
+        type=float,
+        default=TOPIC_REFIT_NEW_SHARE,
+        help="Share of new papers that makes --update-topics refit the model.",
+    )
+    parser.add_argument(
+        "--max-outlier-increase",
+        type=float,
+        default=TOPIC_REFIT_OUTLIER_INCREASE,
+        help="Increase of the outlier share that makes --update-topics refit.",
+    )
+    parser.add_argument(
+        "--k", type=int, default=12, help="Papers scored for each question."
+    )
+    parser.add_argument(
+        "--no-rerank",
+        action="store_true",
+        help="Score the nearest papers, without the cross-encoder reranker.",
+    )
+    parser.add_argument("--milvus-host", default="localhost")
+    parser.add_argument("--milvus-port", type=int, default=19530)
+    args = parser.parse_args(argv)
+
+    load_dotenv(find_dotenv())
+    # the ingestion jobs of the collections run in the workers of the job queue
+    os.environ["INGESTION_WORKERS"] = str(max(1, args.parallel))
+    collections = load_config(args.config)
+    connections.connect(alias="default", host=args.milvus_host, port=args.milvus_port)
+    langchain.llm_cache = get_llm_cache()
+
+    start = time.perf_counter()
+    all_timings = []
+    failed = []
+    with ThreadPoolExecutor(max_workers=max(1, args.parallel)) as executor:
+        futures = {
+            executor.submit(run_collection, config, args): config["collection_name"]
+            for config in collections
+        }
+        for future in as_completed(futures):
+            try:
+                all_timings.append(future.result())
+            except Exception as e:
+                failed.append(futures[future])
+                print(f"[{futures[future]}] failed: {type(e).__name__}: {e}")
+
+    print_timings(all_timings)
+    print(f"\nTotal: {time.perf_counter() - start:.1f} s")
+    llm_cache = get_llm_cache()
+    print(f"LLM cache: {llm_cache.hits} hits, {llm_cache.misses} misses")
+    if failed:
+        print(f"Failed collections: {', '.join(failed)}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
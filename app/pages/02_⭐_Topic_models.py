@@ -4,7 +4,12 @@
 import os
 
 import streamlit as st
-from app.utils.topic_model import fit_model, load_model, restart_topic_model
+from app.utils.topic_model import (
+    fit_model,
+    load_model,
+    restart_topic_model,
+    update_model,
+)
 from app.utils.ui import (
     choose_collection,
     display_vector_db_info,
@@ -38,16 +43,32 @@ if os.path.exists(f"./cache/{state['collection_name']}/topic_model_docs"):
     st.success(
         "A pre-existing topic model was found in the cache. \n\n"
         "**TIP:** If you have added new papers since the last time you calculated "
-        "the topic model, you should recalculate it."
+        "the topic model, you can add them to the topics of the cached model, "
+        "which is much faster than recalculating it. The model is recalculated "
+        "anyway if the new papers do not fit the topics well."
     )
-    col1, col2 = st.columns(2)
+    col1, col2, col3 = st.columns(3)
     col1.button("Load topic model from cache", on_click=load_model)
-    col2.button("Recalculate topic model", on_click=fit_model)
+    col2.button("Add new papers to topic model", on_click=update_model)
+    col3.button("Recalculate topic model", on_click=fit_model)
 
 else:
     st.info("Fit a topic model to extract the underlying topics in your collection.")
     st.button("Fit topic model", on_click=fit_model)
 
+if state["topic_model_fitted"] and "topic_model_update" in state:
+    update = state["topic_model_update"]
+    if update["refit"]:
+        st.info(
+            f"The topic model was recalculated, {update['new_documents']} new "
+            "papers were added since the last fit."
+        )
+    else:
+        st.success(
+            f"{update['new_documents']} new papers were added to the topics, "
+            f"{update['outlier_share']:.0%} of them as outliers."
+        )
+
 if state["topic_model_fitted"]:
     st.info(
         "**TIP:** If you fit few topics, is possible your research collections has"
@@ -1,7 +1,8 @@
 """Explore collections page."""
 
 import streamlit as st
-from app.utils.llm import ScorePapersAgent
+from app.utils.reranker import RERANK_CANDIDATES, recommend_papers
+from app.utils.scoring import get_paper_scorer
 from app.utils.ui import (
     choose_collection,
     display_vector_db_info,
@@ -32,53 +33,59 @@ state["question"] = st.text_input(
     on_change=clear_recommendations,
 )
 
-if st.checkbox("Generate papers recommendations"):
+options = st.columns(2)
+rerank = options[0].checkbox(
+    "Rerank with a local cross-encoder",
+    value=True,
+    help=f"Rerank the {RERANK_CANDIDATES} closest papers, and show the best ones.",
+)
+skip_llm = options[1].checkbox(
+    "Skip the LLM scores",
+    value=False,
+    disabled=not rerank,
+    help="Show only the reranker scores, without calling the LLM.",
+)
+skip_llm = skip_llm and rerank
 
-    similar_docs = state["vector_db"].similarity_search(
-        query="Represent this sentence for searching relevant passages: "
-        + state["question"],
-        k=12,
-        param={"metric_type": "L2", "params": {"nprobe": 16}},
-    )
-    papers = [
-        {
-            "title": doc.metadata["title"],
-            "authors": doc.metadata["authors"],
-            "published": doc.metadata["published"],
-            "abstract": doc.page_content,
-            "link": doc.metadata["link"],
-        }
-        for doc in similar_docs
-    ]
+if st.checkbox("Generate papers recommendations"):
 
     n_rows = state["rows"]  # starts at 2 rows
     n_cols = 2
-    n_papers = 4
-    for row in range(n_rows):
-        # Start a new batch every n_papers
-        if row * n_cols % n_papers == 0 and f"batch{row*n_cols//n_papers}" not in state:
-            chat_labels = ScorePapersAgent(
-                question=state["question"],
-                papers=papers[row * n_cols : row * n_cols + n_papers],
-            ).get_chat_labels()
-            state[f"batch{row*n_cols//n_papers}"] = chat_labels
-        chat_labels = state[f"batch{row*n_cols//n_papers}"]
+    n_visible = n_rows * n_cols
+    # one more page is searched, to score it while the user reads this one
+    recommendations = recommend_papers(
+        state["vector_db"], state["question"], k=n_visible + 2 * n_cols, rerank=rerank
+    )
+    papers = [paper for paper, _ in recommendations]
+    rerank_scores = [score for _, score in recommendations]
+    if skip_llm:
+        chat_labels = [None] * min(n_visible, len(papers))
+    else:
+        scorer = get_paper_scorer()
+        chat_labels = scorer.score(state["question"], papers[:n_visible])
+        scorer.prefetch(state["question"], papers[n_visible:])
 
+    for row in range(n_rows):
         st.write("---")
         cols = st.columns(n_cols, gap="large")
         for col in range(n_cols):
             i = row * n_cols + col
+            if i >= len(chat_labels):
+                break
             with cols[col]:
-                labels = chat_labels[i % n_papers]
+                labels = chat_labels[i]
                 st.markdown(f"#### {papers[i]['title']}")
-                if labels.score >= 4:
+                if labels is not None and labels.score >= 4:
                     st.success("Highly recommended for your research")
                 st.markdown(f"**{papers[i]['authors']}**")
                 st.markdown(f"*{papers[i]['published']}*")
                 st.markdown(f"*{papers[i]['link']}*")
-                st.caption(f"Topics: {', '.join(labels.topics)}")
-                st.markdown(f"Score: {labels.score}")
-                st.markdown(f"**Reasoning**: {labels.reasoning}")
+                if rerank_scores[i] is not None:
+                    st.caption(f"Reranker score: {rerank_scores[i]:.2f}")
+                if labels is not None:
+                    st.caption(f"Topics: {', '.join(labels.topics)}")
+                    st.markdown(f"Score: {labels.score}")
+                    st.markdown(f"**Reasoning**: {labels.reasoning}")
                 with st.expander("Show Abstract"):
                     st.write(papers[i]["abstract"])
 
@@ -0,0 +1,118 @@
+"""On-disk cache of arXiv API responses."""
+import os
+import threading
+import time
+import zlib
+from typing import Optional
+
+from app.utils.sqlite_utils import connect, evict_least_recently_used
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+class ArxivOfflineError(LookupError):
+    """A page that is not in the cache was requested in offline mode."""
+
+
+class ArxivResponseCache:
+    """
+    Persistent cache of arXiv search pages.
+
+    The pages are stored compressed in a SQLite database, keyed by the query,
+    the sort criterion, the offset and the page size. Entries older than the TTL
+    are refetched, and the least recently used entries are evicted when the cache
+    is bigger than `max_bytes`.
+    In offline mode, pages are only served from the cache, expired or not.
+
+    Parameters:
+        path (str):
+            Path of the SQLite database.
+
+        ttl_seconds (float):
+            Time to live of the entries.
+
+        max_bytes (int):
+            Maximum size of the stored pages.
+
+        offline (bool):
+            Serve pages only from the cache.
+    """
+
+    def __init__(
+        self,
+        path: str = "./cache/arxiv_responses.db",
+        ttl_seconds: float = 7 * 24 * 3600,
+        max_bytes: int = 500 * 1024**2,
+        offline: bool = False,
+    ):
+        """Create the database if it does not exist."""
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with connect(self.path) as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS pages ("
+                "key TEXT PRIMARY KEY, body BLOB, size INTEGER, "
+                "created REAL, accessed REAL)"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS pages_accessed ON pages (accessed)"
+            )
+
+    @staticmethod
+    def make_key(query: str, sort_by: str, start: int, size: int) -> str:
+        """Key of a page of results."""
+        return f"{sort_by}|{start}|{size}|{query}"
+
+    def get(self, key: str) -> Optional[bytes]:
+        """Get a page, or None if it is missing or expired.
+
+        In offline mode, raises ArxivOfflineError if the page is missing.
+        """
+        now = time.time()
+        with self._lock, connect(self.path) as connection:
+            row = connection.execute(
+                "SELECT body, created FROM pages WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and (self.offline or now - row[1] <= self.ttl_seconds):
+                connection.execute(
+                    "UPDATE pages SET accessed = ? WHERE key = ?", (now, key)
+                )
+                return zlib.decompress(row[0])
+        if self.offline:
+            raise ArxivOfflineError(f"Page not in the arXiv cache: {key}")
+        return None
+
+    def put(self, key: str, body: bytes):
+        """Store a page, evicting the least recently used pages if needed."""
+        compressed = zlib.compress(body)
+        now = time.time()
+        with self._lock, connect(self.path) as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?)",
+                (key, compressed, len(compressed), now, now),
+            )
+            evict_least_recently_used(connection, "pages", self.max_bytes)
+
+
+def get_response_cache() -> ArxivResponseCache:
+    """Get the response cache of the process.
+
+    It is configured with the environment variables ARXIV_CACHE_TTL (seconds),
+    ARXIV_CACHE_MAX_MB and ARXIV_OFFLINE (1 to serve only from the cache).
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ArxivResponseCache(
+                ttl_seconds=float(os.environ.get("ARXIV_CACHE_TTL", 7 * 24 * 3600)),
+                max_bytes=int(
+                    float(os.environ.get("ARXIV_CACHE_MAX_MB", 500)) * 1024**2
+                ),
+                offline=os.environ.get("ARXIV_OFFLINE", "0") == "1",
+            )
+    return _cache
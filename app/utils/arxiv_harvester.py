@@ -0,0 +1,345 @@
+"""Concurrent arXiv harvester."""
+import datetime
+import json
+import os
+import queue
+import threading
+import time
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, Optional
+
+import arxiv
+import feedparser
+from app.utils.arxiv_cache import ArxivResponseCache
+
+ARXIV_API_URL = os.environ.get("ARXIV_API_URL", "http://export.arxiv.org/api/query")
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket rate limiter.
+
+    Parameters:
+        rate (float):
+            Tokens added per second.
+
+        capacity (int):
+            Maximum number of tokens, the size of the allowed bursts.
+    """
+
+    def __init__(self, rate: float, capacity: int = 1):
+        """Start with a full bucket."""
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Wait until a token is available and take it."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.capacity, self._tokens + (now - self._updated) * self.rate
+                )
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+# arXiv asks for no more than one request every three seconds, from all the
+# sessions of the process
+ARXIV_RATE_LIMIT = TokenBucket(rate=1 / 3, capacity=1)
+
+
+def entry_id_without_version(entry_id: str) -> str:
+    """Remove the version from an arXiv entry id, so versions are duplicates."""
+    base, _, version = entry_id.rpartition("v")
+    return base if base and version.isdigit() else entry_id
+
+
+def date_window_query(query: str, start: datetime.date, end: datetime.date) -> str:
+    """Restrict a query to the papers submitted between two dates."""
+    return (
+        f"({query}) AND submittedDate:"
+        f"[{start.strftime('%Y%m%d')}0000 TO {end.strftime('%Y%m%d')}2359]"
+    )
+
+
+class ArxivHarvester:
+    """
+    Harvest papers from arXiv running several queries concurrently.
+
+    Each query is paged by its own thread, and all the requests go through a
+    shared token bucket that respects the arXiv rate limits. The results are
+    merged and deduplicated by entry id as they arrive, and the harvest stops
+    once `max_papers` unique papers are collected.
+
+    Parameters:
+        base_url (str):
+            URL of the arXiv API. Can point to a local fake server in tests.
+
+        page_size (int):
+            Number of results per request.
+
+        max_workers (int):
+            Number of queries paged at the same time.
+
+        rate_limit (TokenBucket):
+            Rate limiter shared by the requests.
+
+        num_retries (int):
+            Number of retries of a failed or empty page.
+
+        cache (ArxivResponseCache):
+            Optional cache of the pages. Cached pages skip the rate limit.
+    """
+
+    def __init__(
+        self,
+        base_url: str = ARXIV_API_URL,
+        page_size: int = 200,
+        max_workers: int = 4,
+        rate_limit: TokenBucket = ARXIV_RATE_LIMIT,
+        num_retries: int = 5,
+        cache: Optional[ArxivResponseCache] = None,
+    ):
+        """Initialize the harvester."""
+        self.base_url = base_url
+        self.page_size = page_size
+        self.max_workers = max_workers
+        self.rate_limit = rate_limit
+        self.num_retries = num_retries
+        self.cache = cache
+        self.latest_seen = {}
+        self._newest = {}
+        self._newest_lock = threading.Lock()
+
+    def _page_url(self, query: str, sort_by: str, start: int, size: int) -> str:
+        """URL of a page of results."""
+        params = {
+            "search_query": query,
+            "id_list": "",
+            "sortBy": "relevance" if sort_by == "Relevance" else "submittedDate",
+            "sortOrder": "descending",
+            "start": start,
+            "max_results": size,
+        }
+        return f"{self.base_url}?{urllib.parse.urlencode(params)}"
+
+    def fetch_page(
+        self, query: str, sort_by: str, start: int, size: int
+    ) -> tuple[list[arxiv.Result], int]:
+        """Fetch a page of results, with the total number of results of the query.
+
+        arXiv sometimes returns empty pages before the end of the results, so
+        those are retried like failed requests, and are not cached.
+        """
+        key = ArxivResponseCache.make_key(query, sort_by, start, size)
+        body = None if self.cache is None else self.cache.get(key)
+        if body is not None:
+            return self._parse_page(body)
+
+        url = self._page_url(query, sort_by, start, size)
+        for attempt in range(self.num_retries + 1):
+            self.rate_limit.acquire()
+            try:
+                with urllib.request.urlopen(url, timeout=30) as response:
+                    body = response.read()
+                results, total = self._parse_page(body)
+                if len(results) > 0 or start >= total:
+                    if self.cache is not None:
+                        self.cache.put(key, body)
+                    return results, total
+            except Exception:
+                if attempt == self.num_retries:
+                    raise
+            time.sleep(2**attempt)
+        return [], start
+
+    @staticmethod
+    def _parse_page(body: bytes) -> tuple[list[arxiv.Result], int]:
+        """Parse the results of a page, and the total number of results."""
+        feed = feedparser.parse(body)
+        total = int(feed.feed.get("opensearch_totalresults", 0))
+        return [arxiv.Result._from_feed_entry(e) for e in feed.entries], total
+
+    def _page_query(
+        self,
+        keyword: str,
+        query: str,
+        sort_by: str,
+        max_results: int,
+        results: queue.Queue,
+        stop: threading.Event,
+        watermark: Optional[datetime.datetime] = None,
+    ) -> bool:
+        """Page through a query, putting its results in the queue.
+
+        With a watermark, the query must be sorted by submitted date, and the
+        paging stops at the first paper published before the watermark.
+        The newest paper fetched for the keyword is kept, to become its
+        watermark if all its queries are harvested completely.
+        Returns True if all the results (newer than the watermark) were fetched.
+        """
+        start = 0
+        while start < max_results and not stop.is_set():
+            size = min(self.page_size, max_results - start)
+            page, total = self.fetch_page(query, sort_by, start, size)
+            if page:
+                newest = max(page, key=lambda result: result.published)
+                with self._newest_lock:
+                    latest = self._newest.get(keyword)
+                    if latest is None or newest.published > latest.published:
+                        self._newest[keyword] = newest
+            for result in page:
+                if watermark is not None and result.published < watermark:
+                    return True
+                results.put((keyword, result))
+            start += len(page)
+            if len(page) < size or start >= total:
+                return True
+        return False
+
+    def harvest(
+        self,
+        queries: list[str],
+        max_papers: int,
+        sort_by: str = "Relevance",
+        date_windows: Optional[list[tuple[datetime.date, datetime.date]]] = None,
+        watermarks: Optional[dict[str, datetime.datetime]] = None,
+    ) -> Iterator[arxiv.Result]:
+        """Yield unique papers from all the queries, as they arrive.
+
+        If date windows are given, each query is run once per window.
+        If watermarks are given, each query only fetches the papers published
+        after its watermark, sorted by submitted date.
+        After the harvest, `latest_seen` has the newest paper of each keyword
+        whose queries were all harvested completely, down to their watermark or
+        to the end of their results, with all their papers yielded. The keywords
+        cut by `max_papers` are left out, so their watermarks don't move past the
+        papers that were not fetched.
+        """
+        watermarks = watermarks or {}
+        if watermarks:
+            sort_by = "Submitted date"
+        jobs = [(query, query) for query in queries]
+        if date_windows:
+            jobs = [
+                (query, date_window_query(query, start, end))
+                for query in queries
+                for start, end in date_windows
+            ]
+        results = queue.Queue()
+        stop = threading.Event()
+        seen = set()
+        complete, incomplete = object(), object()
+        self.latest_seen = {}
+        self._newest = {}
+        pending = {}
+        for keyword, _ in jobs:
+            pending[keyword] = pending.get(keyword, 0) + 1
+
+        def run(keyword: str, query: str):
+            """Page a query and signal whether it fetched all its results."""
+            status = incomplete
+            try:
+                if self._page_query(
+                    keyword,
+                    query,
+                    sort_by,
+                    max_papers,
+                    results,
+                    stop,
+                    watermarks.get(keyword),
+                ):
+                    status = complete
+            finally:
+                # after the results of the query, so they were all yielded
+                results.put((keyword, status))
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(run, *job) for job in jobs]
+            try:
+                remaining = len(jobs)
+                while remaining > 0 and len(seen) < max_papers:
+                    keyword, result = results.get()
+                    if result is complete or result is incomplete:
+                        remaining -= 1
+                        if result is incomplete:
+                            pending[keyword] = None
+                        elif pending[keyword] is not None:
+                            pending[keyword] -= 1
+                            if pending[keyword] == 0 and keyword in self._newest:
+                                self.latest_seen[keyword] = self._newest[keyword]
+                        continue
+                    paper_id = entry_id_without_version(result.entry_id)
+                    if paper_id not in seen:
+                        seen.add(paper_id)
+                        yield result
+            finally:
+                stop.set()
+        for future in futures:
+            # surface the errors of the queries, after the results that arrived
+            if future.done() and future.exception() is not None:
+                raise future.exception()
+
+
+class HarvestWatermarks:
+    """
+    Newest paper harvested for each keyword of a collection.
+
+    Stored as a json file with the published date and entry id of the newest
+    paper of each keyword. A refresh of the collection only needs the papers
+    published after these dates.
+
+    Parameters:
+        path (str):
+            Path of the json file.
+    """
+
+    def __init__(self, path: str):
+        """Load the watermarks."""
+        self.path = path
+        self.watermarks = {}
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                self.watermarks = json.load(f)
+
+    @property
+    def keywords(self) -> list[str]:
+        """Keywords harvested for the collection."""
+        return list(self.watermarks)
+
+    def published_dates(self) -> dict[str, Optional[datetime.datetime]]:
+        """Published date of the newest paper of each keyword."""
+        return {
+            keyword: datetime.datetime.fromisoformat(watermark["published"])
+            if watermark.get("published")
+            else None
+            for keyword, watermark in self.watermarks.items()
+        }
+
+    def update(self, keywords: list[str], latest_seen: dict[str, arxiv.Result]):
+        """Add the keywords, and move their watermarks to the newest papers."""
+        for keyword in keywords:
+            self.watermarks.setdefault(keyword, {})
+        for keyword, result in latest_seen.items():
+            published = self.published_dates().get(keyword)
+            if published is None or result.published > published:
+                self.watermarks[keyword] = {
+                    "published": result.published.isoformat(),
+                    "entry_id": result.entry_id,
+                }
+
+    def save(self):
+        """Save the watermarks."""
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path, "w") as f:
+            json.dump(self.watermarks, f, indent=2)
@@ -0,0 +1,201 @@
+"""Bulk encoder for the ingestion of many documents."""
+import multiprocessing
+import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Iterator
+
+import numpy as np
+from app.utils.embeddings import EMBEDDING_MODEL_NAME, create_embedding_model
+
+# model loaded in each worker process
+_worker_model = None
+
+_bulk_encoder = None
+_bulk_encoder_lock = threading.Lock()
+
+
+def _init_worker(backend: str, n_threads: int):
+    """Load the embedding model in the worker process."""
+    global _worker_model
+    try:
+        import torch
+
+        torch.set_num_threads(n_threads)
+    except ImportError:
+        pass
+    os.environ["OMP_NUM_THREADS"] = str(n_threads)
+    _worker_model = create_embedding_model(backend)
+
+
+def _encode_batch(indices: list[int], texts: list[str]):
+    """Encode a batch of texts in the worker process."""
+    return indices, np.array(_worker_model.embed_documents(texts), dtype=np.float32)
+
+
+def available_cores() -> int:
+    """Number of cores the process can use."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+class BulkEncoder:
+    """
+    Length-bucketed, multi-process batch encoder.
+
+    The texts are sorted by their number of tokens, so each batch contains texts
+    of similar length and little padding. The batch size is adapted to the length
+    of the texts, keeping the number of padded tokens per batch under a budget.
+    The batches are encoded by a pool of processes, each with its own copy of the
+    model, and the embeddings are streamed back in the original order.
+    Used as a context manager, the pool is kept alive between calls.
+
+    Parameters:
+        n_workers (int):
+            Number of worker processes. Defaults to the available cores, up to 8.
+
+        max_tokens_per_batch (int):
+            Maximum number of padded tokens in a batch.
+
+        max_batch_size (int):
+            Maximum number of texts in a batch.
+
+        backend (str):
+            Embedding backend of the workers: torch or onnx. Defaults to the
+            EMBEDDING_BACKEND environment variable.
+    """
+
+    def __init__(
+        self,
+        n_workers: int = None,
+        max_tokens_per_batch: int = 16384,
+        max_batch_size: int = 128,
+        backend: str = None,
+    ):
+        """Initialize the encoder."""
+        from transformers import AutoTokenizer
+
+        self.n_workers = n_workers or min(available_cores(), 8)
+        self.max_tokens_per_batch = max_tokens_per_batch
+        self.max_batch_size = max_batch_size
+        self.backend = backend or os.environ.get("EMBEDDING_BACKEND", "torch")
+        self.tokenizer = AutoTokenizer.from_pretrained(EMBEDDING_MODEL_NAME)
+        self._executor = None
+
+    def _create_executor(self, n_workers: int) -> ProcessPoolExecutor:
+        """Create a pool of worker processes with the model loaded."""
+        return ProcessPoolExecutor(
+            max_workers=n_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(self.backend, max(1, available_cores() // self.n_workers)),
+        )
+
+    def start(self) -> "BulkEncoder":
+        """Start the pool of workers, if it is not running yet."""
+        if self._executor is None:
+            self._executor = self._create_executor(self.n_workers)
+        return self
+
+    def __enter__(self) -> "BulkEncoder":
+        """Start the pool of workers."""
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        """Stop the pool of workers."""
+        self._executor.shutdown()
+        self._executor = None
+
+    def make_batches(self, texts: list[str]) -> list[list[int]]:
+        """Group the indices of the texts in batches of similar token length."""
+        lengths = [
+            len(ids)
+            for ids in self.tokenizer(
+                texts, truncation=True, max_length=512, add_special_tokens=True
+            )["input_ids"]
+        ]
+        batches = []
+        batch = []
+        for i in np.argsort(lengths, kind="stable"):
+            # texts are sorted by length, so the last one sets the padding
+            padded_tokens = (len(batch) + 1) * lengths[i]
+            if batch and (
+                padded_tokens > self.max_tokens_per_batch
+                or len(batch) == self.max_batch_size
+            ):
+                batches.append(batch)
+                batch = []
+            batch.append(int(i))
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def iter_encode(
+        self, texts: list[str], chunk_size: int = 256
+    ) -> Iterator[tuple[int, np.ndarray]]:
+        """Encode the texts, yielding chunks of embeddings in the original order.
+
+        Yields the start index of each chunk and its embeddings, as soon as all
+        the texts of the chunk are encoded.
+        """
+        if len(texts) == 0:
+            return
+        batches = self.make_batches(texts)
+        embeddings = None
+        done = np.zeros(len(texts), dtype=bool)
+        next_start = 0
+
+        executor = self._executor or self._create_executor(
+            min(self.n_workers, len(batches))
+        )
+        pending = set()
+        try:
+            pending = {
+                executor.submit(_encode_batch, batch, [texts[i] for i in batch])
+                for batch in batches
+            }
+            while pending:
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    indices, batch_embeddings = future.result()
+                    if embeddings is None:
+                        embeddings = np.empty(
+                            (len(texts), batch_embeddings.shape[1]), dtype=np.float32
+                        )
+                    embeddings[indices] = batch_embeddings
+                    done[indices] = True
+
+                while next_start < len(texts):
+                    end = min(next_start + chunk_size, len(texts))
+                    if not done[next_start:end].all():
+                        break
+                    yield next_start, embeddings[next_start:end]
+                    next_start = end
+        finally:
+            # a consumer that stops early frees the shared workers
+            for future in pending:
+                future.cancel()
+            if executor is not self._executor:
+                executor.shutdown()
+
+    def encode(self, texts: list[str]) -> np.ndarray:
+        """Encode all the texts."""
+        chunks = [chunk for _, chunk in self.iter_encode(texts)]
+        if len(chunks) == 0:
+            return np.empty((0, 0), dtype=np.float32)
+        return np.concatenate(chunks)
+
+
+def get_bulk_encoder() -> BulkEncoder:
+    """Get the bulk encoder of the process, starting its pool of workers once.
+
+    The workers load the model only once, and are shared by the ingestions of
+    all the collections.
+    """
+    global _bulk_encoder
+    with _bulk_encoder_lock:
+        if _bulk_encoder is None:
+            _bulk_encoder = BulkEncoder().start()
+    return _bulk_encoder
@@ -0,0 +1,235 @@
+"""Packed single-file byte store."""
+import argparse
+import fcntl
+import mmap
+import os
+import struct
+import threading
+from contextlib import contextmanager
+from typing import BinaryIO, Iterator, Optional, Sequence
+
+from langchain.schema import BaseStore
+
+# key length, value length (-1 marks a deleted key)
+_HEADER = struct.Struct("<Iq")
+_DELETED = -1
+# bytes read after each header, enough for the keys of the embedding cache
+_KEY_READ_SIZE = 128
+
+
+class PackedFileStore(BaseStore[str, bytes]):
+    """
+    Byte store backed by a single append-only file.
+
+    Each record is a header with the key and value lengths, followed by the key
+    and the value. An in-memory index maps every key to the offset of its latest
+    value, so `mset` is a single append and `mget` reads the values through a
+    memory map in file order. Overwritten and deleted values stay in the file
+    until `compact` is called.
+    Every read first indexes the records that other instances sharing the file
+    appended since the last one, found by the file size, or the whole file if it
+    was compacted. So the values overwritten or deleted by other instances are
+    never read stale. The instance can be shared by threads.
+
+    Parameters:
+        path (str):
+            Path of the file. It is created if it does not exist.
+    """
+
+    def __init__(self, path: str):
+        """Open the file and build the index."""
+        self.path = path
+        self._index = {}
+        self._size = 0
+        # kept open, so its inode is not reused by a later compacted file
+        self._file = None
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        if not os.path.exists(path):
+            open(path, "wb").close()
+        self._refresh()
+
+    def _refresh(self):
+        """Index the records appended to the file since the last scan.
+
+        Called with the lock of the instance held, except in the constructor.
+        """
+        if (
+            self._file is None
+            or os.stat(self.path).st_ino != os.fstat(self._file.fileno()).st_ino
+        ):
+            # first scan, or the file was compacted by another instance
+            self._open_indexed_file()
+        fileno = self._file.fileno()
+        file_size = os.fstat(fileno).st_size
+        # only the headers and the keys are read, the values are skipped
+        while self._size + _HEADER.size <= file_size:
+            data = os.pread(fileno, _HEADER.size + _KEY_READ_SIZE, self._size)
+            key_length, value_length = _HEADER.unpack_from(data)
+            value_start = self._size + _HEADER.size + key_length
+            end = value_start + max(value_length, 0)
+            if end > file_size:
+                # incomplete record, still being written or left by a crash
+                break
+            if key_length > _KEY_READ_SIZE:
+                data = os.pread(fileno, _HEADER.size + key_length, self._size)
+            key = data[_HEADER.size : _HEADER.size + key_length].decode("utf-8")
+            if value_length == _DELETED:
+                self._index.pop(key, None)
+            else:
+                self._index[key] = (value_start, value_length)
+            self._size = end
+
+    def _open_indexed_file(self):
+        """Open the current file, and empty the index of the previous one."""
+        if self._file is not None:
+            self._file.close()
+        self._file = open(self.path, "rb")
+        self._index = {}
+        self._size = 0
+
+    @contextmanager
+    def _locked(self, mode: str) -> Iterator[BinaryIO]:
+        """Open the file with an exclusive lock.
+
+        A compaction of another instance can replace the file while the lock is
+        awaited, so the file is opened again until the locked file is the
+        current one.
+        """
+        while True:
+            f = open(self.path, mode)
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                current = os.stat(self.path).st_ino == os.fstat(f.fileno()).st_ino
+            except FileNotFoundError:
+                current = False
+            if current:
+                break
+            fcntl.flock(f, fcntl.LOCK_UN)
+            f.close()
+        try:
+            yield f
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+            f.close()
+
+    def _append(self, records: list[tuple[str, Optional[bytes]]]):
+        """Append records to the file. A None value deletes the key."""
+        with self._lock, self._locked("ab") as f:
+            self._refresh()
+            # drop any incomplete record left by an interrupted write
+            f.truncate(self._size)
+            buffer = bytearray()
+            offsets = []
+            for key, value in records:
+                encoded_key = key.encode("utf-8")
+                value_length = _DELETED if value is None else len(value)
+                buffer += _HEADER.pack(len(encoded_key), value_length)
+                buffer += encoded_key
+                offsets.append((key, self._size + len(buffer), value_length))
+                if value is not None:
+                    buffer += value
+            f.write(buffer)
+            f.flush()
+            os.fsync(f.fileno())
+
+            for key, offset, value_length in offsets:
+                if value_length == _DELETED:
+                    self._index.pop(key, None)
+                else:
+                    self._index[key] = (offset, value_length)
+            self._size += len(buffer)
+
+    def mget(self, keys: Sequence[str]) -> list[Optional[bytes]]:
+        """Get the values of the keys, reading them in file order."""
+        values = [None] * len(keys)
+        with self._lock:
+            self._refresh()
+            found = sorted(
+                (self._index[key][0], self._index[key][1], i)
+                for i, key in enumerate(keys)
+                if key in self._index
+            )
+            if len(found) == 0:
+                return values
+            # the offsets are those of the indexed file, even if it was replaced
+            with mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                for offset, length, i in found:
+                    values[i] = data[offset : offset + length]
+        return values
+
+    def mset(self, key_value_pairs: Sequence[tuple[str, bytes]]) -> None:
+        """Set the values of the keys with a single append."""
+        if len(key_value_pairs) > 0:
+            self._append(list(key_value_pairs))
+
+    def mdelete(self, keys: Sequence[str]) -> None:
+        """Delete the keys."""
+        with self._lock:
+            self._refresh()
+            deleted = [(key, None) for key in keys if key in self._index]
+        if len(deleted) > 0:
+            self._append(deleted)
+
+    def yield_keys(self, prefix: Optional[str] = None) -> Iterator[str]:
+        """Yield the keys in the store, optionally filtered by prefix."""
+        with self._lock:
+            self._refresh()
+            keys = list(self._index)
+        for key in keys:
+            if prefix is None or key.startswith(prefix):
+                yield key
+
+    def __len__(self) -> int:
+        """Number of keys in the store."""
+        with self._lock:
+            self._refresh()
+            return len(self._index)
+
+    def compact(self) -> int:
+        """Rewrite the file with only the latest value of each key.
+
+        Returns the number of bytes reclaimed.
+        """
+        tmp_path = f"{self.path}.compact"
+        with self._lock, self._locked("rb") as f:
+            self._refresh()
+            old_size = self._size
+            if old_size == 0:
+                return 0
+            new_index = {}
+            position = 0
+            live = sorted(
+                (offset, length, key) for key, (offset, length) in self._index.items()
+            )
+            with open(tmp_path, "wb") as out, mmap.mmap(
+                f.fileno(), 0, access=mmap.ACCESS_READ
+            ) as data:
+                for offset, length, key in live:
+                    encoded_key = key.encode("utf-8")
+                    header = _HEADER.pack(len(encoded_key), length)
+                    out.write(header + encoded_key)
+                    out.write(data[offset : offset + length])
+                    new_index[key] = (
+                        position + len(header) + len(encoded_key),
+                        length,
+                    )
+                    position += len(header) + len(encoded_key) + length
+                out.flush()
+                os.fsync(out.fileno())
+            os.replace(tmp_path, self.path)
+            self._open_indexed_file()
+            self._index = new_index
+            self._size = position
+        return old_size - self._size
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage packed byte stores.")
+    parser.add_argument("command", choices=["compact"])
+    parser.add_argument("path", help="Path of the packed store file.")
+    args = parser.parse_args()
+
+    store = PackedFileStore(args.path)
+    reclaimed = store.compact()
+    print(f"Compacted {args.path}: {len(store)} keys, {reclaimed} bytes reclaimed.")
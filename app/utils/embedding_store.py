@@ -0,0 +1,197 @@
+"""Memory-mapped embedding store."""
+import fcntl
+import json
+import os
+import threading
+from typing import Optional
+
+import numpy as np
+from app.utils.quantization import dequantize, quantize
+
+
+class EmbeddingStore:
+    """
+    Contiguous matrix with the embeddings of a collection.
+
+    The embeddings are appended as rows of a single file, and their ids
+    are kept in a text file, one id per line, in the same order as the rows.
+    The matrix is opened with `np.memmap`, so reading the embeddings of the whole
+    collection doesn't copy them into memory.
+    The rows can be stored as float32, float16 or int8 with one float32 scale per
+    row. Quantized rows are dequantized when they are read.
+
+    Parameters:
+        path (str):
+            Directory where the matrix, the ids and the metadata are stored.
+
+        mode (str):
+            Storage mode for a new store: float32, float16 or int8. The mode of
+            an existing store is read from its metadata.
+
+    Attributes:
+        dim (int):
+            Dimension of the embeddings. None until the first append.
+    """
+
+    def __init__(self, path: str, mode: str = "float32"):
+        """Load the ids and the metadata of the store."""
+        self.path = path
+        self.matrix_path = os.path.join(path, "embeddings.bin")
+        self.scales_path = os.path.join(path, "scales.f32")
+        self.ids_path = os.path.join(path, "ids.txt")
+        self.meta_path = os.path.join(path, "meta.json")
+        self.lock_path = os.path.join(path, "lock")
+        self.dim = None
+        self.mode = mode
+        self.dtype = np.dtype(mode)
+        self._rows = {}
+        self._n_rows = 0
+        self._ids_size = 0
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        """Read the metadata and the ids of the rows written so far."""
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, "r") as f:
+                meta = json.load(f)
+            self.dim = meta["dim"]
+            self.mode = meta.get("mode", "float32")
+        self.dtype = np.dtype(self.mode)
+        if not os.path.exists(self.ids_path):
+            return
+        with open(self.ids_path, "rb") as f:
+            f.seek(self._ids_size)
+            lines = f.read().splitlines(keepends=True)
+        # rows written without their ids (an interrupted append) are ignored
+        for line in lines[: self._rows_on_disk() - self._n_rows]:
+            if not line.endswith(b"\n"):
+                break
+            self._rows.setdefault(line.decode("utf-8").strip(), self._n_rows)
+            self._n_rows += 1
+            self._ids_size += len(line)
+
+    def _rows_on_disk(self) -> int:
+        """Number of complete rows in the matrix file."""
+        if self.dim is None or not os.path.exists(self.matrix_path):
+            return 0
+        rows = os.path.getsize(self.matrix_path) // (self.dim * self.dtype.itemsize)
+        if self.mode == "int8":
+            scales_size = (
+                os.path.getsize(self.scales_path)
+                if os.path.exists(self.scales_path)
+                else 0
+            )
+            rows = min(rows, scales_size // 4)
+        return rows
+
+    def __len__(self) -> int:
+        """Number of rows in the store."""
+        return self._n_rows
+
+    def __contains__(self, id_: str) -> bool:
+        """Check if the id is in the store."""
+        return id_ in self._rows
+
+    def contains_all(self, ids: list[str]) -> bool:
+        """Check if all the ids are in the store."""
+        return all(id_ in self._rows for id_ in ids)
+
+    def append(self, ids: list[str], vectors: np.ndarray):
+        """Append the vectors of the ids that are not in the store yet.
+
+        Other instances, also in other processes, can append to the same store:
+        the appends hold a lock on the store, and read the rows the other
+        instances appended before writing theirs after them.
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        os.makedirs(self.path, exist_ok=True)
+        with self._lock, open(self.lock_path, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                self._load()
+                new = {}
+                for id_, vector in zip(ids, vectors):
+                    if id_ not in self._rows and id_ not in new:
+                        new[id_] = vector
+                if len(new) == 0:
+                    return
+
+                if self.dim is None:
+                    self.dim = vectors.shape[1]
+                    with open(self.meta_path, "w") as f:
+                        json.dump({"dim": self.dim, "mode": self.mode}, f)
+
+                codes, scales = quantize(np.stack(list(new.values())), self.mode)
+                row_bytes = self.dim * self.dtype.itemsize
+                self._write_at(self.matrix_path, self._n_rows * row_bytes, codes)
+                if scales is not None:
+                    self._write_at(
+                        self.scales_path, self._n_rows * scales.itemsize, scales
+                    )
+                ids_text = "".join(f"{id_}\n" for id_ in new).encode("utf-8")
+                self._write_at(self.ids_path, self._ids_size, ids_text)
+
+                for id_ in new:
+                    self._rows[id_] = self._n_rows
+                    self._n_rows += 1
+                self._ids_size += len(ids_text)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _write_at(path: str, offset: int, data):
+        """Write data at the end of the rows stored in a file.
+
+        Only the leftovers of an interrupted append can follow the offset, so
+        they are overwritten and cut, and the rows before it are left untouched.
+        """
+        with open(path, "r+b" if os.path.exists(path) else "wb") as f:
+            f.seek(offset)
+            f.write(data if isinstance(data, bytes) else data.tobytes())
+            f.truncate()
+
+    def matrix(self) -> Optional[np.memmap]:
+        """Read-only view of all the stored codes, with shape (n_rows, dim)."""
+        if self._n_rows == 0:
+            return None
+        return np.memmap(
+            self.matrix_path,
+            dtype=self.dtype,
+            mode="r",
+            shape=(self._n_rows, self.dim),
+        )
+
+    def scales(self) -> Optional[np.memmap]:
+        """Read-only view of the scales of the int8 rows."""
+        if self._n_rows == 0 or self.mode != "int8":
+            return None
+        return np.memmap(
+            self.scales_path, dtype=np.float32, mode="r", shape=(self._n_rows,)
+        )
+
+    def get(self, ids: list[str]) -> np.ndarray:
+        """Get the float32 embeddings of the ids, in the same order.
+
+        In float32 mode, if the ids are the rows of the store in order, returns
+        a view of the memory-mapped matrix instead of a copy.
+        Quantized rows are dequantized on the fly.
+        """
+        rows = np.fromiter((self._rows[id_] for id_ in ids), dtype=np.int64)
+        matrix = self.matrix()
+        if matrix is None:
+            return np.empty((0, self.dim or 0), dtype=np.float32)
+        in_order = np.array_equal(rows, np.arange(len(rows)))
+        if self.mode == "float32":
+            return matrix[: len(rows)] if in_order else matrix[rows]
+        scales = self.scales()
+        return dequantize(
+            matrix[: len(rows)] if in_order else matrix[rows],
+            None if scales is None else scales[rows],
+        )
+
+    def sample(self, n: int, seed: int = 42) -> np.ndarray:
+        """Get the float32 embeddings of up to n random rows."""
+        rng = np.random.default_rng(seed)
+        ids = list(self._rows)
+        return self.get([ids[i] for i in rng.permutation(len(ids))[:n]])
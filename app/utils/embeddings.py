@@ -0,0 +1,291 @@
+"""Embedding model shared by all the sessions of the process."""
+import os
+import queue
+import shutil
+import tempfile
+import threading
+from concurrent.futures import Future
+
+import numpy as np
+from langchain.embeddings import HuggingFaceBgeEmbeddings
+from langchain.embeddings.base import Embeddings
+
+EMBEDDING_MODEL_NAME = "BAAI/bge-small-en-v1.5"
+QUERY_INSTRUCTION = "Represent this sentence for searching relevant passages: "
+EMBEDDING_BACKENDS = ["torch", "onnx"]
+
+_service = None
+_service_lock = threading.Lock()
+
+
+class EmbeddingService(Embeddings):
+    """
+    Thread-safe wrapper around an embedding model.
+
+    Document requests from different threads are put in a queue, and a background
+    worker coalesces them into batches of up to `max_batch_size` texts before
+    calling the model. Each caller waits only for the results of its own texts.
+
+    Parameters:
+        model (Embeddings):
+            The underlying embedding model.
+
+        max_batch_size (int):
+            Maximum number of texts encoded in a single call to the model.
+
+        max_wait (float):
+            Seconds the worker waits for more requests before encoding a batch.
+    """
+
+    def __init__(
+        self, model: Embeddings, max_batch_size: int = 256, max_wait: float = 0.01
+    ):
+        """Start the batching worker."""
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._model_lock = threading.Lock()
+        self._requests = queue.Queue()
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    @property
+    def model_name(self) -> str:
+        """Name of the underlying model."""
+        return self.model.model_name
+
+    def _next_batch(self) -> list[tuple[list[str], Future]]:
+        """Wait for a request, and collect the ones that arrive shortly after."""
+        batch = [self._requests.get()]
+        n_texts = len(batch[0][0])
+        while n_texts < self.max_batch_size:
+            try:
+                request = self._requests.get(timeout=self.max_wait)
+            except queue.Empty:
+                break
+            batch.append(request)
+            n_texts += len(request[0])
+        return batch
+
+    def _run(self):
+        """Encode the coalesced requests and resolve their futures."""
+        while True:
+            batch = self._next_batch()
+            texts = [text for request_texts, _ in batch for text in request_texts]
+            try:
+                with self._model_lock:
+                    embeddings = self.model.embed_documents(texts)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            start = 0
+            for request_texts, future in batch:
+                future.set_result(embeddings[start : start + len(request_texts)])
+                start += len(request_texts)
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        """Embed the documents in the shared batches."""
+        if len(texts) == 0:
+            return []
+        future = Future()
+        self._requests.put((list(texts), future))
+        return future.result()
+
+    def embed_query(self, text: str) -> list[float]:
+        """Embed a query."""
+        with self._model_lock:
+            return self.model.embed_query(text)
+
+
+class OnnxBgeEmbeddings(Embeddings):
+    """
+    BGE embeddings computed with ONNX Runtime on CPU.
+
+    The first time it is used, the Hugging Face model is exported to ONNX and its
+    weights are quantized to int8 with dynamic quantization. The exported model is
+    checked against the sentence-transformers model, and saved in `cache_dir`.
+    As in sentence-transformers, the embedding is the normalized CLS token, so the
+    vectors are compatible with the ones of existing collections.
+
+    Parameters:
+        model_name (str):
+            Name of the Hugging Face model.
+
+        query_instruction (str):
+            Instruction prepended to the queries.
+
+        cache_dir (str):
+            Directory where the exported models are saved.
+
+        batch_size (int):
+            Number of texts per inference call.
+
+        min_similarity (float):
+            Minimum cosine similarity with the sentence-transformers embeddings
+            required to accept the exported model.
+    """
+
+    def __init__(
+        self,
+        model_name: str = EMBEDDING_MODEL_NAME,
+        query_instruction: str = QUERY_INSTRUCTION,
+        cache_dir: str = "./cache/onnx",
+        batch_size: int = 32,
+        min_similarity: float = 0.99,
+    ):
+        """Load the exported model, exporting it first if needed."""
+        try:
+            import onnxruntime  # noqa: F401
+            from transformers import AutoTokenizer
+        except ImportError as e:
+            raise ImportError(
+                "The onnx embedding backend needs onnxruntime, "
+                "install it with `poetry install --extras onnx`."
+            ) from e
+
+        self.model_name = model_name
+        self.query_instruction = query_instruction
+        self.batch_size = batch_size
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+
+        model_dir = os.path.join(cache_dir, model_name.replace("/", "__"))
+        model_path = os.path.join(model_dir, "model_int8.onnx")
+        if os.path.exists(model_path):
+            self._load_session(model_path)
+            return
+
+        # exported to a directory of its own, so concurrent first loads don't
+        # overwrite each other, and moved into place once it is validated
+        os.makedirs(model_dir, exist_ok=True)
+        export_dir = tempfile.mkdtemp(dir=model_dir)
+        try:
+            exported_path = self._export(export_dir)
+            self._load_session(exported_path)
+            similarity = self.similarity_to_reference()
+            if similarity < min_similarity:
+                raise ValueError(
+                    f"The quantized model has a cosine similarity of {similarity:.4f} "
+                    f"with the reference embeddings, below {min_similarity}."
+                )
+            os.replace(exported_path, model_path)
+        finally:
+            shutil.rmtree(export_dir, ignore_errors=True)
+
+    def _load_session(self, model_path: str):
+        """Start an ONNX Runtime session with the model."""
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = (
+            onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        )
+        self.session = onnxruntime.InferenceSession(
+            model_path, options, providers=["CPUExecutionProvider"]
+        )
+        self._input_names = {i.name for i in self.session.get_inputs()}
+
+    def _export(self, export_dir: str) -> str:
+        """Export the model to ONNX with int8 weights, and return its path."""
+        import torch
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        from transformers import AutoModel
+
+        fp32_path = os.path.join(export_dir, "model.onnx")
+        model_path = os.path.join(export_dir, "model_int8.onnx")
+        model = AutoModel.from_pretrained(self.model_name).eval()
+        dummy = self.tokenizer(["export"], return_tensors="pt")
+        input_names = list(dummy.keys())
+        dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+        dynamic_axes["last_hidden_state"] = {0: "batch", 1: "sequence"}
+        with torch.no_grad():
+            torch.onnx.export(
+                model,
+                tuple(dummy[name] for name in input_names),
+                fp32_path,
+                input_names=input_names,
+                output_names=["last_hidden_state"],
+                dynamic_axes=dynamic_axes,
+                opset_version=14,
+            )
+        quantize_dynamic(fp32_path, model_path, weight_type=QuantType.QInt8)
+        return model_path
+
+    def similarity_to_reference(self, texts: list[str] = None) -> float:
+        """Minimum cosine similarity with the sentence-transformers embeddings."""
+        if texts is None:
+            texts = [
+                "We report the discovery of a galaxy at redshift 13.",
+                "Room temperature superconductivity in a nitrogen-doped hydride.",
+                "Large language models can be prompted to reason step by step.",
+                QUERY_INSTRUCTION + "stellar evolution",
+            ]
+        reference = HuggingFaceBgeEmbeddings(
+            model_name=self.model_name,
+            encode_kwargs={"normalize_embeddings": True},
+        ).embed_documents(texts)
+        return float(np.min(np.sum(np.array(reference) * self._encode(texts), axis=1)))
+
+    def _encode(self, texts: list[str]) -> np.ndarray:
+        """Encode the texts, in batches of texts with similar length."""
+        texts = [text.replace("\n", " ") for text in texts]
+        order = np.argsort([len(text) for text in texts])
+        embeddings = np.empty((len(texts), 0), dtype=np.float32)
+        batches = []
+        for start in range(0, len(texts), self.batch_size):
+            batch = [texts[i] for i in order[start : start + self.batch_size]]
+            inputs = self.tokenizer(
+                batch,
+                padding=True,
+                truncation=True,
+                max_length=512,
+                return_tensors="np",
+            )
+            inputs = {
+                name: value.astype(np.int64)
+                for name, value in inputs.items()
+                if name in self._input_names
+            }
+            hidden_state = self.session.run(None, inputs)[0]
+            cls = hidden_state[:, 0]
+            batches.append(cls / np.linalg.norm(cls, axis=1, keepdims=True))
+        if len(batches) > 0:
+            embeddings = np.empty((len(texts), batches[0].shape[1]), dtype=np.float32)
+            embeddings[order] = np.concatenate(batches)
+        return embeddings
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        """Embed the documents."""
+        return self._encode(texts).tolist()
+
+    def embed_query(self, text: str) -> list[float]:
+        """Embed a query, with the query instruction."""
+        return self._encode([self.query_instruction + text])[0].tolist()
+
+
+def create_embedding_model(backend: str = None) -> Embeddings:
+    """Load the embedding model with the backend.
+
+    The backend is torch (sentence-transformers) or onnx (ONNX Runtime, int8).
+    By default it is read from the EMBEDDING_BACKEND environment variable.
+    """
+    if backend is None:
+        backend = os.environ.get("EMBEDDING_BACKEND", "torch")
+    if backend not in EMBEDDING_BACKENDS:
+        raise ValueError(f"Unknown embedding backend: {backend}")
+    if backend == "onnx":
+        return OnnxBgeEmbeddings()
+    return HuggingFaceBgeEmbeddings(
+        model_name=EMBEDDING_MODEL_NAME,
+        encode_kwargs={"normalize_embeddings": True},
+        query_instruction=QUERY_INSTRUCTION,
+    )
+
+
+def get_embedding_service() -> EmbeddingService:
+    """Get the embedding service of the process, loading the model once."""
+    global _service
+    with _service_lock:
+        if _service is None:
+            _service = EmbeddingService(create_embedding_model())
+    return _service
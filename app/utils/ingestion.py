@@ -0,0 +1,415 @@
+"""Streaming ingestion pipeline."""
+import queue
+import threading
+import time
+from typing import Callable, Iterable, Iterator, Optional
+
+import arxiv
+import numpy as np
+from app.utils.arxiv_cache import get_response_cache
+from app.utils.arxiv_harvester import ArxivHarvester, HarvestWatermarks
+from app.utils.bulk_encoder import BulkEncoder, get_bulk_encoder
+from app.utils.vector_database import insert_embedded_documents
+from langchain.embeddings.cache import _create_key_encoder
+from langchain.schema import Document
+
+# sentinel that marks the end of a stage output
+_END = object()
+
+# bigger downloads are encoded with the multi-process encoder, in windows of
+# new documents sorted by length together
+BULK_ENCODING_MIN_DOCS = 500
+BULK_ENCODING_WINDOW = 2_000
+
+
+def result_to_document(result: arxiv.Result) -> Document:
+    """Save an arxiv result as a Document.
+
+    Keeps the title, authors, link and published year as metadata.
+    """
+    return Document(
+        page_content=result.summary,
+        metadata={
+            "published": result.published.year,
+            "title": result.title,
+            "authors": ", ".join([author.name for author in result.authors]),
+            "link": result.entry_id,
+        },
+    )
+
+
+class StageStats:
+    """Number of items processed by a stage and the time it spent working."""
+
+    def __init__(self, name: str):
+        """Initialize the counters."""
+        self.name = name
+        self.items = 0
+        self.batches = 0
+        self.busy_seconds = 0.0
+
+    @property
+    def throughput(self) -> float:
+        """Items per second of work."""
+        return self.items / self.busy_seconds if self.busy_seconds > 0 else 0.0
+
+
+class IngestionStats:
+    """Per-stage statistics of an ingestion run."""
+
+    def __init__(self):
+        """Initialize the stats of each stage."""
+        self.stages = {
+            name: StageStats(name)
+            for name in ["harvest", "deduplicate", "embed", "insert"]
+        }
+        self.duplicates = 0
+        self.started = time.perf_counter()
+
+    def __getitem__(self, stage: str) -> StageStats:
+        """Stats of a stage."""
+        return self.stages[stage]
+
+    @property
+    def elapsed(self) -> float:
+        """Seconds since the run started."""
+        return time.perf_counter() - self.started
+
+    def to_markdown(self) -> str:
+        """Markdown table with the throughput of each stage."""
+        lines = [
+            "| stage | items | batches | items/s |",
+            "| --- | --- | --- | --- |",
+        ]
+        for stats in self.stages.values():
+            lines.append(
+                f"| {stats.name} | {stats.items} | {stats.batches} "
+                f"| {stats.throughput:.1f} |"
+            )
+        lines.append(
+            f"\n{self.duplicates} duplicates skipped, {self.elapsed:.1f} s elapsed."
+        )
+        return "\n".join(lines)
+
+
+class IngestionPipeline:
+    """
+    Streaming harvest, deduplicate, embed and insert pipeline.
+
+    Each stage runs in its own thread and processes micro-batches of documents.
+    The stages are connected by bounded queues, so memory is bounded by the batch
+    size and the queue size, not by the number of papers.
+    Each micro-batch is committed on its own: its embeddings are cached as soon
+    as they are computed, and it is inserted in Milvus with those same vectors.
+    The keys of a batch are added to the key index only once it is in Milvus, so a
+    failure does not lose the batches that were already inserted, and the missing
+    ones are ingested again by the next run.
+
+    Parameters:
+        collection (dict):
+            The collection, as returned by `open_collection`.
+
+        batch_size (int):
+            Number of documents per micro-batch.
+
+        queue_size (int):
+            Maximum number of micro-batches waiting between two stages.
+
+        on_progress (Callable):
+            Called with the IngestionStats from the calling thread, every time a
+            stage finishes a batch.
+
+        bulk_encoding (bool):
+            Encode with the multi-process bulk encoder of the process instead of
+            the shared embedding model. The new documents are then embedded in
+            windows of up to `bulk_window_size` documents, and the windows with
+            fewer than BULK_ENCODING_MIN_DOCS documents use the shared model.
+
+        bulk_window_size (int):
+            Maximum number of documents encoded together by the bulk encoder.
+
+        cancel (threading.Event):
+            Optional event to cancel the run from another thread. The batches
+            that were already inserted are kept.
+    """
+
+    def __init__(
+        self,
+        collection: dict,
+        batch_size: int = 100,
+        queue_size: int = 4,
+        on_progress: Optional[Callable[[IngestionStats], None]] = None,
+        bulk_encoding: bool = False,
+        bulk_window_size: int = BULK_ENCODING_WINDOW,
+        cancel: Optional[threading.Event] = None,
+    ):
+        """Initialize the pipeline."""
+        self.collection = collection
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.on_progress = on_progress
+        self.bulk_encoding = bulk_encoding
+        self.bulk_window_size = bulk_window_size
+        self.cancel = cancel
+        self.key_encoder = _create_key_encoder(namespace=collection["collection_name"])
+        self.stats = IngestionStats()
+        self._stop = threading.Event()
+        self._progress = queue.Queue()
+        self._errors = []
+
+    def _put(self, output: queue.Queue, item) -> bool:
+        """Put an item in a bounded queue, unless the pipeline is stopping."""
+        while not self._stop.is_set():
+            try:
+                output.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, input_: queue.Queue) -> Iterator:
+        """Get the items of a queue until the end of the stage before."""
+        while not self._stop.is_set():
+            try:
+                item = input_.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is _END:
+                return
+            yield item
+
+    def _run_stage(
+        self,
+        name: str,
+        items: Callable[[], Iterator],
+        process: Callable,
+        output: Optional[queue.Queue],
+    ):
+        """Process the items of a stage, and put the results in the output queue."""
+        stats = self.stats[name]
+        try:
+            iterator = items()
+            while not self._stop.is_set():
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                result = process(item)
+                stats.busy_seconds += time.perf_counter() - start
+                stats.batches += 1
+                self._progress.put(name)
+                if output is not None and result is not None:
+                    if not self._put(output, result):
+                        break
+        except Exception as e:
+            self._errors.append(e)
+            self._stop.set()
+        finally:
+            if output is not None:
+                self._put(output, _END)
+
+    def _harvest(self, papers: Iterable[Document]) -> Iterator[list[Document]]:
+        """Group the papers in micro-batches."""
+        batch = []
+        for paper in papers:
+            batch.append(paper)
+            if len(batch) == self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def _count_harvested(self, batch: list[Document]) -> list[Document]:
+        """Count the harvested papers."""
+        self.stats["harvest"].items += len(batch)
+        return batch
+
+    def _deduplicate(self, batch: list[Document], seen: set):
+        """Keep the papers that are not in the collection, or in a previous batch."""
+        keys = [self.key_encoder(doc.page_content) for doc in batch]
+        is_new = self.collection["key_index"].is_new(keys)
+        new = [
+            (doc, key)
+            for doc, key, new in zip(batch, keys, is_new)
+            if new and key not in seen
+        ]
+        seen.update(key for _, key in new)
+        self.stats["deduplicate"].items += len(new)
+        self.stats.duplicates += len(batch) - len(new)
+        if len(new) == 0:
+            return None
+        docs, keys = zip(*new)
+        return list(docs), list(keys)
+
+    def _embed(self, batches: Iterator, encoder: Optional[BulkEncoder]) -> Iterator:
+        """Embed the deduplicated micro-batches, and yield them with their vectors.
+
+        With the bulk encoder, the micro-batches are gathered in windows of up to
+        `bulk_window_size` documents, so the encoder sorts a whole window by
+        length and keeps all its workers busy. The window is streamed back in
+        micro-batches as soon as they are encoded.
+        """
+        window = []
+        window_docs = 0
+        for docs, keys in batches:
+            if encoder is None:
+                yield from self._embed_window([(docs, keys)], None)
+                continue
+            window.append((docs, keys))
+            window_docs += len(docs)
+            if window_docs >= self.bulk_window_size:
+                yield from self._embed_window(window, encoder)
+                window = []
+                window_docs = 0
+        if window:
+            yield from self._embed_window(window, encoder)
+
+    def _embed_window(self, window: list, encoder: Optional[BulkEncoder]) -> Iterator:
+        """Embed a window of micro-batches, with the bulk encoder if it is big."""
+        docs = [doc for batch_docs, _ in window for doc in batch_docs]
+        keys = [key for _, batch_keys in window for key in batch_keys]
+        if encoder is None or len(docs) < BULK_ENCODING_MIN_DOCS:
+            # the cached embedder also caches the embeddings
+            for batch_docs, batch_keys in window:
+                embeddings = self.collection["cached_embedder"].embed_documents(
+                    [doc.page_content for doc in batch_docs]
+                )
+                yield batch_docs, batch_keys, np.array(embeddings, dtype=np.float32)
+            return
+        texts = [doc.page_content for doc in docs]
+        for start, embeddings in encoder.iter_encode(texts, chunk_size=self.batch_size):
+            end = start + len(embeddings)
+            self.collection["cached_embedder"].document_embedding_store.mset(
+                list(zip(texts[start:end], embeddings.tolist()))
+            )
+            yield docs[start:end], keys[start:end], embeddings
+
+    def _store_embeddings(self, batch):
+        """Commit the embeddings of a micro-batch to the embedding store."""
+        docs, keys, embeddings = batch
+        self.collection["embedding_store"].append(keys, embeddings)
+        self.stats["embed"].items += len(docs)
+        return batch
+
+    def _insert(self, batch):
+        """Insert a batch in Milvus with its vectors, and mark its keys as ingested."""
+        docs, keys, embeddings = batch
+        insert_embedded_documents(self.collection["vector_db"], docs, embeddings)
+        self.collection["key_index"].add(keys)
+        self.stats["insert"].items += len(docs)
+
+    def run(self, papers: Iterable[Document]) -> IngestionStats:
+        """Ingest the papers, and return the stats of the run.
+
+        Raises the first error of any stage, after the batches that were already
+        inserted are flushed.
+        """
+        harvested = queue.Queue(self.queue_size)
+        deduplicated = queue.Queue(self.queue_size)
+        embedded = queue.Queue(self.queue_size)
+        seen = set()
+
+        # the pool of the bulk encoder is shared by the runs of the process
+        encoder = get_bulk_encoder() if self.bulk_encoding else None
+        threads = [
+            threading.Thread(
+                target=self._run_stage,
+                args=(
+                    "harvest",
+                    lambda: self._harvest(papers),
+                    self._count_harvested,
+                    harvested,
+                ),
+            ),
+            threading.Thread(
+                target=self._run_stage,
+                args=(
+                    "deduplicate",
+                    lambda: self._get(harvested),
+                    lambda batch: self._deduplicate(batch, seen),
+                    deduplicated,
+                ),
+            ),
+            threading.Thread(
+                target=self._run_stage,
+                args=(
+                    "embed",
+                    lambda: self._embed(self._get(deduplicated), encoder),
+                    self._store_embeddings,
+                    embedded,
+                ),
+            ),
+            threading.Thread(
+                target=self._run_stage,
+                args=("insert", lambda: self._get(embedded), self._insert, None),
+            ),
+        ]
+        for thread in threads:
+            thread.start()
+        while any(thread.is_alive() for thread in threads):
+            if self.cancel is not None and self.cancel.is_set():
+                self.stop()
+            try:
+                self._progress.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if self.on_progress is not None:
+                self.on_progress(self.stats)
+        for thread in threads:
+            thread.join()
+
+        vector_db = self.collection["vector_db"]
+        if vector_db.col is not None:
+            vector_db.col.flush()
+        if self.on_progress is not None:
+            self.on_progress(self.stats)
+        if self._errors:
+            raise self._errors[0]
+        return self.stats
+
+    def stop(self):
+        """Ask the stages to stop after their current batch."""
+        self._stop.set()
+
+
+def ingest_arxiv_papers(
+    collection: dict,
+    keywords: list[str],
+    max_papers: int,
+    sort_by: str = "Relevance",
+    refresh: bool = False,
+    on_progress: Optional[Callable[[IngestionStats], None]] = None,
+    cancel: Optional[threading.Event] = None,
+) -> IngestionStats:
+    """Harvest papers from arxiv and ingest them in the collection.
+
+    The harvest watermarks of the keywords are moved forward once the papers are
+    stored, only for the keywords harvested completely, and not when the run is
+    cancelled. In refresh mode, only the papers newer than the watermarks are
+    harvested, and the arxiv response cache is skipped to see the new papers.
+    """
+    watermarks = HarvestWatermarks(
+        f"./cache/{collection['collection_name']}/watermarks.json"
+    )
+    harvester = ArxivHarvester(cache=None if refresh else get_response_cache())
+    papers = (
+        result_to_document(result)
+        for result in harvester.harvest(
+            queries=keywords,
+            max_papers=max_papers,
+            sort_by=sort_by,
+            watermarks=watermarks.published_dates() if refresh else None,
+        )
+    )
+    stats = IngestionPipeline(
+        collection=collection,
+        on_progress=on_progress,
+        # only the windows with enough new documents use the bulk encoder
+        bulk_encoding=max_papers >= BULK_ENCODING_MIN_DOCS,
+        cancel=cancel,
+    ).run(papers)
+    if cancel is None or not cancel.is_set():
+        watermarks.update(keywords, harvester.latest_seen)
+        watermarks.save()
+    return stats
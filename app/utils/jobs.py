@@ -0,0 +1,356 @@
+"""Background queue of ingestion jobs."""
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import ContextManager, Optional
+
+from app.utils.embeddings import get_embedding_service
+from app.utils.ingestion import IngestionStats, ingest_arxiv_papers
+from app.utils.sqlite_utils import connect
+from app.utils.vector_database import open_collection
+
+JOB_KINDS = ["download", "refresh"]
+JOB_STATUSES = ["queued", "running", "done", "failed", "cancelled"]
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+class JobCancelled(Exception):
+    """The job was cancelled before it finished."""
+
+
+class JobQueue:
+    """
+    Persistent queue of ingestion jobs, run by a pool of worker threads.
+
+    The jobs are stored in a SQLite table, so their status outlives the Streamlit
+    sessions that submitted them. A running job stores the pid of its process and
+    a heartbeat, and it is queued again when its process died or its heartbeat
+    stopped, so the queue can be shared by several processes. A worker only claims
+    a job if no other job of the same collection is running, so each collection
+    has a single writer. The workers write the progress of their job in the
+    table, where the pages can poll it, and check for cancellation requests
+    between batches.
+
+    Parameters:
+        path (str):
+            Path of the SQLite database.
+
+        max_workers (int):
+            Number of jobs running at the same time, on different collections.
+
+        poll_interval (float):
+            Seconds an idle worker waits before looking for new jobs.
+
+        progress_interval (float):
+            Minimum seconds between two progress updates of a job.
+
+        heartbeat_interval (float):
+            Seconds between two heartbeats of the running jobs.
+
+        stale_after (float):
+            Seconds without heartbeat after which a running job is queued again.
+    """
+
+    def __init__(
+        self,
+        path: str = "./cache/jobs.db",
+        max_workers: int = 2,
+        poll_interval: float = 1.0,
+        progress_interval: float = 1.0,
+        heartbeat_interval: float = 10.0,
+        stale_after: float = 60.0,
+    ):
+        """Create the jobs table, and start the workers."""
+        self.path = path
+        self.max_workers = max_workers
+        self.poll_interval = poll_interval
+        self.progress_interval = progress_interval
+        self.heartbeat_interval = heartbeat_interval
+        self.stale_after = stale_after
+        self._claim_lock = threading.Lock()
+        self._wake_up = threading.Event()
+        self._cancel_events = {}
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self._connect() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, collection TEXT, kind TEXT, "
+                "params TEXT, status TEXT, progress TEXT, result TEXT, error TEXT, "
+                "cancel_requested INTEGER DEFAULT 0, "
+                "created REAL, started REAL, finished REAL, owner INTEGER, "
+                "heartbeat REAL)"
+            )
+            columns = [
+                row["name"] for row in connection.execute("PRAGMA table_info(jobs)")
+            ]
+            for column, column_type in [("owner", "INTEGER"), ("heartbeat", "REAL")]:
+                if column not in columns:
+                    connection.execute(
+                        f"ALTER TABLE jobs ADD COLUMN {column} {column_type}"
+                    )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id)"
+            )
+            self._requeue_orphans(connection)
+        self._workers = [
+            threading.Thread(target=self._run_worker, daemon=True)
+            for _ in range(max_workers)
+        ]
+        self._workers.append(threading.Thread(target=self._run_heartbeat, daemon=True))
+        for worker in self._workers:
+            worker.start()
+
+    def _connect(self) -> ContextManager[sqlite3.Connection]:
+        """Open a connection to the database, with the rows as sqlite3.Row."""
+        return connect(self.path, row_factory=sqlite3.Row)
+
+    @staticmethod
+    def _to_dict(row: sqlite3.Row) -> dict:
+        """Convert a row of the jobs table to a dict, with its json fields parsed."""
+        job = dict(row)
+        job["params"] = json.loads(job["params"])
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+
+    def submit(self, collection: str, kind: str, **params) -> int:
+        """Queue a job on a collection, and return its id.
+
+        The params are passed to the ingestion of the job kind: keywords,
+        max_papers and sort_by for a download, and the keywords for a refresh.
+        """
+        if kind not in JOB_KINDS:
+            raise ValueError(f"Unknown job kind: {kind}")
+        with self._connect() as connection:
+            job_id = connection.execute(
+                "INSERT INTO jobs (collection, kind, params, status, created) "
+                "VALUES (?, ?, ?, 'queued', ?)",
+                (collection, kind, json.dumps(params), time.time()),
+            ).lastrowid
+        self._wake_up.set()
+        return job_id
+
+    def get(self, job_id: int) -> Optional[dict]:
+        """Get a job, or None if it does not exist."""
+        with self._connect() as connection:
+            row = connection.execute(
+                "SELECT * FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        return None if row is None else self._to_dict(row)
+
+    def list_jobs(
+        self,
+        collection: Optional[str] = None,
+        statuses: Optional[list[str]] = None,
+        limit: int = 20,
+    ) -> list[dict]:
+        """List the most recent jobs, optionally of a collection and statuses."""
+        conditions = []
+        args = []
+        if collection is not None:
+            conditions.append("collection = ?")
+            args.append(collection)
+        if statuses:
+            conditions.append(f"status IN ({', '.join('?' * len(statuses))})")
+            args.extend(statuses)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        with self._connect() as connection:
+            rows = connection.execute(
+                f"SELECT * FROM jobs {where} ORDER BY id DESC LIMIT ?",
+                (*args, limit),
+            ).fetchall()
+        return [self._to_dict(row) for row in rows]
+
+    def cancel(self, job_id: int):
+        """Cancel a job.
+
+        A queued job is cancelled right away, and a running job stops after its
+        current batch, keeping the papers that were already inserted.
+        """
+        with self._connect() as connection:
+            connection.execute(
+                "UPDATE jobs SET status = 'cancelled', finished = ? "
+                "WHERE id = ? AND status = 'queued'",
+                (time.time(), job_id),
+            )
+            connection.execute(
+                "UPDATE jobs SET cancel_requested = 1 "
+                "WHERE id = ? AND status = 'running'",
+                (job_id,),
+            )
+        event = self._cancel_events.get(job_id)
+        if event is not None:
+            event.set()
+
+    def _requeue_orphans(self, connection: sqlite3.Connection):
+        """Queue again the running jobs whose process died or stopped beating."""
+        now = time.time()
+        orphans = [
+            row["id"]
+            for row in connection.execute(
+                "SELECT id, owner, heartbeat FROM jobs WHERE status = 'running'"
+            )
+            if row["heartbeat"] is None
+            or now - row["heartbeat"] > self.stale_after
+            or not _is_alive(row["owner"])
+        ]
+        for job_id in orphans:
+            connection.execute(
+                "UPDATE jobs SET status = 'queued', started = NULL, owner = NULL, "
+                "heartbeat = NULL WHERE id = ? AND status = 'running'",
+                (job_id,),
+            )
+
+    def _claim(self) -> Optional[dict]:
+        """Mark the oldest queued job of a collection without running jobs."""
+        with self._claim_lock, self._connect() as connection:
+            # lock the database, so workers of other processes see the claim
+            connection.execute("BEGIN IMMEDIATE")
+            # the jobs of dead processes would block their collection forever
+            self._requeue_orphans(connection)
+            row = connection.execute(
+                "SELECT * FROM jobs WHERE status = 'queued' AND collection NOT IN "
+                "(SELECT collection FROM jobs WHERE status = 'running') "
+                "ORDER BY id LIMIT 1"
+            ).fetchone()
+            if row is None:
+                return None
+            now = time.time()
+            connection.execute(
+                "UPDATE jobs SET status = 'running', started = ?, owner = ?, "
+                "heartbeat = ? WHERE id = ?",
+                (now, os.getpid(), now, row["id"]),
+            )
+            self._cancel_events[row["id"]] = threading.Event()
+        return self._to_dict(row)
+
+    def _finish(self, job_id: int, status: str, result=None, error: str = None):
+        """Store the final status of a job."""
+        with self._connect() as connection:
+            connection.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, finished = ? "
+                "WHERE id = ?",
+                (status, json.dumps(result), error, time.time(), job_id),
+            )
+        self._cancel_events.pop(job_id, None)
+        # the collection of the job may have other queued jobs
+        self._wake_up.set()
+
+    def _run_worker(self):
+        """Run the jobs that can be claimed, and wait for new ones when idle."""
+        while True:
+            job = self._claim()
+            if job is None:
+                self._wake_up.wait(self.poll_interval)
+                self._wake_up.clear()
+                continue
+            try:
+                stats = self._run_job(job)
+            except JobCancelled as e:
+                self._finish(job["id"], "cancelled", result=e.args[0])
+            except Exception as e:
+                self._finish(job["id"], "failed", error=f"{type(e).__name__}: {e}")
+            else:
+                self._finish(job["id"], "done", result=stats)
+
+    def _run_heartbeat(self):
+        """Refresh the heartbeat of the jobs run by this queue."""
+        while True:
+            time.sleep(self.heartbeat_interval)
+            job_ids = list(self._cancel_events)
+            if not job_ids:
+                continue
+            with self._connect() as connection:
+                connection.execute(
+                    "UPDATE jobs SET heartbeat = ? WHERE status = 'running' AND "
+                    f"id IN ({', '.join('?' * len(job_ids))})",
+                    (time.time(), *job_ids),
+                )
+
+    def _run_job(self, job: dict) -> dict:
+        """Ingest the papers of a job, and return the stats of the run."""
+        cancel = self._cancel_events[job["id"]]
+        last_update = 0.0
+
+        def on_progress(stats: IngestionStats):
+            """Write the progress of the job, at most once per interval."""
+            nonlocal last_update
+            now = time.monotonic()
+            if now - last_update >= self.progress_interval:
+                last_update = now
+                self._write_progress(job["id"], stats, cancel)
+
+        params = job["params"]
+        collection = open_collection(
+            job["collection"],
+            get_embedding_service(),
+            params.get("embedding_dtype", "float32"),
+        )
+        stats = ingest_arxiv_papers(
+            collection=collection,
+            keywords=params["keywords"],
+            max_papers=params.get("max_papers", 1000),
+            sort_by=params.get("sort_by", "Relevance"),
+            refresh=job["kind"] == "refresh",
+            on_progress=on_progress,
+            cancel=cancel,
+        )
+        self._write_progress(job["id"], stats, cancel)
+        result = {
+            "harvested": stats["harvest"].items,
+            "new_documents": stats["insert"].items,
+            "duplicates": stats.duplicates,
+            "elapsed": stats.elapsed,
+            "stages": {
+                stage.name: {"items": stage.items, "seconds": stage.busy_seconds}
+                for stage in stats.stages.values()
+            },
+        }
+        if cancel.is_set():
+            raise JobCancelled(result)
+        return result
+
+    def _write_progress(
+        self, job_id: int, stats: IngestionStats, cancel: threading.Event
+    ):
+        """Write the progress of a job, and read its cancellation requests."""
+        with self._connect() as connection:
+            connection.execute(
+                "UPDATE jobs SET progress = ?, heartbeat = ? WHERE id = ?",
+                (stats.to_markdown(), time.time(), job_id),
+            )
+            row = connection.execute(
+                "SELECT cancel_requested FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        # cancellations can come from another process sharing the database
+        if row["cancel_requested"]:
+            cancel.set()
+
+
+def _is_alive(pid: Optional[int]) -> bool:
+    """Check if a process is running."""
+    if pid is None:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # the process exists, but belongs to another user
+        return True
+    return True
+
+
+def get_job_queue() -> JobQueue:
+    """Get the job queue of the process, starting its workers once.
+
+    The number of workers is read from the INGESTION_WORKERS environment variable.
+    """
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = JobQueue(max_workers=int(os.environ.get("INGESTION_WORKERS", 2)))
+    return _queue
@@ -1,11 +1,17 @@
 """Utility functions for the app."""
+import json
 import os
+import random
+import re
+import time
 
 from app.utils.prompts import first_keywords_prompt, refine_keywords_prompt
 from app.utils.utils import get_arxiv_abstracts
+from dotenv import find_dotenv, load_dotenv
 from langchain.chat_models import ChatOpenAI
+from langchain.chat_models.base import BaseChatModel, SimpleChatModel
 from langchain.llms import OpenAI
-from langchain.output_parsers import ResponseSchema, StructuredOutputParser
+from langchain.llms.base import LLM, BaseLLM
 from langchain.output_parsers.pydantic import PydanticOutputParser
 from langchain.prompts import (
     ChatPromptTemplate,
@@ -13,19 +19,112 @@ from langchain.prompts import (
     SystemMessagePromptTemplate,
 )
 from langchain.prompts.chat import BaseMessage
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, ValidationError
 
-instruct = OpenAI(
-    model="gpt-3.5-turbo-instruct",
-    temperature=0.01,
-    openai_api_key=os.environ["OPENAI_API_KEY"],
-)
+LLM_BACKENDS = ["openai", "stand-in"]
 
-chat = ChatOpenAI(
-    model="gpt-3.5-turbo",
-    temperature=0.01,
-    openai_api_key=os.environ["OPENAI_API_KEY"],
-)
+
+class StandInLLM(LLM):
+    """Local stand-in of the instruct model, for tests and offline development.
+
+    Answers the keyword prompts without calling any API, and counts its calls.
+    """
+
+    model_name: str = "stand-in"
+    calls: int = 0
+
+    @property
+    def _llm_type(self) -> str:
+        """Type of the model."""
+        return "stand-in"
+
+    def _call(self, prompt: str, stop=None, run_manager=None, **kwargs) -> str:
+        """Answer with a fixed list of keywords, closed like the prompts expect."""
+        self.calls += 1
+        return "Stand-in keyword, Another stand-in keyword]"
+
+
+class StandInChatModel(SimpleChatModel):
+    """Local stand-in of the chat model, for tests and offline development.
+
+    Answers without calling any API, and counts its calls. Topic label prompts
+    get the first keywords of each topic, and scoring prompts get a neutral score
+    for each paper, in the format of the scoring instructions.
+    Each answer takes `latency` seconds on average, with some jitter, to test the
+    concurrent scoring like with a remote endpoint.
+    """
+
+    model_name: str = "stand-in"
+    calls: int = 0
+    latency: float = float(os.environ.get("LLM_STAND_IN_LATENCY", 0))
+
+    @property
+    def _llm_type(self) -> str:
+        """Type of the model."""
+        return "stand-in-chat"
+
+    def _call(self, messages, stop=None, run_manager=None, **kwargs) -> str:
+        """Answer the last message."""
+        self.calls += 1
+        if self.latency > 0:
+            time.sleep(self.latency * random.uniform(0.5, 1.5))
+        prompt = messages[-1].content
+        topics = re.findall(r"^Topic (-?\d+):", prompt, flags=re.MULTILINE)
+        if topics:
+            keywords = re.findall(r"^Keywords: (.*)$", prompt, flags=re.MULTILINE)
+            labels = [
+                {"topic": int(topic), "label": " ".join(words.split()[:3])}
+                for topic, words in zip(topics, keywords)
+            ]
+            return "```json\n" + json.dumps(labels) + "\n```"
+        ids = re.findall(r"'id': '([^']*)'", prompt)
+        return (
+            "```json\n"
+            + json.dumps(
+                [
+                    {
+                        "id": id_,
+                        "title": f"Paper {id_}",
+                        "topics": ["stand-in"],
+                        "score": 3,
+                        "reasoning": "Stand-in answer.",
+                    }
+                    for id_ in ids
+                ],
+                indent=4,
+            )
+            + "\n```"
+        )
+
+
+def create_llms(backend: str = None) -> tuple[BaseLLM, BaseChatModel]:
+    """Create the instruct and chat models.
+
+    The backend is openai, or stand-in for local models that do not call any API.
+    By default it is read from the LLM_BACKEND environment variable.
+    """
+    if backend is None:
+        backend = os.environ.get("LLM_BACKEND", "openai")
+    if backend not in LLM_BACKENDS:
+        raise ValueError(f"Unknown llm backend: {backend}")
+    if backend == "stand-in":
+        return StandInLLM(), StandInChatModel()
+    instruct = OpenAI(
+        model="gpt-3.5-turbo-instruct",
+        temperature=0.01,
+        openai_api_key=os.environ["OPENAI_API_KEY"],
+    )
+    chat = ChatOpenAI(
+        model="gpt-3.5-turbo",
+        temperature=0.01,
+        openai_api_key=os.environ["OPENAI_API_KEY"],
+    )
+    return instruct, chat
+
+
+# the api key and the backend are configured in the .env file
+load_dotenv(find_dotenv())
+instruct, chat = create_llms()
 
 
 class KeywordsAgent:
@@ -86,67 +185,135 @@ class KeywordsAgent:
         return first_keywords.split(", "), refined_keywords.split(", ")
 
 
+class PaperLabels(BaseModel):
+    """Labels of a paper, given by the chat llm."""
+
+    id: str = Field(default="", description="id of the paper")
+    title: str = Field(description="paper title")
+    topics: list[str] = Field(description="Topics that best describe the paper.")
+    score: int = Field(
+        description="Rate from 1 to 5 how relevant is the paper "
+        "for the user research. 5 is a must read, "
+        "1 is irrelevant"
+    )
+    reasoning: str = Field(description="short explanation for the score")
+
+
+class JSONObjectStream:
+    """Incremental parser of the objects of a JSON array.
+
+    Fed with chunks of text, it returns each top-level object as soon as it is
+    complete. Malformed objects are skipped, so one bad entry does not lose the
+    others, and the text around the array, like markdown fences, is ignored.
+    """
+
+    def __init__(self):
+        """Start with an empty buffer."""
+        self._buffer = ""
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+
+    def feed(self, chunk: str) -> list[dict]:
+        """Add a chunk of text, and return the objects it completed."""
+        self._buffer += chunk
+        objects = []
+        while self._pos < len(self._buffer):
+            char = self._buffer[self._pos]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"' and self._depth > 0:
+                self._in_string = True
+            elif char == "{":
+                if self._depth == 0:
+                    # only the text of the current object is kept
+                    self._buffer = self._buffer[self._pos :]
+                    self._pos = 0
+                self._depth += 1
+            elif char == "}" and self._depth > 0:
+                self._depth -= 1
+                if self._depth == 0:
+                    try:
+                        obj = json.loads(self._buffer[: self._pos + 1])
+                    except ValueError:
+                        obj = None
+                    if isinstance(obj, dict):
+                        objects.append(obj)
+            self._pos += 1
+        if self._depth == 0:
+            self._buffer = ""
+            self._pos = 0
+        return objects
+
+
 class ScorePapersAgent:
     """Label tha papers using chat llm.
 
     The agent uses gpt-3.5-turbo to score the relevance of the papers.
-    The output should is a list of pydantic objects with the following schema:
-    title, topics, score and reasoning for the score.
+    Each paper is sent with an id, and the llm answers with a single JSON array
+    with the id, title, topics, score and reasoning of each paper. The array is
+    parsed object by object, and every valid entry is kept, so only the papers
+    that are missing or invalid need to be asked again.
+
+    Parameters:
+        question (str):
+            The question that the user wants to research.
+
+        papers (list[dict]):
+            The papers to score. Their "id" is used to match the answers,
+            by default it is their position, starting at 1.
+
+        attempt (int):
+            Number of times the papers were asked before. Retries remind the llm
+            to answer for all the papers, which also avoids the cached answer.
     """
 
-    def __init__(self, question: str, papers: list[dict]):
+    def __init__(self, question: str, papers: list[dict], attempt: int = 0):
         """Initialize the LabelChat."""
         self.question = question
-        self.papers = papers
-        self.output_parser = None
+        self.attempt = attempt
+        self.papers = [
+            {
+                "id": str(paper.get("id", i + 1)),
+                **{key: value for key, value in paper.items() if key != "id"},
+            }
+            for i, paper in enumerate(papers)
+        ]
 
     @staticmethod
     def get_parser():
-        """Get the parser for the LLM output."""
-
-        class Papers(BaseModel):
-            title: str = Field(description="paper title")
-            topics: list = Field(description="Topics that best describe the paper.")
-            score: int = Field(
-                description="Rate from 1 to 5 how relevant is the paper "
-                "for the user research. 5 is a must read, "
-                "1 is irrelevant"
-            )
-            reasoning: str = Field(description="short explanation for the score")
-
-        return PydanticOutputParser(pydantic_object=Papers)
+        """Get the parser for the labels of a paper."""
+        return PydanticOutputParser(pydantic_object=PaperLabels)
 
     @staticmethod
     def _get_format_instructions():
         """Response schema for the LLM"""
-        response_schemas = [
-            ResponseSchema(name="title", description="Paper title"),
-            ResponseSchema(
-                name="topics",
-                description="Topics that best describe the paper.",
-                type="list",
-            ),
-            ResponseSchema(
-                name="score",
-                description="Rate from 1 to 5 how relevant is the paper "
-                "for the user research. 5 is a must read, 1 is irrelevant",
-                type="int",
-            ),
-            ResponseSchema(
-                name="reasoning", description="short explanation for the score"
-            ),
-        ]
-        json_parser = StructuredOutputParser.from_response_schemas(response_schemas)
-        format_instructions = json_parser.get_format_instructions()
-
-        format_instructions += (
-            "\n\nIf the user provides multiple papers, "
-            "use a separate the markdown snippets using a divider '---' "
+        return (
+            "The output should be a markdown code snippet with a single JSON "
+            "array, with one object for each paper provided by the user, "
+            "in the following format:\n\n"
+            "```json\n"
+            "[\n"
+            "    {\n"
+            '        "id": string  // id of the paper, as provided by the user\n'
+            '        "title": string  // Paper title\n'
+            '        "topics": list  // Topics that best describe the paper.\n'
+            '        "score": int  // Rate from 1 to 5 how relevant is the paper '
+            "for the user research. 5 is a must read, 1 is irrelevant\n"
+            '        "reasoning": string  // short explanation for the score\n'
+            "    }\n"
+            "]\n"
+            "```"
         )
-        return format_instructions
 
-    def get_chat_labels(self):
-        """Ask chatgpt to label the papers"""
+    def get_messages(self) -> list[BaseMessage]:
+        """Messages that ask the chat llm to label the papers."""
         format_instruction = self._get_format_instructions()
         prompt = ChatPromptTemplate(
             messages=[
@@ -168,16 +335,36 @@ class ScorePapersAgent:
             input_variables=["question", "papers"],
             partial_variables={"format_instruction": format_instruction},
         )
-        _input = prompt.format_prompt(
+        messages = prompt.format_prompt(
             question=self.question,
             papers=self.papers,
-        )
+        ).to_messages()
+        if self.attempt > 0:
+            messages[-1].content += (
+                "\n\nThese papers were missing or invalid in your previous answer. "
+                "Answer with a valid JSON object for each of them."
+            )
+        return messages
+
+    def get_chat_labels(self) -> dict[str, PaperLabels]:
+        """Ask chatgpt to label the papers, and return the labels by paper id."""
+        output = chat(self.get_messages())
+        return self.parse_output(output)
 
-        output = chat(_input.to_messages())
+    async def aget_chat_labels(self) -> dict[str, PaperLabels]:
+        """Ask chatgpt to label the papers, without blocking the event loop."""
+        output = await chat.apredict_messages(self.get_messages())
         return self.parse_output(output)
 
-    def parse_output(self, output: BaseMessage) -> list[dict]:
-        """Use output parser to parse the output"""
-        pydantic_parser = self.get_parser()
-        split = output.content.split("---")
-        return [pydantic_parser.parse(s) for s in split]
+    def parse_output(self, output: BaseMessage) -> dict[str, PaperLabels]:
+        """Parse the valid labels of the papers that were asked, by paper id."""
+        ids = {paper["id"] for paper in self.papers}
+        labels = {}
+        for obj in JSONObjectStream().feed(output.content):
+            try:
+                label = PaperLabels(**obj)
+            except ValidationError:
+                continue
+            if label.id in ids and label.id not in labels and 1 <= label.score <= 5:
+                labels[label.id] = label
+        return labels
@@ -0,0 +1,132 @@
+"""Persistent cache of LLM responses."""
+import hashlib
+import json
+import os
+import threading
+import time
+import zlib
+from typing import Any, Optional
+
+from app.utils.sqlite_utils import connect, evict_least_recently_used
+from langchain.load.dump import dumps
+from langchain.load.load import loads
+from langchain.schema import BaseCache, Generation
+from langchain.schema.cache import RETURN_VAL_TYPE
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def normalize_prompt(prompt: str) -> str:
+    """Collapse the whitespace of a prompt, so formatting changes are cache hits."""
+    return " ".join(prompt.split())
+
+
+class LLMResponseCache(BaseCache):
+    """
+    Size-bounded SQLite cache of LLM responses, for `langchain.llm_cache`.
+
+    The responses are keyed by the llm string, which has the model name, the
+    temperature and the other generation parameters, and by the normalized
+    prompt. They are stored compressed, and the least recently used responses
+    are evicted when the cache is bigger than `max_bytes`. The hits and misses
+    are counted, to check how many calls the cache saves.
+
+    Parameters:
+        path (str):
+            Path of the SQLite database.
+
+        max_bytes (int):
+            Maximum size of the stored responses.
+    """
+
+    def __init__(
+        self, path: str = "./cache/llm_responses.db", max_bytes: int = 100 * 1024**2
+    ):
+        """Create the database if it does not exist."""
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with connect(self.path) as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, body BLOB, size INTEGER, "
+                "created REAL, accessed REAL)"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS responses_accessed "
+                "ON responses (accessed)"
+            )
+
+    @staticmethod
+    def make_key(prompt: str, llm_string: str) -> str:
+        """Key of the response of a model to a prompt."""
+        return hashlib.sha256(
+            f"{llm_string}\n{normalize_prompt(prompt)}".encode("utf-8")
+        ).hexdigest()
+
+    def lookup(self, prompt: str, llm_string: str) -> Optional[RETURN_VAL_TYPE]:
+        """Get the generations of a prompt, or None if they are not cached."""
+        key = self.make_key(prompt, llm_string)
+        with self._lock, connect(self.path) as connection:
+            row = connection.execute(
+                "SELECT body FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            connection.execute(
+                "UPDATE responses SET accessed = ? WHERE key = ?", (time.time(), key)
+            )
+            self.hits += 1
+        generations = json.loads(zlib.decompress(row[0]))
+        try:
+            return [loads(generation) for generation in generations]
+        except Exception:
+            return [Generation(text=generation) for generation in generations]
+
+    def update(self, prompt: str, llm_string: str, return_val: RETURN_VAL_TYPE):
+        """Store the generations of a prompt, evicting old ones if needed."""
+        key = self.make_key(prompt, llm_string)
+        compressed = zlib.compress(
+            json.dumps([dumps(generation) for generation in return_val]).encode()
+        )
+        now = time.time()
+        with self._lock, connect(self.path) as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                (key, compressed, len(compressed), now, now),
+            )
+            evict_least_recently_used(connection, "responses", self.max_bytes)
+
+    def clear(self, **kwargs: Any):
+        """Remove all the responses, and reset the counters."""
+        with self._lock, connect(self.path) as connection:
+            connection.execute("DELETE FROM responses")
+            self.hits = 0
+            self.misses = 0
+
+    @property
+    def hit_rate(self) -> float:
+        """Fraction of the lookups that were found in the cache."""
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0.0
+
+
+def get_llm_cache() -> LLMResponseCache:
+    """Get the LLM response cache of the process.
+
+    Its size is configured with the LLM_CACHE_MAX_MB environment variable.
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = LLMResponseCache(
+                max_bytes=int(
+                    float(os.environ.get("LLM_CACHE_MAX_MB", 100)) * 1024**2
+                )
+            )
+    return _cache
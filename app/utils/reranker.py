@@ -0,0 +1,122 @@
+"""Local cross-encoder reranker of the search results."""
+import os
+import threading
+from typing import Optional
+
+import numpy as np
+from app.utils.score_cache import normalize_question, paper_id
+from app.utils.vector_database import search_papers
+from langchain.vectorstores import Milvus
+
+RERANKER_MODEL_NAME = os.environ.get(
+    "RERANKER_MODEL", "cross-encoder/ms-marco-MiniLM-L-6-v2"
+)
+# number of nearest neighbors reranked to pick the recommendations
+RERANK_CANDIDATES = 100
+
+_reranker = None
+_reranker_lock = threading.Lock()
+
+
+class CrossEncoderReranker:
+    """
+    Reorder papers by their relevance to a question with a cross-encoder.
+
+    A cross-encoder reads the question and the paper together, so it ranks the
+    papers better than the distance between their embeddings, but it is too slow
+    to search a whole collection. It reranks a pool of nearest neighbors instead,
+    and only the best papers are sent to the LLM. The model is small enough to
+    run on CPU, and the scores of the papers are kept in memory for each
+    question, so a rerun only scores new papers.
+
+    Parameters:
+        model_name (str):
+            Name of the sentence-transformers cross-encoder, like
+            BAAI/bge-reranker-base.
+
+        batch_size (int):
+            Number of question and paper pairs per inference call.
+
+        max_cached (int):
+            Maximum number of scores kept in memory.
+    """
+
+    def __init__(
+        self,
+        model_name: str = RERANKER_MODEL_NAME,
+        batch_size: int = 32,
+        max_cached: int = 100_000,
+    ):
+        """Load the cross-encoder."""
+        from sentence_transformers import CrossEncoder
+
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.max_cached = max_cached
+        self.model = CrossEncoder(model_name, max_length=512)
+        self._scores = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _paper_text(paper: dict) -> str:
+        """Text of a paper read by the cross-encoder."""
+        return f"{paper['title']}. {paper['abstract']}"
+
+    def score(self, question: str, papers: list[dict]) -> np.ndarray:
+        """Relevance of each paper to the question, between 0 and 1."""
+        question_key = normalize_question(question)
+        keys = [(question_key, paper_id(paper)) for paper in papers]
+        with self._lock:
+            missing = [i for i, key in enumerate(keys) if key not in self._scores]
+            if missing:
+                scores = self.model.predict(
+                    [(question, self._paper_text(papers[i])) for i in missing],
+                    batch_size=self.batch_size,
+                    show_progress_bar=False,
+                )
+                if len(self._scores) + len(missing) > self.max_cached:
+                    self._scores.clear()
+                for i, score in zip(missing, np.atleast_1d(scores)):
+                    self._scores[keys[i]] = float(score)
+            return np.array([self._scores[key] for key in keys], dtype=np.float32)
+
+    def rerank(
+        self, question: str, papers: list[dict], top_k: Optional[int] = None
+    ) -> list[tuple[dict, float]]:
+        """Sort the papers by relevance, and return the top ones with their scores."""
+        if len(papers) == 0:
+            return []
+        scores = self.score(question, papers)
+        order = np.argsort(-scores, kind="stable")[:top_k]
+        return [(papers[i], float(scores[i])) for i in order]
+
+
+def get_reranker() -> CrossEncoderReranker:
+    """Get the reranker of the process, loading the model once.
+
+    The model is read from the RERANKER_MODEL environment variable.
+    """
+    global _reranker
+    with _reranker_lock:
+        if _reranker is None:
+            _reranker = CrossEncoderReranker()
+    return _reranker
+
+
+def recommend_papers(
+    vector_db: Milvus,
+    question: str,
+    k: int,
+    rerank: bool = True,
+    n_candidates: int = RERANK_CANDIDATES,
+) -> list[tuple[dict, Optional[float]]]:
+    """Get the k papers of a collection that are most relevant to a question.
+
+    With reranking, the nearest neighbors of the question are reranked with the
+    cross-encoder, and the papers come with their reranker score. Without it,
+    they are the nearest neighbors, without a score.
+    """
+    if not rerank:
+        return [(paper, None) for paper in search_papers(vector_db, question, k=k)]
+    candidates = search_papers(vector_db, question, k=max(k, n_candidates))
+    return get_reranker().rerank(question, candidates, top_k=k)
@@ -0,0 +1,82 @@
+"""Cache of the relevance scores of the papers."""
+import json
+import os
+import re
+import threading
+import time
+from app.utils.arxiv_harvester import entry_id_without_version
+from app.utils.sqlite_utils import connect
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def normalize_question(question: str) -> str:
+    """Lowercase a question, and remove the whitespace and punctuation noise."""
+    return " ".join(re.sub(r"[^\w\s]", " ", question.lower()).split())
+
+
+def paper_id(paper: dict) -> str:
+    """The arXiv id of a paper, without its version."""
+    return entry_id_without_version(paper["link"]).split("/abs/")[-1]
+
+
+class PaperScoreCache:
+    """
+    Shared store of the relevance scores of the papers, for each question.
+
+    The topics, score and reasoning given by the LLM to a paper are stored in a
+    SQLite table keyed by the normalized question and the arXiv id of the paper.
+    The scores are shared by all the sessions, so a paper is scored only once for
+    a question, no matter the batch it was shown in.
+
+    Parameters:
+        path (str):
+            Path of the SQLite database.
+    """
+
+    def __init__(self, path: str = "./cache/paper_scores.db"):
+        """Create the database if it does not exist."""
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with connect(self.path) as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS scores ("
+                "question TEXT, paper_id TEXT, labels TEXT, created REAL, "
+                "PRIMARY KEY (question, paper_id))"
+            )
+
+    def get_many(self, question: str, paper_ids: list[str]) -> dict[str, dict]:
+        """Get the labels of the papers that were scored for the question."""
+        if len(paper_ids) == 0:
+            return {}
+        with self._lock, connect(self.path) as connection:
+            rows = connection.execute(
+                "SELECT paper_id, labels FROM scores WHERE question = ? AND "
+                f"paper_id IN ({', '.join('?' * len(paper_ids))})",
+                (normalize_question(question), *paper_ids),
+            ).fetchall()
+        return {paper_id: json.loads(labels) for paper_id, labels in rows}
+
+    def put_many(self, question: str, labels: dict[str, dict]):
+        """Store the labels of the papers for the question."""
+        question = normalize_question(question)
+        now = time.time()
+        with self._lock, connect(self.path) as connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?)",
+                [
+                    (question, paper_id, json.dumps(paper_labels), now)
+                    for paper_id, paper_labels in labels.items()
+                ],
+            )
+
+
+def get_score_cache() -> PaperScoreCache:
+    """Get the score cache of the process."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = PaperScoreCache()
+    return _cache
@@ -0,0 +1,182 @@
+"""Concurrent scoring of the relevance of the papers."""
+import asyncio
+import os
+import threading
+from concurrent.futures import Future
+
+from app.utils.llm import ScorePapersAgent
+from app.utils.score_cache import (
+    PaperScoreCache,
+    get_score_cache,
+    normalize_question,
+    paper_id,
+)
+
+_scorer = None
+_scorer_lock = threading.Lock()
+
+
+class PaperScorer:
+    """
+    Asyncio scorer of the relevance of the papers, with look-ahead prefetch.
+
+    The papers that are not in the score cache are split in batches, and the
+    batches are sent to the chat llm concurrently, up to `max_concurrency` calls
+    at a time. Failed calls are retried with exponential backoff, and only the
+    papers missing from an answer are asked again. The scorer runs its own event
+    loop in a background thread, so the pages can prefetch the scores of the next
+    papers while the user reads the current ones. A paper that is being scored is
+    not sent again, the callers wait for the same batch.
+
+    Parameters:
+        max_concurrency (int):
+            Maximum number of llm calls at the same time.
+
+        batch_size (int):
+            Number of papers scored in a single llm call.
+
+        num_retries (int):
+            Number of retries of a failed call.
+
+        backoff (float):
+            Seconds before the first retry, doubled on each retry.
+
+        cache (PaperScoreCache):
+            Cache of the scores. Defaults to the score cache of the process.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = 4,
+        batch_size: int = 4,
+        num_retries: int = 3,
+        backoff: float = 1.0,
+        cache: PaperScoreCache = None,
+    ):
+        """Start the event loop of the scorer."""
+        self.max_concurrency = max_concurrency
+        self.batch_size = batch_size
+        self.num_retries = num_retries
+        self.backoff = backoff
+        self.cache = cache or get_score_cache()
+        self._semaphore = None
+        self._in_flight = {}
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+
+    async def _score_batch(
+        self, question: str, batch: list[tuple[str, dict]]
+    ) -> dict[str, dict]:
+        """Score a batch of papers, and cache the scores as they come.
+
+        The papers that are missing from an answer, or whose labels are invalid,
+        are asked again together in a smaller batch, and failed calls are retried,
+        with exponential backoff. The backoff doesn't hold a slot of
+        `max_concurrency`, so other batches can be scored meanwhile. Raises an
+        error if some papers are still not scored after the retries.
+        """
+        if self._semaphore is None:
+            # created in the loop of the scorer
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        scores = {}
+        remaining = batch
+        for attempt in range(self.num_retries + 1):
+            try:
+                async with self._semaphore:
+                    labels = await ScorePapersAgent(
+                        question=question,
+                        papers=[{"id": id_, **paper} for id_, paper in remaining],
+                        attempt=attempt,
+                    ).aget_chat_labels()
+            except Exception:
+                if attempt == self.num_retries:
+                    raise
+                labels = {}
+            new = {id_: label.dict() for id_, label in labels.items()}
+            if new:
+                self.cache.put_many(question, new)
+                scores.update(new)
+            remaining = [(id_, paper) for id_, paper in remaining if id_ not in new]
+            if len(remaining) == 0:
+                return scores
+            if attempt < self.num_retries:
+                await asyncio.sleep(self.backoff * 2**attempt)
+        raise ValueError(f"The LLM did not score {len(remaining)} papers.")
+
+    async def ascore(self, question: str, papers: list[dict]) -> list:
+        """Score the papers, and return their labels in the order of the papers."""
+        ids = [paper_id(paper) for paper in papers]
+        scores = self.cache.get_many(question, ids)
+        key = normalize_question(question)
+        tasks = {}
+        missing = {}
+        for id_, paper in zip(ids, papers):
+            if id_ in scores or id_ in tasks or id_ in missing:
+                continue
+            if (key, id_) in self._in_flight:
+                tasks[id_] = self._in_flight[(key, id_)]
+            else:
+                missing[id_] = paper
+        missing = list(missing.items())
+
+        for start in range(0, len(missing), self.batch_size):
+            batch = missing[start : start + self.batch_size]
+            task = asyncio.ensure_future(self._score_batch(question, batch))
+            batch_keys = [(key, id_) for id_, _ in batch]
+            for batch_key in batch_keys:
+                self._in_flight[batch_key] = task
+                tasks[batch_key[1]] = task
+            task.add_done_callback(
+                lambda _, batch_keys=batch_keys: [
+                    self._in_flight.pop(batch_key, None) for batch_key in batch_keys
+                ]
+            )
+
+        for scored in await asyncio.gather(*set(tasks.values())):
+            scores.update(scored)
+        parser = ScorePapersAgent.get_parser()
+        return [parser.pydantic_object(**scores[id_]) for id_ in ids]
+
+    def score(self, question: str, papers: list[dict]) -> list:
+        """Score the papers, waiting for all their labels."""
+        return asyncio.run_coroutine_threadsafe(
+            self.ascore(question, papers), self._loop
+        ).result()
+
+    def prefetch(self, question: str, papers: list[dict]) -> Future:
+        """Start scoring the papers in the background, and return right away.
+
+        The scores go to the score cache, where the next `score` finds them.
+        """
+        future = asyncio.run_coroutine_threadsafe(
+            self.ascore(question, papers), self._loop
+        )
+        # the errors are raised again when the papers are scored for display
+        future.add_done_callback(lambda future: future.exception())
+        return future
+
+
+def get_paper_scorer() -> PaperScorer:
+    """Get the paper scorer of the process.
+
+    The number of concurrent llm calls is read from the SCORING_CONCURRENCY
+    environment variable.
+    """
+    global _scorer
+    with _scorer_lock:
+        if _scorer is None:
+            _scorer = PaperScorer(
+                max_concurrency=int(os.environ.get("SCORING_CONCURRENCY", 4))
+            )
+    return _scorer
+
+
+def score_papers(question: str, papers: list[dict]) -> list:
+    """Score the relevance of the papers for the question, concurrently.
+
+    The papers already scored for the question are read from the score cache, and
+    only the others are sent to the LLM. The labels are returned in the order of
+    the papers.
+    """
+    return get_paper_scorer().score(question, papers)
@@ -0,0 +1,42 @@
+"""Helpers shared by the SQLite stores."""
+import sqlite3
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+
+@contextmanager
+def connect(
+    path: str, row_factory: Optional[type] = None
+) -> Iterator[sqlite3.Connection]:
+    """Open a connection to the database, and commit when done."""
+    connection = sqlite3.connect(path, timeout=30)
+    if row_factory is not None:
+        connection.row_factory = row_factory
+    try:
+        with connection:
+            yield connection
+    finally:
+        connection.close()
+
+
+def evict_least_recently_used(
+    connection: sqlite3.Connection, table: str, max_bytes: int
+):
+    """Delete the least recently accessed rows of a table bigger than max_bytes.
+
+    The table needs the `key`, `size` and `accessed` columns.
+    """
+    total = connection.execute(f"SELECT SUM(size) FROM {table}").fetchone()[0]
+    if total is None or total <= max_bytes:
+        return
+    to_free = total - max_bytes
+    freed = 0
+    evicted = []
+    for key, size in connection.execute(
+        f"SELECT key, size FROM {table} ORDER BY accessed"
+    ):
+        if freed >= to_free:
+            break
+        evicted.append((key,))
+        freed += size
+    connection.executemany(f"DELETE FROM {table} WHERE key = ?", evicted)
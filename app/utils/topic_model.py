@@ -1,24 +1,231 @@
 """Topic model utilities."""
-import datetime
-
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property
+from typing import Optional
+
+import joblib
 import numpy as np
 import pandas as pd
 import streamlit as st
-from app.utils.vector_database import get_all_documents
+from app.utils.embeddings import EMBEDDING_MODEL_NAME, get_embedding_service
+from app.utils.llm import JSONObjectStream, chat
+from app.utils.vector_database import current_collection, get_all_documents_and_keys
 from bertopic import BERTopic
-from bertopic.representation import KeyBERTInspired, OpenAI
+from bertopic.backend import BaseEmbedder
+from bertopic.representation import BaseRepresentation
 from hdbscan import HDBSCAN
+from langchain.chat_models.base import BaseChatModel
+from langchain.schema import Document, HumanMessage, SystemMessage
 from plotly.graph_objs import Figure
+from scipy.sparse import csr_matrix, vstack
+from sklearn.metrics.pairwise import cosine_similarity
+from sklearn.preprocessing import normalize
 from umap import UMAP
 
 state = st.session_state
 
+# an update fits the model again past these shares of new documents and outliers
+TOPIC_REFIT_NEW_SHARE = 0.25
+TOPIC_REFIT_OUTLIER_INCREASE = 0.15
+# bigger collections are fitted on a sample, and assigned in chunks
+TOPIC_FIT_SAMPLE_SIZE = 20_000
+TOPIC_ASSIGN_CHUNK_SIZE = 2_000
+
+
+class ServiceBackend(BaseEmbedder):
+    """BERTopic embedding backend that uses the shared embedding service.
+
+    Without a service, the shared one is loaded when a document is first embedded.
+    """
+
+    def __init__(self, service=None):
+        """Initialize the backend."""
+        super().__init__()
+        self._service = service
+
+    @property
+    def service(self):
+        """The embedding service, loaded on first use."""
+        if self._service is None:
+            self._service = get_embedding_service()
+        return self._service
+
+    def embed(self, documents: list[str], verbose: bool = False) -> np.ndarray:
+        """Embed the documents with the embedding service."""
+        return np.array(self.service.embed_documents(list(documents)))
+
+
+class ChatRepresentation(BaseRepresentation):
+    """
+    BERTopic representation that labels the topics with a langchain chat model.
+
+    Several topics are labeled in a single request, with their keywords and
+    representative documents, and the requests are sent concurrently. The labels
+    are saved by topic signature, the c-TF-IDF keywords and the representative
+    documents of the topic, so a refit reuses the labels of the topics that did
+    not change, without calling the llm.
+
+    Parameters:
+        llm (BaseChatModel):
+            The chat model.
+
+        labels_path (str):
+            Optional json file where the labels are saved by topic signature.
+
+        nr_docs (int):
+            Number of representative documents in the prompt of a topic.
+
+        diversity (float):
+            Diversity of the representative documents, between 0 and 1.
+
+        topics_per_request (int):
+            Number of topics labeled in a single request.
+
+        max_concurrency (int):
+            Maximum number of requests at the same time.
+    """
+
+    def __init__(
+        self,
+        llm: BaseChatModel,
+        labels_path: str = None,
+        nr_docs: int = 4,
+        diversity: float = None,
+        topics_per_request: int = 8,
+        max_concurrency: int = 4,
+    ):
+        """Initialize the representation."""
+        self.llm = llm
+        self.labels_path = labels_path
+        self.nr_docs = nr_docs
+        self.diversity = diversity
+        self.topics_per_request = topics_per_request
+        self.max_concurrency = max_concurrency
+
+    @staticmethod
+    def topic_signature(keywords: list[str], docs: list[str]) -> str:
+        """Hash of the keywords and the representative documents of a topic."""
+        doc_ids = sorted(
+            hashlib.sha1(doc.encode("utf-8")).hexdigest()[:16] for doc in docs
+        )
+        return hashlib.sha256(
+            "|".join([" ".join(keywords), *doc_ids]).encode("utf-8")
+        ).hexdigest()
+
+    def _load_labels(self) -> dict[str, str]:
+        """Labels saved by topic signature."""
+        if self.labels_path is None or not os.path.exists(self.labels_path):
+            return {}
+        with open(self.labels_path, "r") as f:
+            return json.load(f)
+
+    def _save_labels(self, labels: dict[str, str]):
+        """Save the labels, replacing the file at once."""
+        if self.labels_path is None:
+            return
+        os.makedirs(os.path.dirname(self.labels_path) or ".", exist_ok=True)
+        tmp_path = f"{self.labels_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(labels, f, indent=2)
+        os.replace(tmp_path, tmp_path[: -len(".tmp")])
+
+    @staticmethod
+    def _create_prompt(batch: list[tuple[int, list[str], list[str]]]) -> str:
+        """Prompt that asks for the labels of several topics."""
+        prompt = "I have the following topics, each with some of its documents.\n\n"
+        for topic, keywords, docs in batch:
+            prompt += f"Topic {topic}:\n"
+            prompt += "".join(f"- {doc[:255]}\n" for doc in docs)
+            prompt += f"Keywords: {' '.join(keywords)}\n\n"
+        prompt += (
+            "Based on the information above, extract a short topic label for each "
+            "topic. The output should be a markdown code snippet with a single "
+            "JSON array, with one object for each topic, in the following "
+            "format:\n\n"
+            "```json\n"
+            '[{"topic": int, "label": string}]\n'
+            "```"
+        )
+        return prompt
+
+    def _label_batch(self, batch: list[tuple[int, list[str], list[str]]]) -> dict:
+        """Ask the llm for the labels of a batch of topics."""
+        messages = [
+            SystemMessage(content="You are a helpful assistant."),
+            HumanMessage(content=self._create_prompt(batch)),
+        ]
+        topics = {topic for topic, _, _ in batch}
+        labels = {}
+        for obj in JSONObjectStream().feed(self.llm(messages).content):
+            topic, label = obj.get("topic"), obj.get("label")
+            if topic in topics and isinstance(label, str) and label.strip():
+                labels[topic] = label.strip()
+        return labels
+
+    def _label_topics(self, to_label: list[tuple[int, list[str], list[str]]]) -> dict:
+        """Label the topics with concurrent batched requests.
+
+        The topics missing from the answers are asked once more. Those that are
+        still missing get their first keywords as label.
+        """
+        labels = {}
+        for _ in range(2):
+            missing = [item for item in to_label if item[0] not in labels]
+            batches = [
+                missing[start : start + self.topics_per_request]
+                for start in range(0, len(missing), self.topics_per_request)
+            ]
+            if len(batches) == 0:
+                break
+            with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+                for batch_labels in executor.map(self._label_batch, batches):
+                    labels.update(batch_labels)
+        return labels
+
+    def extract_topics(self, topic_model, documents, c_tf_idf, topics) -> dict:
+        """Label each topic, reusing the saved labels of the unchanged topics."""
+        repr_docs_mappings, _, _, _ = topic_model._extract_representative_docs(
+            c_tf_idf, documents, topics, 500, self.nr_docs, self.diversity
+        )
+        saved = self._load_labels()
+        signatures = {}
+        to_label = []
+        for topic, docs in repr_docs_mappings.items():
+            keywords = [word for word, _ in topics[topic]]
+            signatures[topic] = self.topic_signature(keywords, docs)
+            if signatures[topic] not in saved:
+                to_label.append((topic, keywords, docs))
+
+        new_labels = self._label_topics(to_label) if to_label else {}
+        saved.update({signatures[topic]: label for topic, label in new_labels.items()})
+        self._save_labels(saved)
+
+        updated_topics = {}
+        for topic in repr_docs_mappings:
+            label = saved.get(signatures[topic])
+            if label is None:
+                label = " ".join(word for word, _ in topics[topic][:3])
+            updated_topics[topic] = [(label, 1)]
+        return updated_topics
+
 
 class TopicModel:
     """
     A topic model that uses BERTopic to cluster documents and embeddings.
 
+    The documents of the collection and the BERTopic model are only created when
+    an operation needs them, so loading a cached model doesn't fetch the whole
+    collection. The topic table of a cached model comes from the saved model, and
+    its plots from the saved topic of each document.
+
     Parameters:
+        collection (dict):
+            The collection, as returned by `open_collection`. Defaults to the
+            collection that is currently loaded.
+
         hdbscan_params (dict):
             Parameters for the HDBSCAN clustering algorithm.
 
@@ -26,7 +233,7 @@ class TopicModel:
             Parameters for the UMAP dimensionality reduction algorithm.
 
         representation_params (dict):
-            Parameters for the OpenAI representation model.
+            Parameters for the chat representation model.
 
     Attributes:
         topic_model (BERTopic):
@@ -35,6 +242,7 @@ class TopicModel:
 
     def __init__(
         self,
+        collection: dict = None,
         umap_params: dict = None,
         hdbscan_params: dict = None,
         representation_params: dict = None,
@@ -43,6 +251,9 @@ class TopicModel:
         Initialize the topic model.
 
         Parameters:
+            collection (dict):
+                The collection, as returned by `open_collection`.
+
             umap_params (dict):
                 Parameters for the UMAP dimensionality reduction algorithm.
 
@@ -52,6 +263,8 @@ class TopicModel:
             representation_params (dict):
                 Parameters for the representation model.
         """
+        self.collection = collection or current_collection()
+        self.collection_name = self.collection["collection_name"]
         if umap_params is None:
             umap_params = {
                 "n_neighbors": 10,
@@ -71,18 +284,51 @@ class TopicModel:
 
         if representation_params is None:
             representation_params = {
-                "model": "gpt-3.5-turbo",
-                "chat": True,
                 "nr_docs": 3,
                 "diversity": 0,
             }
 
-        umap = UMAP(**umap_params)
-        hdbscan = HDBSCAN(**hdbscan_params)
-        representation = OpenAI(**representation_params)
+        self.umap_params = umap_params
+        self.hdbscan_params = hdbscan_params
+        self.representation_params = representation_params
+        self.model_path = f"./cache/{self.collection_name}/topic_model_docs"
+        # fingerprint of the document keys, 2-D embeddings and hover texts
+        self._projection = None
+        # frequency and words of each topic and publication year
+        self._topics_over_time = None
+
+    @cached_property
+    def topic_model(self) -> BERTopic:
+        """The BERTopic model, unfitted until it is fitted or loaded."""
+        return self._create_topic_model()
+
+    @cached_property
+    def _documents_and_keys(self) -> tuple[list[Document], list[str]]:
+        """Documents of the collection and their embedding keys, fetched once."""
+        return get_all_documents_and_keys(self.collection)
+
+    @property
+    def documents(self) -> list[Document]:
+        """Documents of the collection."""
+        return self._documents_and_keys[0]
+
+    @property
+    def document_keys(self) -> list[str]:
+        """Embedding keys of the documents of the collection."""
+        return self._documents_and_keys[1]
+
+    def _create_topic_model(self) -> BERTopic:
+        """Create an unfitted BERTopic model with the parameters of the model."""
+        umap = UMAP(**self.umap_params)
+        hdbscan = HDBSCAN(**self.hdbscan_params)
+        representation = ChatRepresentation(
+            llm=chat,
+            labels_path=f"./cache/{self.collection_name}/topic_labels.json",
+            **self.representation_params,
+        )
 
-        self.topic_model = BERTopic(
-            embedding_model=state["embedding_model"].model_name,
+        return BERTopic(
+            embedding_model=ServiceBackend(),
             umap_model=umap,
             hdbscan_model=hdbscan,
             representation_model=representation,
@@ -92,67 +338,380 @@ class TopicModel:
             n_gram_range=(1, 2),
             verbose=True,
         )
-        self.documents = get_all_documents()
-        self.embeddings = np.array(
-            state["cached_embedder"].embed_documents(
-                [doc.page_content for doc in self.documents]
+
+    def fit_model(self, sample_size: int = TOPIC_FIT_SAMPLE_SIZE):
+        """Fit a topic model to a set of documents and embeddings.
+
+        Collections bigger than `sample_size` are fitted on a sample stratified by
+        publication year. The other documents are then assigned to the topics in
+        parallel chunks, and the c-TF-IDF is recalculated with all of them.
+        The embeddings are read from the embedding store, and dequantized, only
+        once per fit, and by chunks for the assigned documents.
+        """
+        contents = [doc.page_content for doc in self.documents]
+        if len(contents) <= sample_size:
+            self.topic_model.fit(
+                documents=contents,
+                embeddings=self.collection["embedding_store"].get(self.document_keys),
             )
+            topics = np.asarray(self.topic_model.topics_)
+            outliers = topics == -1
+        else:
+            sample = self._stratified_sample(sample_size)
+            self.topic_model.fit(
+                documents=[contents[i] for i in sample],
+                embeddings=self.collection["embedding_store"].get(
+                    [self.document_keys[i] for i in sample]
+                ),
+            )
+            topics = np.full(len(contents), -1)
+            outliers = np.zeros(len(contents), dtype=bool)
+            topics[sample] = self.topic_model.topics_
+            outliers[sample] = topics[sample] == -1
+            rest = np.setdiff1d(np.arange(len(contents)), sample)
+            topics[rest], outliers[rest] = self._assign_topics(
+                [self.document_keys[i] for i in rest], [contents[i] for i in rest]
+            )
+        assignments = dict(zip(self.document_keys, topics.tolist()))
+        # the 2-D projection belongs to the previous model
+        self._projection = None
+        for name in ["projection.npz", "projection_umap.joblib"]:
+            if os.path.exists(os.path.join(self.model_path, name)):
+                os.remove(os.path.join(self.model_path, name))
+        if len(contents) > sample_size:
+            self._update_topic_counts(assignments)
+        self.save_model()
+        # the fitted UMAP and HDBSCAN models are kept to assign new documents
+        joblib.dump(
+            {
+                "umap_model": self.topic_model.umap_model,
+                "hdbscan_model": self.topic_model.hdbscan_model,
+            },
+            os.path.join(self.model_path, "clustering.joblib"),
         )
+        self._save_assignments(
+            assignments=assignments,
+            fitted_documents=len(topics),
+            outlier_share=float(outliers.mean()) if len(topics) else 0.0,
+        )
+        self._update_topics_over_time(self.document_keys, topics.tolist(), reset=True)
+
+    def _stratified_sample(self, sample_size: int) -> np.ndarray:
+        """Sorted indices of a sample with the same share of each publication year."""
+        rng = np.random.default_rng(42)
+        years = np.array([doc.metadata.get("published", 0) for doc in self.documents])
+        sample = []
+        for year in np.unique(years):
+            indices = np.flatnonzero(years == year)
+            n_sampled = max(1, round(sample_size * len(indices) / len(years)))
+            sample.append(
+                rng.choice(indices, size=min(n_sampled, len(indices)), replace=False)
+            )
+        return np.sort(np.concatenate(sample))
 
-    def fit_model(self):
-        """Fit a topic model to a set of documents and embeddings."""
-        contents = [doc.page_content for doc in self.documents]
-        self.topic_model.fit(
-            documents=contents,
-            embeddings=self.embeddings,
+    def _assign_topics(
+        self,
+        keys: list[str],
+        contents: list[str],
+        chunk_size: int = TOPIC_ASSIGN_CHUNK_SIZE,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Assign documents to the fitted topics, one chunk at a time.
+
+        Only the embeddings of a chunk are in memory at once, and the UMAP
+        reduction of each chunk already runs on all the cores with numba.
+
+        Returns the topics of the documents, and which of them are outliers.
+        Without an outlier topic in the model, the outliers join the closest topic.
+        """
+
+        def assign(start: int) -> tuple[np.ndarray, np.ndarray]:
+            """Assign a chunk of documents, reading only their embeddings."""
+            embeddings = self.collection["embedding_store"].get(
+                keys[start : start + chunk_size]
+            )
+            predictions, _ = self.topic_model.transform(
+                contents[start : start + chunk_size], embeddings=embeddings
+            )
+            predictions = np.asarray(predictions)
+            outliers = predictions == -1
+            if not self.topic_model._outliers and outliers.any():
+                similarity = cosine_similarity(
+                    embeddings[outliers], self.topic_model.topic_embeddings_
+                )
+                predictions[outliers] = np.argmax(similarity, axis=1)
+            return predictions, outliers
+
+        if len(keys) == 0:
+            return np.empty(0, dtype=int), np.empty(0, dtype=bool)
+        chunks = [assign(start) for start in range(0, len(keys), chunk_size)]
+        return (
+            np.concatenate([predictions for predictions, _ in chunks]),
+            np.concatenate([outliers for _, outliers in chunks]),
         )
+
+    def update_model(
+        self,
+        max_new_share: float = TOPIC_REFIT_NEW_SHARE,
+        max_outlier_increase: float = TOPIC_REFIT_OUTLIER_INCREASE,
+        sample_size: int = TOPIC_FIT_SAMPLE_SIZE,
+    ) -> dict:
+        """Assign the new documents of the collection to the topics of the cache.
+
+        Loads the cached model, and assigns only the documents that were added
+        since the fit, with the fitted UMAP and HDBSCAN prediction data. Then the
+        c-TF-IDF and the topic sizes are updated, keeping the topic labels. The
+        model is fitted again instead when the new documents are more than
+        `max_new_share` of the fitted ones, or when the share of outliers among
+        them is `max_outlier_increase` higher than in the fit.
+
+        Returns a summary of the update, with the number of new documents, their
+        share of outliers, and whether the model was fitted again. A refit uses
+        `sample_size` as `fit_model` does.
+        """
+        clustering_path = os.path.join(self.model_path, "clustering.joblib")
+        saved = self._load_assignments()
+        summary = {"new_documents": 0, "outlier_share": 0.0, "refit": True}
+        if saved is None or not os.path.exists(clustering_path):
+            # caches of older versions can not be updated
+            self.fit_model(sample_size)
+            return summary
+
+        assignments = saved["assignments"]
+        new_keys = [key for key in self.document_keys if key not in assignments]
+        summary["new_documents"] = len(new_keys)
+        if len(new_keys) > max_new_share * saved["fitted_documents"]:
+            self.fit_model(sample_size)
+            return summary
+
+        self.load_model()
+        if new_keys:
+            clustering = joblib.load(clustering_path)
+            self.topic_model.umap_model = clustering["umap_model"]
+            self.topic_model.hdbscan_model = clustering["hdbscan_model"]
+            new_documents = {
+                doc_key: doc.page_content
+                for doc, doc_key in zip(self.documents, self.document_keys)
+                if doc_key not in assignments
+            }
+            predictions, outliers = self._assign_topics(
+                new_keys, [new_documents[key] for key in new_keys]
+            )
+            summary["outlier_share"] = float(outliers.mean())
+            if summary["outlier_share"] > saved["outlier_share"] + max_outlier_increase:
+                self.topic_model = self._create_topic_model()
+                self.fit_model(sample_size)
+                return summary
+            assignments.update(zip(new_keys, predictions.tolist()))
+
+        self._update_topic_counts(assignments)
         self.save_model()
-        state["topic_model_fitted"] = True
+        if self._load_topics_over_time() is None:
+            self._update_topics_over_time(
+                self.document_keys,
+                [assignments[key] for key in self.document_keys],
+                reset=True,
+            )
+        elif new_keys:
+            self._update_topics_over_time(
+                new_keys, [assignments[key] for key in new_keys]
+            )
+        self._save_assignments(
+            assignments={key: assignments[key] for key in self.document_keys},
+            fitted_documents=saved["fitted_documents"],
+            outlier_share=saved["outlier_share"],
+        )
+        summary["refit"] = False
+        return summary
+
+    def _update_topic_counts(
+        self, assignments: dict[str, int], chunk_size: int = TOPIC_ASSIGN_CHUNK_SIZE
+    ):
+        """Recalculate the c-TF-IDF and the topic sizes from the assignments.
+
+        The word counts of the topics are summed chunk by chunk with the fitted
+        vocabulary, instead of vectorizing all the documents of a topic joined in
+        a single string. The topic labels and embeddings are left as they are.
+        """
+        topic_model = self.topic_model
+        topics = np.array([assignments[key] for key in self.document_keys])
+        topic_ids = np.array(
+            sorted(set(topic_model.topic_representations_) | set(topics.tolist()))
+        )
+        rows = np.searchsorted(topic_ids, topics)
+        counts = None
+        for start in range(0, len(topics), chunk_size):
+            chunk = self.documents[start : start + chunk_size]
+            words = topic_model.vectorizer_model.transform(
+                topic_model._preprocess_text([doc.page_content for doc in chunk])
+            )
+            membership = csr_matrix(
+                (
+                    np.ones(len(chunk)),
+                    (rows[start : start + chunk_size], np.arange(len(chunk))),
+                ),
+                shape=(len(topic_ids), len(chunk)),
+            )
+            chunk_counts = membership @ words
+            counts = chunk_counts if counts is None else counts + chunk_counts
+        if counts is None:
+            return
+        topic_model.ctfidf_model.fit(counts)
+        topic_model.c_tf_idf_ = topic_model.ctfidf_model.transform(counts)
+        topic_model._update_topic_size(pd.DataFrame({"Topic": topics}))
+
+    def _load_assignments(self) -> Optional[dict]:
+        """Topics of the documents of the cached model, by embedding key."""
+        path = os.path.join(self.model_path, "assignments.json")
+        if not os.path.exists(path):
+            return None
+        with open(path, "r") as f:
+            return json.load(f)
+
+    def _save_assignments(
+        self, assignments: dict[str, int], fitted_documents: int, outlier_share: float
+    ):
+        """Save the topics of the documents, replacing the file at once."""
+        path = os.path.join(self.model_path, "assignments.json")
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(
+                {
+                    "fitted_documents": fitted_documents,
+                    "outlier_share": outlier_share,
+                    "assignments": {key: int(t) for key, t in assignments.items()},
+                },
+                f,
+            )
+        os.replace(tmp_path, path)
 
     def save_model(self):
         """Save the topic model."""
         self.topic_model.save(
-            path=f"./cache/{state['collection_name']}/" f"topic_model_docs",
+            path=self.model_path,
             serialization="safetensors",
             save_ctfidf=True,
-            save_embedding_model=state["embedding_model"].model_name,
+            save_embedding_model=EMBEDDING_MODEL_NAME,
         )
 
     def visualize_documents(self, hide_annotations=False) -> Figure:
         """Visualize the documents."""
-        hover = []
-        for doc in self.documents:
-            title = f"{doc.metadata['title']}<br>"
-            # divide authors in lines of 6 authors
-            authors_list = doc.metadata["authors"].split(",")
-            authors = ""
-            for i, author in enumerate(authors_list):
-                authors += f"{author}"
-                authors += (
-                    "<br>"
-                    if (i % 5 == 0 and i != 0) or i == len(authors_list) - 1
-                    else ", "
-                )
-            published = f"{doc.metadata['published']}<br>"
-            hover.append(title + authors + published)
-
-        reduced_embeddings = UMAP(
-            n_neighbors=15,
-            n_components=2,
-            min_dist=0.0,
-            metric="cosine",
-            random_state=42,
-        ).fit_transform(self.embeddings)
-
+        reduced_embeddings, hover = self.document_projection()
         self.get_custom_labels()
         return self.topic_model.visualize_documents(
             docs=hover,
             reduced_embeddings=reduced_embeddings,
-            title=f'<b> {state["nice_collection_name"]} </b>',
+            title=f'<b> {self.collection_name.replace("_", " ").title()} </b>',
             custom_labels=True,
             hide_annotations=hide_annotations,
         )
 
+    @staticmethod
+    def _hover_text(doc: Document) -> str:
+        """Title, authors and year of a document, for the hover of the plot."""
+        title = f"{doc.metadata['title']}<br>"
+        # divide authors in lines of 6 authors
+        authors_list = doc.metadata["authors"].split(",")
+        authors = ""
+        for i, author in enumerate(authors_list):
+            authors += f"{author}"
+            authors += (
+                "<br>"
+                if (i % 5 == 0 and i != 0) or i == len(authors_list) - 1
+                else ", "
+            )
+        published = f"{doc.metadata['published']}<br>"
+        return title + authors + published
+
+    def document_projection(self) -> tuple[np.ndarray, list[str]]:
+        """2-D embeddings and hover texts of the documents, in the order of the topics.
+
+        They are saved next to the model with a fingerprint of the document keys,
+        and kept in memory, so a rerun of the page doesn't project them again.
+        When documents are added to the model, only those are projected, with the
+        saved 2-D reducer.
+        """
+        saved = self._load_assignments()
+        keys = list(saved["assignments"]) if saved else self.document_keys
+        fingerprint = hashlib.sha256("\n".join(keys).encode("utf-8")).hexdigest()
+        if self._projection is not None and self._projection[0] == fingerprint:
+            return self._projection[1:]
+
+        projection_path = os.path.join(self.model_path, "projection.npz")
+        reducer_path = os.path.join(self.model_path, "projection_umap.joblib")
+        known = {}
+        if os.path.exists(projection_path) and os.path.exists(reducer_path):
+            with np.load(projection_path) as projection:
+                if str(projection["fingerprint"]) == fingerprint:
+                    reduced = projection["reduced"]
+                    hover = projection["hover"].tolist()
+                    self._projection = (fingerprint, reduced, hover)
+                    return reduced, hover
+                known = {
+                    key: (point, text)
+                    for key, point, text in zip(
+                        projection["keys"].tolist(),
+                        projection["reduced"],
+                        projection["hover"].tolist(),
+                    )
+                }
+
+        new_keys = [key for key in keys if key not in known]
+        new_reduced = None
+        if len(known) == 0:
+            reducer = UMAP(
+                n_neighbors=15,
+                n_components=2,
+                min_dist=0.0,
+                metric="cosine",
+                random_state=42,
+            )
+            if len(new_keys) <= TOPIC_FIT_SAMPLE_SIZE:
+                new_reduced = reducer.fit_transform(
+                    self.collection["embedding_store"].get(new_keys)
+                )
+            else:
+                sample = np.random.default_rng(42).choice(
+                    len(new_keys), TOPIC_FIT_SAMPLE_SIZE, replace=False
+                )
+                reducer.fit(
+                    self.collection["embedding_store"].get(
+                        [new_keys[i] for i in np.sort(sample)]
+                    )
+                )
+            joblib.dump(reducer, reducer_path)
+        else:
+            reducer = joblib.load(reducer_path)
+        if new_reduced is None:
+            new_reduced = [np.empty((0, 2), dtype=np.float32)] + [
+                reducer.transform(
+                    self.collection["embedding_store"].get(
+                        new_keys[start : start + TOPIC_ASSIGN_CHUNK_SIZE]
+                    )
+                )
+                for start in range(0, len(new_keys), TOPIC_ASSIGN_CHUNK_SIZE)
+            ]
+            new_reduced = np.concatenate(new_reduced)
+
+        documents = dict(zip(self.document_keys, self.documents)) if new_keys else {}
+        for key, point in zip(new_keys, new_reduced):
+            doc = documents.get(key)
+            known[key] = (point, self._hover_text(doc) if doc is not None else "")
+        reduced = np.array([known[key][0] for key in keys], dtype=np.float32)
+        hover = [known[key][1] for key in keys]
+
+        tmp_path = f"{projection_path}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                fingerprint=np.array(fingerprint),
+                keys=np.array(keys),
+                reduced=reduced,
+                hover=np.array(hover),
+            )
+        os.replace(tmp_path, projection_path)
+        self._projection = (fingerprint, reduced, hover)
+        return reduced, hover
+
     def get_custom_labels(self):
         """Get custom labels for the topics for simplified visualization."""
 
@@ -171,30 +730,186 @@ class TopicModel:
     def load_model(self):
         """Load a pre-existing topic model."""
         self.topic_model = BERTopic.load(
-            path=f"./cache/{state['collection_name']}/topic_model_docs",
-            embedding_model=state["embedding_model"].model_name,
+            path=self.model_path,
+            embedding_model=ServiceBackend(),
         )
-        state["topic_model_fitted"] = True
 
     def visualize_over_time(self):
         """Visualize the topics over time.
 
-        Uses the KeyBERTInspired representation model, to save tokens and time.
+        Reads the frequency and words of each topic and year saved with the model.
+        Caches made before they were saved count them here, once.
         """
-        self.topic_model.representation_model = KeyBERTInspired
-        timestamps = [
-            datetime.datetime(doc.metadata["published"], 1, 1) for doc in self.documents
-        ]
-        contents = [doc.metadata["title"] for doc in self.documents]
-        topics_over_time = self.topic_model.topics_over_time(
-            contents,
-            timestamps,
+        if self._topics_over_time is None:
+            saved = self._load_topics_over_time()
+            if saved is None:
+                assignments = self._load_assignments()
+                if assignments is not None:
+                    keys = list(assignments["assignments"])
+                    topics = list(assignments["assignments"].values())
+                else:
+                    keys, topics = self.document_keys, self.topic_model.topics_
+                self._update_topics_over_time(keys, topics, reset=True)
+            else:
+                self._topics_over_time = saved[0]
+        table = self._topics_over_time
+        topics_over_time = pd.DataFrame(
+            {
+                "Topic": table["Topic"],
+                "Words": table["Words"],
+                "Frequency": table["Frequency"],
+                "Timestamp": pd.to_datetime(
+                    pd.DataFrame({"year": table["Year"], "month": 1, "day": 1})
+                ),
+            }
         )
         return self.topic_model.visualize_topics_over_time(
             topics_over_time,
             top_n_topics=10,
         )
 
+    def _load_topics_over_time(self) -> Optional[tuple[pd.DataFrame, csr_matrix]]:
+        """Saved bins of the topics over time, and the word counts of each bin."""
+        path = os.path.join(self.model_path, "topics_over_time.npz")
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as saved:
+            table = pd.DataFrame(
+                {
+                    "Topic": saved["topic"],
+                    "Year": saved["year"],
+                    "Frequency": saved["frequency"],
+                    "Words": saved["words"].tolist(),
+                }
+            )
+            counts = csr_matrix(
+                (saved["data"], saved["indices"], saved["indptr"]),
+                shape=tuple(saved["shape"]),
+            )
+        return table, counts
+
+    def _update_topics_over_time(
+        self, keys: list[str], topics: list[int], reset: bool = False
+    ):
+        """Add documents to the saved bins of the topics over time.
+
+        The words of the titles are counted for each topic and publication year,
+        and only the bins where the documents fall get their words again. The words
+        of a bin are its c-TF-IDF averaged with the c-TF-IDF of its topic, like the
+        global tuning of BERTopic. With `reset`, the saved bins are replaced.
+        """
+        topic_model = self.topic_model
+        saved = None if reset else self._load_topics_over_time()
+        if saved is None:
+            table = pd.DataFrame(
+                {"Topic": [], "Year": [], "Frequency": [], "Words": []}
+            ).astype({"Topic": int, "Year": int, "Frequency": int, "Words": str})
+            counts = None
+        else:
+            table, counts = saved
+
+        documents = dict(zip(self.document_keys, self.documents))
+        known = [i for i, key in enumerate(keys) if key in documents]
+        docs = [documents[keys[i]] for i in known]
+        if docs:
+            frame = pd.DataFrame(
+                {
+                    "Topic": np.asarray(topics)[known],
+                    "Year": [doc.metadata["published"] for doc in docs],
+                }
+            )
+            groups = frame.groupby(["Topic", "Year"])
+            bins = groups.size()
+            words = topic_model.vectorizer_model.transform(
+                topic_model._preprocess_text([doc.metadata["title"] for doc in docs])
+            )
+            bin_counts = (
+                csr_matrix(
+                    (
+                        np.ones(len(docs)),
+                        (groups.ngroup().to_numpy(), np.arange(len(docs))),
+                    ),
+                    shape=(len(bins), len(docs)),
+                )
+                @ words
+            )
+
+            index = {
+                (topic, year): i
+                for i, (topic, year) in enumerate(zip(table["Topic"], table["Year"]))
+            }
+            new_bins = [key for key in bins.index if key not in index]
+            index.update({key: len(table) + i for i, key in enumerate(new_bins)})
+            if new_bins:
+                table = pd.concat(
+                    [
+                        table,
+                        pd.DataFrame(
+                            {
+                                "Topic": [topic for topic, _ in new_bins],
+                                "Year": [year for _, year in new_bins],
+                                "Frequency": 0,
+                                "Words": "",
+                            }
+                        ),
+                    ],
+                    ignore_index=True,
+                )
+            rows = np.array([index[key] for key in bins.index])
+            table.loc[rows, "Frequency"] += bins.to_numpy()
+            added = (
+                csr_matrix(
+                    (np.ones(len(rows)), (rows, np.arange(len(rows)))),
+                    shape=(len(table), len(rows)),
+                )
+                @ bin_counts
+            )
+            if counts is not None:
+                padding = csr_matrix((len(table) - counts.shape[0], counts.shape[1]))
+                added = vstack([counts, padding]).tocsr() + added
+            counts = added.tocsr()
+
+            topic_ids = np.array(
+                sorted(
+                    set(topic_model.topic_representations_)
+                    | set(topic_model.topic_sizes_)
+                )
+            )
+            c_tf_idf = normalize(
+                topic_model.ctfidf_model.transform(counts[rows]), axis=1, norm="l1"
+            )
+            global_c_tf_idf = normalize(topic_model.c_tf_idf_, axis=1, norm="l1")
+            c_tf_idf = (
+                global_c_tf_idf[np.searchsorted(topic_ids, table["Topic"][rows])]
+                + c_tf_idf
+            ) / 2.0
+            vocabulary = topic_model.vectorizer_model.get_feature_names_out()
+            for row, values in zip(rows, c_tf_idf):
+                values = np.asarray(values.todense()).ravel()
+                top = np.argsort(-values)[:5]
+                table.at[row, "Words"] = ", ".join(
+                    vocabulary[i] for i in top if values[i] > 0
+                )
+
+        if counts is None:
+            counts = csr_matrix((0, 0))
+        path = os.path.join(self.model_path, "topics_over_time.npz")
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                topic=table["Topic"].to_numpy(dtype=np.int64),
+                year=table["Year"].to_numpy(dtype=np.int64),
+                frequency=table["Frequency"].to_numpy(dtype=np.int64),
+                words=np.array(table["Words"].tolist(), dtype=str),
+                data=counts.data,
+                indices=counts.indices,
+                indptr=counts.indptr,
+                shape=np.array(counts.shape),
+            )
+        os.replace(tmp_path, path)
+        self._topics_over_time = table
+
     def topics_info(self) -> pd.DataFrame:
         """Get a dataframe with the topics and their metadata."""
         topic_info = self.topic_model.get_topic_info()
@@ -210,8 +925,9 @@ class TopicModel:
 
 def restart_topic_model():
     """Restart the topic model."""
-    if "topic_model" in state:
-        del state["topic_model"]
+    for key in ["topic_model", "topic_model_update"]:
+        if key in state:
+            del state[key]
     state["topic_model_fitted"] = False
 
 
@@ -220,6 +936,15 @@ def load_model():
     restart_topic_model()
     state["topic_model"] = TopicModel()
     state["topic_model"].load_model()
+    state["topic_model_fitted"] = True
+
+
+def update_model():
+    """Restart the topic model and add the new documents to the cached model."""
+    restart_topic_model()
+    state["topic_model"] = TopicModel()
+    state["topic_model_update"] = state["topic_model"].update_model()
+    state["topic_model_fitted"] = True
 
 
 def fit_model():
@@ -227,3 +952,4 @@ def fit_model():
     restart_topic_model()
     state["topic_model"] = TopicModel()
     state["topic_model"].fit_model()
+    state["topic_model_fitted"] = True
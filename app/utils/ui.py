@@ -1,14 +1,17 @@
 """UI utilities for the app."""
 
+import time
+
+import langchain
 import streamlit as st
-from app.utils.vector_database import connect_to_vector_db
+from app.utils.embeddings import get_embedding_service
+from app.utils.jobs import get_job_queue
+from app.utils.llm_cache import get_llm_cache
+from app.utils.quantization import quantization_report
+from app.utils.vector_database import connect_to_vector_db, sample_vectors
 from dotenv import find_dotenv, load_dotenv
-from langchain.embeddings import HuggingFaceBgeEmbeddings
 from pymilvus import connections
 
-# import langchain
-# from langchain.cache import SQLiteCache
-
 state = st.session_state
 
 
@@ -20,25 +23,21 @@ def set_state_if_absent(key, value):
 
 def init_session_states():
     """Some session states, that should always be present."""
+    # the embedding backend is configured in the .env file
+    load_dotenv(find_dotenv())
     set_state_if_absent(key="rows", value=2)
-    set_state_if_absent(
-        key="embedding_model",
-        value=HuggingFaceBgeEmbeddings(
-            model_name="BAAI/bge-small-en-v1.5",
-            encode_kwargs={"normalize_embeddings": True},
-            query_instruction="Represent this sentence for searching relevant "
-            "passages: ",
-        ),
-    )
+    set_state_if_absent(key="embedding_model", value=get_embedding_service())
     set_state_if_absent(key="topic_model_fitted", value=False)
+    set_state_if_absent(key="watched_jobs", value=[])
 
 
 def start_app():
     """Start the app.
 
     Connect to Milvus default, set app_state to initialized and load .env file.
+    The LLM responses are cached on disk, shared by all the sessions.
     """
-    # langchain.llm_cache = SQLiteCache(database_path=".app.db")
+    langchain.llm_cache = get_llm_cache()
     milvus_connection = {"alias": "default", "host": "localhost", "port": 19530}
     connections.connect(**milvus_connection)
     load_dotenv(find_dotenv())
@@ -69,7 +68,7 @@ def choose_collection(collections: list[str], on_change=None):
 
 def display_vector_db_info():
     """If the vector database is loaded, display relevant info."""
-    if "vector_db" in state:
+    if "vector_db" in state and state["vector_db"].col is not None:
         st.write(
             f"Total abstracts in collection: {state['vector_db'].col.num_entities} \n\n"
             "Embedding Dimensions: "
@@ -77,6 +76,24 @@ def display_vector_db_info():
         )
 
 
+def display_quantization_report():
+    """Compare the embedding storage modes on a sample of the collection."""
+    if "embedding_store" not in state or len(state["embedding_store"]) < 2:
+        return
+    st.write(f"Embedding storage: {state['embedding_store'].mode}")
+    if st.checkbox("Compare embedding storage modes", value=False):
+        vectors = sample_vectors(1000)
+        baseline = "float32 embeddings stored in Milvus"
+        if len(vectors) < 2:
+            vectors = state["embedding_store"].sample(1000)
+            baseline = f"{state['embedding_store'].mode} embeddings of the store"
+        st.caption(
+            "Nearest neighbors recall and cosine similarity of the quantized "
+            f"embeddings, compared to the {baseline} of this collection."
+        )
+        st.dataframe(quantization_report(vectors))
+
+
 def sidebar_collection_info() -> None:
     """Display info about the current collection in the sidebar."""
     info = (
@@ -85,3 +102,69 @@ def sidebar_collection_info() -> None:
         else "Currently you are not connected to any collection. "
     )
     st.sidebar.info(info)
+    llm_cache = get_llm_cache()
+    st.sidebar.caption(
+        f"LLM cache: {llm_cache.hits} hits, {llm_cache.misses} misses "
+        f"({llm_cache.hit_rate:.0%} hit rate)."
+    )
+
+
+def watch_job(job_id: int):
+    """Follow a job in the page, until it finishes."""
+    if job_id is not None:
+        state["watched_jobs"].append(job_id)
+
+
+def display_jobs() -> bool:
+    """Display the ingestion jobs of the current collection.
+
+    Shows the progress of the running jobs with a button to cancel them, and the
+    outcome of the jobs followed by the session once they finish. When a job of
+    the collection finishes, it is reloaded to see the new documents.
+    Returns True if the collection has jobs that are not finished.
+    """
+    if "collection_name" not in state:
+        return False
+    job_queue = get_job_queue()
+    for job_id in list(state["watched_jobs"]):
+        job = job_queue.get(job_id)
+        if job is None or job["status"] in ["queued", "running"]:
+            continue
+        state["watched_jobs"].remove(job_id)
+        if job["status"] == "failed":
+            st.error(f"The {job['kind']} job failed: {job['error']}")
+            continue
+        if job["result"] is not None:
+            st.info(
+                f"{job['result']['new_documents']} abstracts were downloaded. \n\n"
+                f"{job['result']['duplicates']} duplicated abstracts were skipped."
+                + (
+                    " \n\nThe job was cancelled."
+                    if job["status"] == "cancelled"
+                    else ""
+                )
+            )
+        if job["collection"] == state["collection_name"]:
+            connect_to_vector_db()
+
+    active = job_queue.list_jobs(
+        collection=state["collection_name"], statuses=["queued", "running"]
+    )
+    for job in reversed(active):
+        with st.status(
+            f"{job['kind'].title()} job {job['id']}: {job['status']}",
+            expanded=job["status"] == "running",
+        ):
+            st.write(", ".join(job["params"]["keywords"]))
+            if job["progress"]:
+                st.markdown(job["progress"])
+            if st.button("Cancel", key=f"cancel_job_{job['id']}"):
+                job_queue.cancel(job["id"])
+    return len(active) > 0
+
+
+def poll_jobs(active: bool, interval: float = 2.0):
+    """Rerun the page after an interval while there are jobs to follow."""
+    if active or len(state["watched_jobs"]) > 0:
+        time.sleep(interval)
+        st.experimental_rerun()
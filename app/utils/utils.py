@@ -1,9 +1,14 @@
 """Utility functions for the app."""
 import re
+from typing import Iterable
 
 import arxiv
 import streamlit as st
-from app.utils.vector_database import cache_documents_embeddings, connect_to_vector_db
+from app.utils.arxiv_cache import get_response_cache
+from app.utils.arxiv_harvester import ArxivHarvester, HarvestWatermarks
+from app.utils.ingestion import result_to_document
+from app.utils.jobs import get_job_queue
+from app.utils.vector_database import connect_to_vector_db
 from langchain.schema import Document
 
 state = st.session_state
@@ -16,6 +21,17 @@ def clean_string(input_string: str) -> str:
     return cleaned_string.lower()
 
 
+def results_to_documents(results: Iterable[arxiv.Result]) -> list[Document]:
+    """Save arxiv results in a list of Document objects."""
+    docs = []
+    for i, result in enumerate(results):
+        try:
+            docs.append(result_to_document(result))
+        except Exception as e:
+            st.write(f"Error: {e}", i)
+    return docs
+
+
 def get_arxiv_abstracts(
     query: str, sort_by: str = "Relevance", max_results=5
 ) -> list[Document]:
@@ -24,82 +40,71 @@ def get_arxiv_abstracts(
     Saves them in a list of Document objects. Keeps the title, authors, link, journal
     and comment as metadata.
     """
-    # If the request is too big, we need to use a slower client
-    if max_results > 500:
-        client = arxiv.Client(page_size=500, delay_seconds=5, num_retries=7)
-    else:
-        client = arxiv.Client(page_size=100, delay_seconds=3, num_retries=7)
-
-    sort_by = (
-        arxiv.SortCriterion.Relevance
-        if sort_by == "Relevance"
-        else arxiv.SortCriterion.SubmittedDate
+    harvester = ArxivHarvester(
+        page_size=min(max_results, 500), max_workers=1, cache=get_response_cache()
     )
-
-    results = client.results(
-        arxiv.Search(query=query, max_results=max_results, sort_by=sort_by)
+    return results_to_documents(
+        harvester.harvest(queries=[query], max_papers=max_results, sort_by=sort_by)
     )
-    docs = []
-    for i, result in enumerate(results):
-        try:
-            docs.append(
-                Document(
-                    page_content=result.summary,
-                    metadata={
-                        "published": result.published.year,
-                        "title": result.title,
-                        "authors": ", ".join(
-                            [author.name for author in result.authors]
-                        ),
-                        "link": result.entry_id,
-                    },
-                )
-            )
-        except Exception as e:
-            st.write(f"Error: {e}", i)
-    return docs
 
 
 def download_abstracts():
-    """Download abstracts from arxiv and store them in a milvus collection database.
+    """Queue the download of the abstracts in the background.
 
-    The collection name is the cleaned question string.
+    Connects to the vector database first, creating the collection name from the
+    research question.
     """
-    with state.placeholder.status("Downloading abstracts...", expanded=False):
-        if "vector_db" not in state:
-            st.write("Creating vector database...")
-            state["collection_name"] = clean_string(state["question"])
-            connect_to_vector_db()
+    if "vector_db" not in state:
+        state["collection_name"] = clean_string(state["question"])
+        connect_to_vector_db()
 
-        download_and_upsert_documents()
+    return download_and_upsert_documents()
 
 
 def download_and_upsert_documents():
-    """Download abstracts from arxiv and store them in a milvus collection database.
+    """Queue a job that downloads abstracts from arxiv and stores them in milvus.
 
-    The collection name is the cleaned question string.
+    The papers are harvested, deduplicated, embedded and inserted in a streaming
+    pipeline by a background worker, so the download goes on while the page is
+    used or reloaded. Only one job writes to a collection at a time.
     """
-    st.write(f"Downloading {state['max_papers']} abstracts...")
-    bulk_papers = get_arxiv_abstracts(
-        query=", ".join(state["refined_keywords"][:10]),
-        max_results=state["max_papers"],
+    return get_job_queue().submit(
+        collection=state["collection_name"],
+        kind="download",
+        keywords=state["refined_keywords"][:10],
+        max_papers=state["max_papers"],
         sort_by=state["sort_by"],
+        embedding_dtype=state.get("embedding_dtype", "float32"),
     )
 
-    st.write("Total documents", len(bulk_papers))
 
-    bulk_papers = cache_documents_embeddings(bulk_papers)
-    state["total_new_documents"] = len(bulk_papers)
-    st.write("Total documents after removing duplicates", len(bulk_papers))
+def refresh_collection():
+    """Queue the download of the papers published after the last harvest.
+
+    Each keyword of the collection is queried by submitted date, and the paging
+    stops at its watermark, the newest paper harvested before.
+    """
+    watermarks = get_watermarks()
+    if len(watermarks.keywords) == 0:
+        st.warning("This collection has no harvest history to refresh from.")
+        return None
+    return get_job_queue().submit(
+        collection=state["collection_name"],
+        kind="refresh",
+        keywords=watermarks.keywords,
+        max_papers=state.get("max_papers", 1000),
+        sort_by="Submitted date",
+    )
+
 
-    st.write("Storing documents in vectorstore...")
-    _ = state["vector_db"].add_documents(bulk_papers)
-    state["vector_db"].col.flush()
-    st.write("Done!")
+def get_watermarks() -> HarvestWatermarks:
+    """Harvest watermarks of the collection that is currently loaded."""
+    return HarvestWatermarks(f"./cache/{state['collection_name']}/watermarks.json")
 
 
 def clear_recommendations():
-    """Clear the recommendations cache."""
-    for key in state.keys():
-        if "batch" in key:
-            del state[key]
+    """Show only the first rows of recommendations, for a new question.
+
+    The scores are cached by question, so they do not need to be cleared.
+    """
+    state["rows"] = 2
@@ -1,12 +1,199 @@
 """Vector database utilities."""
+import contextlib
+import fcntl
+import os
+import threading
+from typing import Iterable, Iterator, Optional
+
+import numpy as np
 import streamlit as st
+from app.utils.byte_store import PackedFileStore
+from app.utils.embedding_store import EmbeddingStore
+from app.utils.embeddings import QUERY_INSTRUCTION
+from app.utils.quantization import deserialize_embedding, serialize_embedding
+from langchain.embeddings.base import Embeddings
 from langchain.embeddings.cache import CacheBackedEmbeddings, _create_key_encoder
-from langchain.schema import Document
-from langchain.storage import LocalFileStore
+from langchain.schema import BaseStore, Document
+from langchain.storage import EncoderBackedStore, LocalFileStore
 from langchain.vectorstores import Milvus
+from pymilvus import Collection
 
 state = st.session_state
 
+# embedding caches of the process, by collection name
+_embedding_caches = {}
+_embedding_caches_lock = threading.Lock()
+
+# session state keys set when connecting to a collection
+COLLECTION_KEYS = [
+    "vector_db",
+    "cached_embedder",
+    "cache",
+    "key_index",
+    "embedding_store",
+    "collection_name",
+]
+
+
+def is_cache_key(key: str, namespace: str) -> bool:
+    """Keys written by the cached embedder are the namespace followed by an uuid."""
+    return key.startswith(namespace) and len(key) == len(namespace) + 36
+
+
+def open_embedding_cache(collection_name: str) -> PackedFileStore:
+    """Open the packed embedding cache of a collection, once per process.
+
+    The store and its index are shared by the sessions and the jobs, so the
+    reruns of the pages don't index the file again. Embeddings cached by older
+    versions of the app, as one file per abstract in ./cache/<collection>, are
+    moved into the packed store the first time the collection is opened.
+    """
+    with _embedding_caches_lock:
+        if collection_name not in _embedding_caches:
+            _embedding_caches[collection_name] = _load_embedding_cache(collection_name)
+        return _embedding_caches[collection_name]
+
+
+def _load_embedding_cache(collection_name: str) -> PackedFileStore:
+    """Open the packed embedding cache of a collection, and migrate the old one."""
+    root = f"./cache/{collection_name}"
+    cache = PackedFileStore(f"{root}/embedding_cache.pack")
+    if not os.path.isdir(root):
+        return cache
+
+    legacy_store = LocalFileStore(root)
+    # other processes can open the collection at the same time, and the
+    # files they moved are gone by the time the lock is released
+    with open(f"{root}/embedding_cache.lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            legacy_keys = [
+                entry.name
+                for entry in os.scandir(root)
+                if entry.is_file() and is_cache_key(entry.name, collection_name)
+            ]
+            batch_size = 5000
+            for i in range(0, len(legacy_keys), batch_size):
+                keys = legacy_keys[i : i + batch_size]
+                values = legacy_store.mget(keys)
+                cache.mset([(k, v) for k, v in zip(keys, values) if v is not None])
+                for key in keys:
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(os.path.join(root, key))
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    return cache
+
+
+class KeyIndex:
+    """
+    Persistent set with the embedding cache keys of a collection.
+
+    The keys are kept in memory as a hash set and persisted in an append-only
+    text file, one key per line. The file is loaded once, so membership checks
+    don't need to walk the whole cache directory.
+    If the file does not exist yet, the index is bootstrapped from the keys
+    of the embedding cache.
+
+    Parameters:
+        path (str):
+            Path of the file where the keys are persisted.
+
+        namespace (str):
+            Namespace of the cache keys, usually the collection name.
+
+        store (BaseStore):
+            Embedding cache used to bootstrap the index.
+    """
+
+    def __init__(self, path: str, namespace: str, store: BaseStore = None):
+        """Load the index from disk, or build it from the store."""
+        self.path = path
+        self.namespace = namespace
+        self._keys = set()
+        if os.path.exists(self.path):
+            with open(self.path, "r") as f:
+                self._keys = {line.strip() for line in f if line.strip()}
+        elif store is not None:
+            self.add(key for key in store.yield_keys() if is_cache_key(key, namespace))
+
+    def __contains__(self, key: str) -> bool:
+        """Check if the key is in the index."""
+        return key in self._keys
+
+    def __len__(self) -> int:
+        """Number of keys in the index."""
+        return len(self._keys)
+
+    def is_new(self, keys: list[str]) -> list[bool]:
+        """Membership check for a batch of keys.
+
+        A key is new if it is not in the index and it is not repeated earlier
+        in the same batch.
+        """
+        seen = set()
+        new = []
+        for key in keys:
+            new.append(key not in self._keys and key not in seen)
+            seen.add(key)
+        return new
+
+    def add(self, keys: Iterable[str]):
+        """Add keys to the index and append them to the file."""
+        new_keys = [key for key in dict.fromkeys(keys) if key not in self._keys]
+        if len(new_keys) == 0:
+            return
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path, "a") as f:
+            f.writelines(f"{key}\n" for key in new_keys)
+        self._keys.update(new_keys)
+
+
+def open_collection(
+    collection_name: str, embedding_model: Embeddings, embedding_dtype: str = "float32"
+) -> dict:
+    """Open a collection, without touching the session state.
+
+    Returns a dict with the collection name, the embedding cache, its key index,
+    the embedding store, the cached embedder and the Milvus vector database.
+    """
+    cache = open_embedding_cache(collection_name)
+    key_index = KeyIndex(
+        path=f"./cache/{collection_name}/key_index.txt",
+        namespace=collection_name,
+        store=cache,
+    )
+    embedding_store = EmbeddingStore(
+        f"./cache/{collection_name}/embeddings", mode=embedding_dtype
+    )
+    mode = embedding_store.mode
+    cached_embedder = CacheBackedEmbeddings(
+        underlying_embeddings=embedding_model,
+        document_embedding_store=EncoderBackedStore(
+            store=cache,
+            key_encoder=_create_key_encoder(namespace=collection_name),
+            value_serializer=lambda value: serialize_embedding(value, mode),
+            value_deserializer=deserialize_embedding,
+        ),
+    )
+    vector_db = Milvus(
+        collection_name=collection_name,
+        embedding_function=cached_embedder,
+    )
+    return {
+        "collection_name": collection_name,
+        "cache": cache,
+        "key_index": key_index,
+        "embedding_store": embedding_store,
+        "cached_embedder": cached_embedder,
+        "vector_db": vector_db,
+    }
+
+
+def current_collection() -> dict:
+    """The collection the session is connected to, as returned by open_collection."""
+    return {key: state[key] for key in COLLECTION_KEYS}
+
 
 def connect_to_vector_db():
     """Connect to pre-existing vector database.
@@ -15,68 +202,172 @@ def connect_to_vector_db():
     The cached documents prevent duplicated documents.
     """
     state["nice_collection_name"] = state["collection_name"].replace("_", " ").title()
-    state["cache"] = LocalFileStore(f"./cache/{state['collection_name']}")
-    state["cached_embedder"] = CacheBackedEmbeddings.from_bytes_store(
-        underlying_embeddings=state["embedding_model"],
-        document_embedding_cache=state["cache"],
-        namespace=state["collection_name"],
-    )
-    state["vector_db"] = Milvus(
-        collection_name=state["collection_name"],
-        embedding_function=state["cached_embedder"],
+    state.update(
+        open_collection(
+            collection_name=state["collection_name"],
+            embedding_model=state["embedding_model"],
+            embedding_dtype=state.get("embedding_dtype", "float32"),
+        )
     )
 
 
 def disconnect_from_vector_db():
     """Disconnect from the vector database."""
-    if "vector_db" in state:
-        del state["vector_db"]
+    for key in COLLECTION_KEYS:
+        if key in state:
+            del state[key]
 
-    if "cached_embedder" in state:
-        del state["cached_embedder"]
 
-    if "cache" in state:
-        del state["cache"]
+def get_document_keys(
+    docs: list[Document], collection_name: Optional[str] = None
+) -> list[str]:
+    """Get the embedding cache keys of the documents, by default of the session."""
+    # encoder used by langchain
+    key_encoder = _create_key_encoder(
+        namespace=collection_name or state["collection_name"]
+    )
+    return [key_encoder(doc.page_content) for doc in docs]
 
-    if "collection_name" in state:
-        del state["collection_name"]
 
-    for key in state:
-        if key.startswith("batch"):
-            del state[key]
+def iter_document_pages(
+    page_size: int = 1000, with_vectors: bool = True, collection: dict = None
+) -> Iterator[tuple[list[Document], Optional[np.ndarray]]]:
+    """Stream all the documents of a collection in fixed-size pages.
 
+    Uses the Milvus query iterator, so no query is embedded and the collection
+    can be bigger than the top-k limit of a search. Each page is a list of
+    documents and, if requested, a float32 array with their stored vectors.
+    Memory use is bounded by the page size.
+    Defaults to the collection that is currently loaded.
+    """
+    vector_db = (collection or current_collection())["vector_db"]
+    if vector_db.col is None:
+        return
+    output_fields = [f for f in vector_db.fields if f != vector_db._vector_field]
+    if with_vectors:
+        output_fields.append(vector_db._vector_field)
 
-def cache_documents_embeddings(docs: list[Document]):
-    """Get the embeddings for the documents and cache them.
+    iterator = vector_db.col.query_iterator(
+        batch_size=page_size, output_fields=output_fields
+    )
+    try:
+        while True:
+            page = iterator.next()
+            if len(page) == 0:
+                break
+            docs, vectors = [], []
+            for entity in page:
+                metadata = {
+                    key: entity[key]
+                    for key in output_fields
+                    if key not in (vector_db._text_field, vector_db._vector_field)
+                }
+                docs.append(
+                    Document(
+                        page_content=entity[vector_db._text_field], metadata=metadata
+                    )
+                )
+                if with_vectors:
+                    vectors.append(entity[vector_db._vector_field])
+            if with_vectors:
+                yield docs, np.array(vectors, dtype=np.float32)
+            else:
+                yield docs, None
+    finally:
+        iterator.close()
+
+
+def get_all_documents(collection: dict = None) -> list[Document]:
+    """Get all documents from the vector database that is currently loaded"""
+    return [
+        doc
+        for docs, _ in iter_document_pages(with_vectors=False, collection=collection)
+        for doc in docs
+    ]
 
-    Checks for duplicates before caching.
-    Returns list of documents that were not in the database.
+
+def get_all_documents_and_keys(
+    collection: dict = None,
+) -> tuple[list[Document], list[str]]:
+    """Get all documents from the vector database and their embedding keys.
+
+    The keys index the embeddings in the memory-mapped embedding store of the
+    collection. If some vectors are missing from the store, for example in
+    collections created before the store existed, they are read from Milvus and
+    appended to the store.
     """
-    st.write("Checking cache for duplicates...")
-    new_docs = check_for_duplicates(docs)
-    if len(new_docs) > 0:
-        st.write(f"Encoding {len(new_docs)} new documents.")
-        state["cached_embedder"].embed_documents([doc.page_content for doc in new_docs])
-    return new_docs
+    collection = collection or current_collection()
+    embedding_store = collection["embedding_store"]
+    documents = get_all_documents(collection)
+    keys = get_document_keys(documents, collection["collection_name"])
+    if not embedding_store.contains_all(keys):
+        for docs, vectors in iter_document_pages(
+            with_vectors=True, collection=collection
+        ):
+            embedding_store.append(
+                get_document_keys(docs, collection["collection_name"]), vectors
+            )
+    return documents, keys
 
 
-def check_for_duplicates(docs: list[Document]):
-    """Only return documents that where not in the database.
+def sample_vectors(n: int = 1000, collection: dict = None) -> np.ndarray:
+    """Get the float32 vectors of the first n documents stored in Milvus.
 
-    Extract the uuid of the documents. If the uuid is not in the database, return
-    the document.
+    Milvus keeps the vectors in float32 whatever the mode of the embedding store,
+    so they are the reference of the quantized ones.
     """
-    # encoder used by langchain
-    preexisting_keys = list(state["cache"].yield_keys())
-    key_encoder = _create_key_encoder(namespace=state["collection_name"])
-    keys = [key_encoder(doc.page_content) for doc in docs]
-    return [doc for doc, key in zip(docs, keys) if key not in preexisting_keys]
+    pages = []
+    found = 0
+    for _, vectors in iter_document_pages(
+        page_size=min(n, 1000), with_vectors=True, collection=collection
+    ):
+        pages.append(vectors[: n - found])
+        found += len(pages[-1])
+        if found >= n:
+            break
+    if len(pages) == 0:
+        return np.empty((0, 0), dtype=np.float32)
+    return np.concatenate(pages)
 
 
-def get_all_documents() -> list[Document]:
-    """Get all documents from the vector database that is currently loaded"""
-    return state["vector_db"].similarity_search(
-        query="query",
-        k=state["vector_db"].col.num_entities,
+def insert_embedded_documents(
+    vector_db: Milvus, docs: list[Document], embeddings: np.ndarray
+) -> list[int]:
+    """Insert documents with precomputed embeddings in the vector database.
+
+    Same as `add_documents`, without calling the embedder again. Creates the
+    collection if it does not exist yet.
+    """
+    if len(docs) == 0:
+        return []
+    texts = [doc.page_content for doc in docs]
+    metadatas = [doc.metadata for doc in docs]
+    embeddings = np.asarray(embeddings, dtype=np.float32).tolist()
+    if not isinstance(vector_db.col, Collection):
+        vector_db._init(embeddings=embeddings, metadatas=metadatas)
+
+    insert_dict = {vector_db._text_field: texts, vector_db._vector_field: embeddings}
+    for field in vector_db.fields:
+        if field not in insert_dict:
+            insert_dict[field] = [metadata.get(field) for metadata in metadatas]
+    result = vector_db.col.insert([insert_dict[field] for field in vector_db.fields])
+    return result.primary_keys
+
+
+def search_papers(vector_db: Milvus, question: str, k: int = 12) -> list[dict]:
+    """Search the papers of a collection that are most relevant to a question."""
+    similar_docs = vector_db.similarity_search(
+        query=QUERY_INSTRUCTION + question,
+        k=k,
         param={"metric_type": "L2", "params": {"nprobe": 16}},
     )
+    return [
+        {
+            "title": doc.metadata["title"],
+            "authors": doc.metadata["authors"],
+            "published": doc.metadata["published"],
+            "abstract": doc.page_content,
+            "link": doc.metadata["link"],
+        }
+        for doc in similar_docs
+    ]
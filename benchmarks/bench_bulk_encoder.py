@@ -0,0 +1,58 @@
+"""Benchmark the bulk encoder against the single-call embedding path.
+
+Usage:
+    poetry run python benchmarks/bench_bulk_encoder.py --n-docs 3000
+"""
+import argparse
+import random
+import time
+
+from app.utils.bulk_encoder import BulkEncoder
+from app.utils.embeddings import create_embedding_model
+
+WORDS = (
+    "galaxy redshift spectroscopy telescope infrared emission star formation "
+    "dust halo cluster survey photometry quasar black hole accretion disk "
+    "model simulation observation evidence population metallicity"
+).split()
+
+
+def synthetic_abstracts(n_docs: int, seed: int = 42) -> list[str]:
+    """Abstract-like texts with a realistic spread of lengths."""
+    rng = random.Random(seed)
+    return [
+        " ".join(rng.choice(WORDS) for _ in range(rng.randint(40, 300)))
+        for _ in range(n_docs)
+    ]
+
+
+def main():
+    """Run the benchmark and print docs/sec of each path."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--n-docs", type=int, default=3000)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--backend", default=None, choices=["torch", "onnx"])
+    args = parser.parse_args()
+
+    texts = synthetic_abstracts(args.n_docs)
+
+    model = create_embedding_model(args.backend)
+    start = time.perf_counter()
+    model.embed_documents(texts)
+    single_call = time.perf_counter() - start
+
+    encoder = BulkEncoder(n_workers=args.workers, backend=args.backend)
+    start = time.perf_counter()
+    encoder.encode(texts)
+    bulk = time.perf_counter() - start
+
+    print(f"{'path':<28}{'seconds':>10}{'docs/sec':>12}")
+    print(
+        f"{'embed_documents':<28}{single_call:>10.1f}{len(texts) / single_call:>12.1f}"
+    )
+    label = f"BulkEncoder ({encoder.n_workers} workers)"
+    print(f"{label:<28}{bulk:>10.1f}{len(texts) / bulk:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
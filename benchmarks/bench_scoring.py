@@ -0,0 +1,78 @@
+"""Benchmark the concurrent paper scorer against the sequential batches.
+
+Uses the local stand-in chat model with a simulated latency, so no API is
+called. Checks that the labels come back in the order of the papers.
+
+Usage:
+    poetry run python benchmarks/bench_scoring.py --n-papers 16 --latency 1.0
+"""
+import argparse
+import os
+import tempfile
+import time
+
+os.environ["LLM_BACKEND"] = "stand-in"
+
+from app.utils.llm import ScorePapersAgent, chat  # noqa: E402
+from app.utils.score_cache import PaperScoreCache, paper_id  # noqa: E402
+from app.utils.scoring import PaperScorer  # noqa: E402
+
+
+def synthetic_papers(n_papers: int, offset: int = 0) -> list[dict]:
+    """Papers with distinct arXiv ids."""
+    return [
+        {
+            "title": f"Paper {i}",
+            "authors": "A. Author",
+            "published": 2023,
+            "abstract": f"Abstract of paper {i}.",
+            "link": f"http://arxiv.org/abs/2301.{i:05d}v1",
+        }
+        for i in range(offset, offset + n_papers)
+    ]
+
+
+def main():
+    """Run the benchmark and print the seconds of each path."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--n-papers", type=int, default=16)
+    parser.add_argument("--latency", type=float, default=1.0)
+    parser.add_argument("--concurrency", type=int, default=4)
+    args = parser.parse_args()
+    chat.latency = args.latency
+    batch_size = 4
+
+    papers = synthetic_papers(args.n_papers)
+    start = time.perf_counter()
+    for i in range(0, len(papers), batch_size):
+        ScorePapersAgent("question", papers[i : i + batch_size]).get_chat_labels()
+    sequential = time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as tmp:
+        scorer = PaperScorer(
+            max_concurrency=args.concurrency,
+            batch_size=batch_size,
+            cache=PaperScoreCache(os.path.join(tmp, "scores.db")),
+        )
+        start = time.perf_counter()
+        labels = scorer.score("question", papers)
+        concurrent = time.perf_counter() - start
+        expected = [paper_id(paper) for paper in papers]
+        assert [label.id for label in labels] == expected, "labels out of order"
+
+        next_page = synthetic_papers(batch_size, offset=args.n_papers)
+        scorer.prefetch("question", next_page)
+        time.sleep(args.latency * 2)
+        start = time.perf_counter()
+        scorer.score("question", next_page)
+        prefetched = time.perf_counter() - start
+
+    print(f"{'path':<34}{'seconds':>10}")
+    print(f"{'sequential batches':<34}{sequential:>10.2f}")
+    label = f"PaperScorer ({args.concurrency} concurrent)"
+    print(f"{label:<34}{concurrent:>10.2f}")
+    print(f"{'next page, after prefetch':<34}{prefetched:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
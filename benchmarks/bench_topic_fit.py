@@ -0,0 +1,125 @@
+"""Benchmark the topic model fit time and peak memory against the collection size.
+
+Each size is fitted in its own process, once on the whole collection and once on a
+sample, so the peak RSS of a run is not hidden by a previous one. The abstracts and
+their embeddings are synthetic clusters, and the topics are labeled by the local
+stand-in chat model, so no API is called.
+
+Usage:
+    poetry run python benchmarks/bench_topic_fit.py --sizes 10000 30000 100000
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+WORDS = (
+    "galaxy redshift spectroscopy telescope infrared emission star formation "
+    "dust halo cluster survey photometry quasar black hole accretion disk "
+    "model simulation observation evidence population metallicity"
+).split()
+
+
+def synthetic_collection(n_docs: int, dim: int = 384, n_clusters: int = 50):
+    """Abstracts, embedding keys and clustered embeddings of a collection."""
+    rng = np.random.default_rng(42)
+    text_rng = random.Random(42)
+    centers = rng.normal(size=(n_clusters, dim)).astype(np.float32)
+    clusters = rng.integers(n_clusters, size=n_docs)
+    embeddings = centers[clusters] + rng.normal(scale=0.5, size=(n_docs, dim))
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+    abstracts = []
+    for cluster in clusters:
+        words = WORDS[cluster % len(WORDS) :] + WORDS
+        abstracts.append(
+            " ".join(
+                text_rng.choice(words[:8]) for _ in range(text_rng.randint(40, 200))
+            )
+        )
+    years = rng.integers(2015, 2024, size=n_docs)
+    keys = [f"doc-{i}" for i in range(n_docs)]
+    return abstracts, years.tolist(), keys, embeddings.astype(np.float32)
+
+
+def run_fit(n_docs: int, sample_size: int) -> dict:
+    """Fit a topic model in this process, and return its seconds and peak RSS."""
+    os.environ["LLM_BACKEND"] = "stand-in"
+    from app.utils import topic_model
+    from app.utils.embedding_store import EmbeddingStore
+    from langchain.schema import Document
+
+    abstracts, years, keys, embeddings = synthetic_collection(n_docs)
+    documents = [
+        Document(page_content=abstract, metadata={"published": year})
+        for abstract, year in zip(abstracts, years)
+    ]
+    store = EmbeddingStore(os.path.join("cache", "bench", "embeddings"))
+    store.append(keys, embeddings)
+    del abstracts, embeddings
+    # the documents come from memory instead of Milvus
+    topic_model.get_all_documents_and_keys = lambda collection: (documents, keys)
+
+    model = topic_model.TopicModel(
+        collection={"collection_name": "bench", "embedding_store": store}
+    )
+    start = time.perf_counter()
+    model.fit_model(sample_size=sample_size)
+    seconds = time.perf_counter() - start
+    return {
+        "seconds": seconds,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "topics": len(model.topic_model.get_topics()),
+    }
+
+
+def main():
+    """Fit each size in a subprocess, and print the seconds and peak RSS."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 30_000])
+    parser.add_argument("--sample-size", type=int, default=20_000)
+    parser.add_argument("--child", type=int, nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_fit(*args.child)))
+        return
+
+    print(
+        f"{'documents':>10}  {'mode':<8}{'seconds':>10}{'peak RSS MB':>14}{'topics':>8}"
+    )
+    for n_docs in args.sizes:
+        modes = [("full", n_docs)]
+        if n_docs > args.sample_size:
+            modes.append(("sampled", args.sample_size))
+        for mode, sample_size in modes:
+            with tempfile.TemporaryDirectory() as tmp:
+                output = subprocess.run(
+                    [sys.executable, os.path.abspath(__file__)]
+                    + ["--child", str(n_docs), str(sample_size)],
+                    cwd=tmp,
+                    env={
+                        **os.environ,
+                        "PYTHONPATH": os.pathsep.join(
+                            [os.getcwd(), os.environ.get("PYTHONPATH", "")]
+                        ),
+                    },
+                    capture_output=True,
+                    text=True,
+                    check=True,
+                ).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            print(
+                f"{n_docs:>10}  {mode:<8}{result['seconds']:>10.1f}"
+                f"{result['peak_rss_mb']:>14.0f}{result['topics']:>8}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,6 @@
+"""Shared setup of the tests."""
+import os
+
+# the models are created when app.utils.llm is imported, so the tests never
+# call the OpenAI API
+os.environ["LLM_BACKEND"] = "stand-in"
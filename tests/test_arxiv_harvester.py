@@ -0,0 +1,229 @@
+"""Tests of the arXiv harvester against a local fake arXiv server."""
+import datetime
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from app.utils.arxiv_harvester import ArxivHarvester, HarvestWatermarks, TokenBucket
+
+FEED = """<?xml version="1.0" encoding="UTF-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom"
+      xmlns:opensearch="http://a9.com/-/spec/opensearch/1.1/"
+      xmlns:arxiv="http://arxiv.org/schemas/atom">
+  <title>Fake arXiv query</title>
+  <opensearch:totalResults>{total}</opensearch:totalResults>
+  <opensearch:startIndex>{start}</opensearch:startIndex>
+  <opensearch:itemsPerPage>{size}</opensearch:itemsPerPage>
+{entries}
+</feed>
+"""
+
+ENTRY = """  <entry>
+    <id>http://arxiv.org/abs/{id}</id>
+    <updated>{published}</updated>
+    <published>{published}</published>
+    <title>Paper {id}</title>
+    <summary>Abstract of paper {id}.</summary>
+    <author><name>A. Author</name></author>
+    <link href="http://arxiv.org/abs/{id}" rel="alternate" type="text/html"/>
+    <arxiv:primary_category term="astro-ph.GA"/>
+    <category term="astro-ph.GA"/>
+  </entry>"""
+
+
+def paper(number: int, day: int, version: int = 1) -> dict:
+    """A paper of the fake server, published `day` days after 2023-01-01."""
+    published = datetime.datetime(2023, 1, 1) + datetime.timedelta(days=day)
+    return {
+        "id": f"2301.{number:05d}v{version}",
+        "published": published.strftime("%Y-%m-%dT%H:%M:%SZ"),
+    }
+
+
+class FakeArxiv:
+    """
+    State of the fake arXiv API: the papers of each query and the requests seen.
+
+    Parameters:
+        papers (dict):
+            Papers of each search query, in relevance order.
+    """
+
+    def __init__(self, papers: dict[str, list[dict]]):
+        """Start without requests."""
+        self.papers = papers
+        self.empty_pages = 0
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def page(self, query: str, sort_by: str, start: int, size: int) -> bytes:
+        """Atom feed of a page of results."""
+        with self.lock:
+            self.requests.append((query, start, size))
+            papers = list(self.papers.get(query, []))
+            empty = self.empty_pages > 0
+            if empty:
+                self.empty_pages -= 1
+        if sort_by == "submittedDate":
+            papers.sort(key=lambda paper: paper["published"], reverse=True)
+        entries = [] if empty else papers[start : start + size]
+        return FEED.format(
+            total=len(papers),
+            start=start,
+            size=size,
+            entries="\n".join(ENTRY.format(**entry) for entry in entries),
+        ).encode("utf-8")
+
+
+@pytest.fixture
+def fake_arxiv():
+    """Serve a fake arXiv API on localhost, and return its state and URL."""
+    state = FakeArxiv({})
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            params = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+            body = state.page(
+                params["search_query"][0],
+                params["sortBy"][0],
+                int(params["start"][0]),
+                int(params["max_results"][0]),
+            )
+            self.send_response(200)
+            self.send_header("Content-Type", "application/atom+xml")
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield state, f"http://127.0.0.1:{server.server_address[1]}/api/query"
+    server.shutdown()
+    server.server_close()
+
+
+def make_harvester(url: str, **kwargs) -> ArxivHarvester:
+    """Harvester of the fake server, with a rate limit that doesn't slow the tests."""
+    return ArxivHarvester(
+        base_url=url,
+        rate_limit=TokenBucket(rate=1000, capacity=100),
+        **kwargs,
+    )
+
+
+def test_capped_harvest_keeps_the_watermark(fake_arxiv, tmp_path):
+    """Only the harvests that reach the watermark or the end move the watermark."""
+    state, url = fake_arxiv
+    state.papers["galaxies"] = [paper(i, day=i) for i in range(100)]
+    watermarks = HarvestWatermarks(str(tmp_path / "watermarks.json"))
+    day = datetime.datetime(2023, 1, 1, tzinfo=datetime.timezone.utc)
+
+    harvester = make_harvester(url, page_size=10)
+    results = list(
+        harvester.harvest(["galaxies"], max_papers=25, sort_by="Submitted date")
+    )
+    assert len(results) == 25
+    watermarks.update(["galaxies"], harvester.latest_seen)
+    assert watermarks.published_dates()["galaxies"] is None
+
+    harvester = make_harvester(url, page_size=10)
+    results = list(
+        harvester.harvest(["galaxies"], max_papers=200, sort_by="Submitted date")
+    )
+    assert len(results) == 100
+    watermarks.update(["galaxies"], harvester.latest_seen)
+    assert watermarks.published_dates()["galaxies"] == day + datetime.timedelta(days=99)
+
+    # a refresh with fewer new papers than max_papers reaches the watermark
+    state.papers["galaxies"] += [paper(i, day=i) for i in range(100, 105)]
+    harvester = make_harvester(url, page_size=10)
+    results = list(
+        harvester.harvest(
+            ["galaxies"], max_papers=25, watermarks=watermarks.published_dates()
+        )
+    )
+    assert {result.entry_id.split("/")[-1] for result in results} >= {
+        f"2301.{i:05d}v1" for i in range(100, 105)
+    }
+    watermarks.update(["galaxies"], harvester.latest_seen)
+    assert watermarks.published_dates()["galaxies"] == day + datetime.timedelta(
+        days=104
+    )
+
+    # with more new papers than max_papers, the older new papers are not fetched
+    state.papers["galaxies"] += [paper(i, day=i) for i in range(105, 135)]
+    harvester = make_harvester(url, page_size=10)
+    results = list(
+        harvester.harvest(
+            ["galaxies"], max_papers=25, watermarks=watermarks.published_dates()
+        )
+    )
+    assert len(results) == 25
+    watermarks.update(["galaxies"], harvester.latest_seen)
+    assert watermarks.published_dates()["galaxies"] == day + datetime.timedelta(
+        days=104
+    )
+
+
+def test_versions_are_deduplicated_across_queries(fake_arxiv):
+    """A paper found by several queries, in different versions, is yielded once."""
+    state, url = fake_arxiv
+    state.papers["galaxies"] = [paper(i, day=i) for i in range(20)]
+    state.papers["quasars"] = [paper(i, day=i, version=2) for i in range(10, 30)]
+
+    results = list(
+        make_harvester(url, page_size=10).harvest(["galaxies", "quasars"], 100)
+    )
+
+    ids = [result.entry_id.split("/")[-1].split("v")[0] for result in results]
+    assert len(ids) == len(set(ids))
+    assert set(ids) == {f"2301.{i:05d}" for i in range(30)}
+
+
+def test_max_papers_caps_all_queries(fake_arxiv):
+    """The harvest stops at max_papers unique papers, over all the queries."""
+    state, url = fake_arxiv
+    state.papers["galaxies"] = [paper(i, day=i) for i in range(100)]
+    state.papers["quasars"] = [paper(i, day=i) for i in range(100, 200)]
+
+    harvester = make_harvester(url, page_size=10)
+    results = list(harvester.harvest(["galaxies", "quasars"], max_papers=25))
+
+    assert len(results) == 25
+    # each query pages only up to max_papers
+    assert all(start + size <= 25 for _, start, size in state.requests)
+
+
+def test_empty_pages_are_retried(fake_arxiv):
+    """An empty page before the end of the results is fetched again."""
+    state, url = fake_arxiv
+    state.papers["galaxies"] = [paper(i, day=i) for i in range(30)]
+    state.empty_pages = 1
+
+    results = list(make_harvester(url, page_size=10).harvest(["galaxies"], 100))
+
+    assert len(results) == 30
+    assert [start for _, start, _ in state.requests] == [0, 0, 10, 20]
+
+
+def test_requests_follow_the_rate_limit(fake_arxiv):
+    """The requests wait for the tokens of the rate limit."""
+    state, url = fake_arxiv
+    state.papers["galaxies"] = [paper(i, day=i) for i in range(50)]
+    harvester = ArxivHarvester(
+        base_url=url, page_size=10, rate_limit=TokenBucket(rate=20, capacity=1)
+    )
+
+    start = time.monotonic()
+    results = list(harvester.harvest(["galaxies"], 100))
+    elapsed = time.monotonic() - start
+
+    assert len(results) == 50
+    assert len(state.requests) == 5
+    # the first token is in the bucket, the other four come at 20 per second
+    assert elapsed >= 4 / 20 * 0.9
@@ -0,0 +1,74 @@
+"""Tests of the ONNX embedding backend against the sentence-transformers model."""
+import os
+import threading
+
+import numpy as np
+import pytest
+
+pytest.importorskip("onnxruntime")
+pytest.importorskip("torch")
+pytest.importorskip("sentence_transformers")
+
+from app.utils.embeddings import (  # noqa: E402
+    EMBEDDING_MODEL_NAME,
+    OnnxBgeEmbeddings,
+    create_embedding_model,
+)
+
+TEXTS = [
+    "We report the discovery of a galaxy at redshift 13.",
+    "Room temperature superconductivity in a nitrogen-doped hydride.",
+    "Dust attenuation curves of star-forming galaxies at cosmic noon.\nWith JWST.",
+]
+
+
+@pytest.fixture(scope="module")
+def onnx_model(tmp_path_factory) -> OnnxBgeEmbeddings:
+    """ONNX model exported once for the tests of the module."""
+    return OnnxBgeEmbeddings(cache_dir=str(tmp_path_factory.mktemp("onnx")))
+
+
+@pytest.fixture(scope="module")
+def torch_model():
+    """Reference sentence-transformers model."""
+    return create_embedding_model("torch")
+
+
+def test_documents_match_torch(onnx_model, torch_model):
+    """The ONNX document embeddings are close to the torch ones."""
+    onnx = np.array(onnx_model.embed_documents(TEXTS))
+    reference = np.array(torch_model.embed_documents(TEXTS))
+    assert onnx.shape == reference.shape
+    assert np.allclose(np.linalg.norm(onnx, axis=1), 1, atol=1e-4)
+    assert np.min(np.sum(onnx * reference, axis=1)) > 0.99
+
+
+def test_queries_match_torch(onnx_model, torch_model):
+    """The ONNX query embeddings use the same instruction as the torch ones."""
+    onnx = np.array(onnx_model.embed_query("stellar evolution"))
+    reference = np.array(torch_model.embed_query("stellar evolution"))
+    assert np.dot(onnx, reference) > 0.99
+
+
+def test_concurrent_first_loads(tmp_path):
+    """Models exported at the same time leave a single complete file."""
+    models, errors = [], []
+
+    def load():
+        """Load the model, keeping the error if any."""
+        try:
+            models.append(OnnxBgeEmbeddings(cache_dir=str(tmp_path)))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=load) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    model_dir = tmp_path / EMBEDDING_MODEL_NAME.replace("/", "__")
+    assert os.listdir(model_dir) == ["model_int8.onnx"]
+    first, second = (np.array(model.embed_documents(TEXTS)) for model in models)
+    assert np.allclose(first, second, atol=1e-5)
@@ -0,0 +1,81 @@
+"""Tests of the LLM response cache with the stand-in models."""
+import time
+
+import langchain
+import pytest
+from app.utils.llm import StandInChatModel, StandInLLM
+from app.utils.llm_cache import LLMResponseCache
+from app.utils.sqlite_utils import connect
+from langchain.schema import HumanMessage
+
+
+@pytest.fixture
+def llm_cache(tmp_path):
+    """Cache of the test, set as the langchain cache while the test runs."""
+    cache = LLMResponseCache(str(tmp_path / "llm_responses.db"))
+    previous = langchain.llm_cache
+    langchain.llm_cache = cache
+    yield cache
+    langchain.llm_cache = previous
+
+
+def test_hits_and_misses(llm_cache):
+    """Repeated prompts are answered by the cache, new prompts by the model."""
+    llm = StandInLLM()
+
+    first = llm("Keywords about galaxies: [")
+    second = llm("Keywords   about galaxies:\n[")
+    llm("Keywords about quasars: [")
+
+    assert first == second
+    assert llm.calls == 2
+    assert (llm_cache.hits, llm_cache.misses) == (1, 2)
+    assert llm_cache.hit_rate == pytest.approx(1 / 3)
+
+
+def test_chat_messages_are_cached(llm_cache):
+    """Chat generations are restored with their message."""
+    chat = StandInChatModel()
+    messages = [HumanMessage(content="Score these papers: {'id': '2301.00001'}")]
+
+    first = chat(messages)
+    second = chat(messages)
+
+    assert chat.calls == 1
+    assert second.content == first.content
+    assert type(second) is type(first)
+
+
+def test_least_recently_used_responses_are_evicted(tmp_path):
+    """Past max_bytes, the responses looked up the longest time ago are evicted."""
+    cache = LLMResponseCache(str(tmp_path / "llm_responses.db"))
+    llm = StandInLLM()
+    llm_string = str(sorted(llm.dict().items()))
+    answer = llm.generate(["first"]).generations[0]
+    for prompt in ["first", "second"]:
+        cache.update(prompt, llm_string, answer)
+        time.sleep(0.01)
+    cache.lookup("first", llm_string)
+    time.sleep(0.01)
+
+    # room for two responses, so the third evicts the least recently used one
+    with connect(cache.path) as connection:
+        size = connection.execute("SELECT MAX(size) FROM responses").fetchone()[0]
+    cache.max_bytes = 2 * size
+    cache.update("third", llm_string, answer)
+
+    assert cache.lookup("first", llm_string) is not None
+    assert cache.lookup("second", llm_string) is None
+    assert cache.lookup("third", llm_string) is not None
+
+
+def test_responses_persist_across_instances(tmp_path, llm_cache):
+    """A new cache on the same database answers the prompts of the previous one."""
+    StandInLLM()("Keywords about galaxies: [")
+
+    langchain.llm_cache = LLMResponseCache(llm_cache.path)
+    llm = StandInLLM()
+    llm("Keywords about galaxies: [")
+
+    assert llm.calls == 0
+    assert langchain.llm_cache.hits == 1
@@ -0,0 +1,162 @@
+"""Tests of the concurrent paper scorer with a stand-in chat llm."""
+import re
+import threading
+import time
+
+import langchain
+import pytest
+from app.utils import llm
+from app.utils.llm import StandInChatModel
+from app.utils.score_cache import PaperScoreCache
+from app.utils.scoring import PaperScorer
+from langchain.schema import HumanMessage
+
+QUESTION = "Which galaxies did JWST find at the highest redshifts?"
+
+
+def make_papers(numbers: list[int]) -> list[dict]:
+    """Papers with the fields given by the vector database."""
+    return [
+        {
+            "title": f"Paper {number}",
+            "abstract": f"Abstract of paper {number}.",
+            "link": f"http://arxiv.org/abs/2301.{number:05d}v1",
+        }
+        for number in numbers
+    ]
+
+
+class FakeChat(StandInChatModel):
+    """
+    Stand-in chat llm that records the papers of each call.
+
+    Parameters:
+        failures (list):
+            What the first calls do instead of answering: "raise" to fail, or the
+            id of a paper to leave out of the answer.
+    """
+
+    failures: list = []
+    asked: list = []
+    started: list = []
+    running: int = 0
+    max_running: int = 0
+
+    def _call(self, messages, stop=None, run_manager=None, **kwargs) -> str:
+        """Answer the last message, unless the call should fail."""
+        prompt = messages[-1].content
+        with _running_lock:
+            self.asked.append(re.findall(r"'id': '([^']*)'", prompt))
+            self.started.append(time.monotonic())
+            failure = self.failures.pop(0) if self.failures else None
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        try:
+            if failure == "raise":
+                time.sleep(self.latency)
+                raise ConnectionError("The llm is not available.")
+            if failure is not None:
+                prompt = prompt.replace(f"'id': '{failure}'", "")
+            return super()._call([HumanMessage(content=prompt)], stop, run_manager)
+        finally:
+            with _running_lock:
+                self.running -= 1
+
+
+_running_lock = threading.Lock()
+
+
+@pytest.fixture
+def fake_chat(monkeypatch) -> FakeChat:
+    """Fake chat llm answering the scoring agents, without the llm cache."""
+    chat = FakeChat()
+    monkeypatch.setattr(llm, "chat", chat)
+    monkeypatch.setattr(langchain, "llm_cache", None)
+    return chat
+
+
+def make_scorer(tmp_path, **kwargs) -> PaperScorer:
+    """Scorer with its own score cache and short backoffs."""
+    return PaperScorer(
+        cache=PaperScoreCache(str(tmp_path / "scores.db")), backoff=0.01, **kwargs
+    )
+
+
+def test_labels_follow_the_order_of_the_papers(fake_chat, tmp_path):
+    """Cached, new and repeated papers get their labels in the order asked."""
+    scorer = make_scorer(tmp_path, batch_size=2)
+    scorer.score(QUESTION, make_papers([3, 1]))
+
+    papers = make_papers([5, 1, 4, 3, 5, 2])
+    labels = scorer.score(QUESTION, papers)
+
+    assert [label.id for label in labels] == [
+        "2301.00005",
+        "2301.00001",
+        "2301.00004",
+        "2301.00003",
+        "2301.00005",
+        "2301.00002",
+    ]
+    asked = sorted(id_ for ids in fake_chat.asked for id_ in ids)
+    assert asked == [f"2301.{number:05d}" for number in [1, 2, 3, 4, 5]]
+
+
+def test_papers_in_flight_are_not_asked_again(fake_chat, tmp_path):
+    """A paper prefetched by one caller is awaited, not scored, by the next one."""
+    fake_chat.latency = 0.2
+    scorer = make_scorer(tmp_path, batch_size=2)
+
+    prefetch = scorer.prefetch(QUESTION, make_papers([1, 2, 3]))
+    time.sleep(0.05)
+    labels = scorer.score(QUESTION, make_papers([2, 3, 4]))
+    prefetch.result()
+
+    assert [label.id for label in labels] == ["2301.00002", "2301.00003", "2301.00004"]
+    asked = sorted(id_ for ids in fake_chat.asked for id_ in ids)
+    assert asked == ["2301.00001", "2301.00002", "2301.00003", "2301.00004"]
+
+
+def test_failed_calls_and_missing_papers_are_retried(fake_chat, tmp_path):
+    """Failed calls are retried, and only the missing papers are asked again."""
+    fake_chat.failures = ["raise", "2301.00002"]
+    scorer = make_scorer(tmp_path, batch_size=3)
+
+    labels = scorer.score(QUESTION, make_papers([1, 2, 3]))
+
+    assert len(labels) == 3
+    assert fake_chat.asked == [
+        ["2301.00001", "2301.00002", "2301.00003"],
+        ["2301.00001", "2301.00002", "2301.00003"],
+        ["2301.00002"],
+    ]
+
+
+def test_papers_still_missing_after_the_retries_raise(fake_chat, tmp_path):
+    """A paper the llm never scores raises an error after the retries."""
+    fake_chat.failures = ["2301.00002"] * 3
+    scorer = make_scorer(tmp_path, batch_size=2, num_retries=2)
+
+    with pytest.raises(ValueError):
+        scorer.score(QUESTION, make_papers([1, 2]))
+    assert len(fake_chat.asked) == 3
+
+
+def test_backoff_frees_the_concurrency_slot(fake_chat, tmp_path):
+    """Other batches are scored while a failed batch waits for its retry."""
+    fake_chat.failures = ["raise"]
+    fake_chat.latency = 0.05
+    scorer = PaperScorer(
+        max_concurrency=1,
+        batch_size=1,
+        backoff=0.5,
+        cache=PaperScoreCache(str(tmp_path / "scores.db")),
+    )
+
+    labels = scorer.score(QUESTION, make_papers([1, 2, 3]))
+
+    assert len(labels) == 3
+    assert fake_chat.max_running == 1
+    # the other batches are scored before the retry of the first one is due
+    assert fake_chat.asked[-1] == ["2301.00001"]
+    assert fake_chat.started[2] - fake_chat.started[0] < 0.5